@@ -1,54 +1,233 @@
 import dash
-from dash import dcc, html
-from dash.dependencies import Input, Output
+from dash import dcc, html, Patch
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
 import plotly.graph_objects as go
-import pandas as pd
+import plotly.io as pio
+from contextlib import contextmanager
+from functools import lru_cache
+import ratio_store
+import fact_db
 import xbrl_functions
+import peer_index
+import entity_search
+import metrics
+import ratio_api
+import scenario
+import json
+import math
+import pandas as pd
+import os
+import textwrap
+import threading
+import time
 import warnings
 
 # Silence all warnings
 warnings.filterwarnings("ignore")
 
-# Load data
-df = pd.read_csv('xbrl_data.csv')
-report_ids = df['report.id'].unique().tolist()
-
-# Create the `final_ratios` DataFrame
-final_ratios = pd.DataFrame(columns= ['report_id', 'report_entity_name', 'ratio', 'value', 'green_start', 'green_end', 'yellow_start', 'yellow_end', 'red_start', 'red_end', 'var_1_name', 'var_1_value', 'var_2_name', 'var_2_value'])
-
-# Add the ratios to the `final_ratios` DataFrame
-for report_id in report_ids:
-    final_ratios = pd.concat([final_ratios, pd.DataFrame([xbrl_functions.get_short_run(df, report_id)], columns=final_ratios.columns)], ignore_index=True) # gauge-plot1
-    final_ratios = pd.concat([final_ratios, pd.DataFrame([xbrl_functions.get_days_cash_on_hand(df, report_id)], columns=final_ratios.columns)], ignore_index=True) # gauge-plot2
-    final_ratios = pd.concat([final_ratios, pd.DataFrame([xbrl_functions.get_liquidity(df, report_id)], columns=final_ratios.columns)], ignore_index=True) # gauge-plot3
-    final_ratios = pd.concat([final_ratios, pd.DataFrame([xbrl_functions.get_gov_debt_coverage(df, report_id)], columns=final_ratios.columns)], ignore_index=True) # gauge-plot4
-    final_ratios = pd.concat([final_ratios, pd.DataFrame([xbrl_functions.get_expenditure_per_capita(df, report_id)], columns=final_ratios.columns)], ignore_index=True) # gauge-plot5
-    final_ratios = pd.concat([final_ratios, pd.DataFrame([xbrl_functions.get_net_asset_growth(df, report_id)], columns=final_ratios.columns)], ignore_index=True) # gauge-plot6
-    final_ratios = pd.concat([final_ratios, pd.DataFrame([xbrl_functions.get_captial_asset_ga(df, report_id)], columns=final_ratios.columns)], ignore_index=True) # gauge-plot7
-    final_ratios = pd.concat([final_ratios, pd.DataFrame([xbrl_functions.get_captial_asset_bta(df, report_id)], columns=final_ratios.columns)], ignore_index=True) # gauge-plot8
-    final_ratios = pd.concat([final_ratios, pd.DataFrame([xbrl_functions.get_own_source_rev(df, report_id)], columns=final_ratios.columns)], ignore_index=True) # gauge-plot9
-    
-    # # # NOTE: UNCOMMENT TO ADD ADDITIONAL RATIOS TO THE DATAFRAME
-    # final_ratios = pd.concat([final_ratios, pd.DataFrame([xbrl_functions.INSERT_FUNCTION_NAME(df, report_id)], columns=final_ratios.columns)], ignore_index=True) # gauge-plot10
-
-# print(final_ratios)
+# Fact backend (set the environment variable FACT_BACKEND to choose):
+# `artifact` (default): Every ratio for every report ID is calculated in one batch (see `xbrl_functions.compute_ratios`) and saved to a
+# precomputed artifact, which is loaded into memory at startup (see `ratio_store.py`)
+# `sqlite`: Facts are stored in an indexed SQLite database (see `fact_db.py`). Only the list of municipalities & the peer index are
+# loaded at startup; the ratios of a municipality are calculated when it is selected and kept in a bounded LRU cache
+# Either way, the precomputed data is updated only when `xbrl_data.csv` has changed, and only for the municipalities whose facts changed
+# # # NOTE: TO ADD ADDITIONAL RATIOS, ADD AN ENTRY TO `RATIO_TARGETS` AND `BATCH_RATIOS` IN `xbrl_functions.py` (gauge-plot10, ...)
+fact_backend = os.environ.get('FACT_BACKEND', 'artifact')
+csv_path = 'xbrl_data.csv'
+artifact_path = 'xbrl_ratios.pkl'
+db_path = 'xbrl_facts.db'
+
+# Hot reload (set the environment variable RELOAD_INTERVAL to the number of seconds between checks, 0 to disable):
+# A background thread checks `xbrl_data.csv` for changes, recalculates the municipalities whose facts changed (see
+# `ratio_store.refresh_artifact` & `fact_db.update_database`), then swaps in the new data in a single step.
+# Requests keep using the old data until the swap.
+reload_interval = float(os.environ.get('RELOAD_INTERVAL', '30'))
+
+# This function loads the data the dashboard needs from the artifact or the fact database (see `fact_backend`)
+# Dataset keys & values are as follows:
+# `version`: Hash of the source data (changes whenever the data changes)
+# `source_stat`: (modification time, size) of `xbrl_data.csv` & the population table when they were loaded, to check for changes cheaply
+# `report_entity_names`: List of municipality names, in the order of the source data
+# `peers`: Sorted ratio values of every peer group (see `peer_index.py`)
+# `search_index`: Entity name & report ID search index for the dropdown (see `entity_search.py`)
+# `entity_versions`: Entity name -> hash of its ratios (artifact backend, see `ratio_store.entity_versions`) or of its facts (SQLite backend,
+# see `fact_db.entity_versions`), part of the gauge cache key
+# `artifact`: The artifact the dataset was loaded from (artifact backend only)
+# `entity_rows`: Entity name -> its `final_ratios` rows (artifact backend only), so callbacks never have to filter the whole DataFrame
+# `ratio_panel`: Every ratio for every fiscal year, indexed by (entity name, ratio, fiscal year) (artifact backend only)
+# `entity_names`: Report ID -> entity name
+# `report_ids`: Entity name -> report ID (SQLite backend only)
+def load_dataset(artifact=None):
+    source_stat = get_source_stat()
+    if fact_backend == 'sqlite':
+        database = fact_db.load_database(csv_path, db_path)
+        entities = fact_db.list_entities(db_path)
+        search_index = entity_search.build_search_index(entities)
+        return {'version': database['source_hash'], 'source_stat': source_stat,
+                'report_entity_names': entities['report_entity_name'].tolist(),
+                'peers': database['peer_index'],
+                'search_index': search_index,
+                'entity_versions': fact_db.entity_versions(db_path),
+                'entity_names': {report_id: entity_name for entity_name, report_id in search_index['entities']},
+                'report_ids': dict(zip(entities['report_entity_name'], entities['report_id']))}
+
+    artifact = artifact or ratio_store.load_artifact(csv_path, artifact_path)
+    final_ratios = artifact['final_ratios']
+    with metrics.timer('startup_stage_seconds', {'stage': 'entity_rows'}):
+        entity_rows = {name: rows.reset_index(drop=True) for name, rows in final_ratios.groupby('report_entity_name', sort=False)}
+    return {'version': artifact['source_hash'], 'source_stat': source_stat,
+            'report_entity_names': artifact['report_entity_name'],
+            'peers': artifact['peer_index'],
+            'search_index': artifact['search_index'],
+            'entity_versions': artifact['entity_versions'],
+            'entity_names': {report_id: entity_name for entity_name, report_id in artifact['search_index']['entities']},
+            'artifact': artifact,
+            'entity_rows': entity_rows,
+            'ratio_panel': artifact['ratio_panel']}
+
+# This function returns the (modification time, size) of `xbrl_data.csv` & of the population table (see `xbrl_functions.POPULATION_PATH`)
+def get_source_stat():
+    stats = [os.stat(path) for path in [csv_path, xbrl_functions.POPULATION_PATH] if os.path.exists(path)]
+    return tuple((stat.st_mtime_ns, stat.st_size) for stat in stats)
+
+# The current dataset (see `load_dataset`). It is only ever replaced as a whole (see `reload_dataset`), never modified
+dataset = load_dataset()
+
+# The dataset each callback thread is reading (see `pin_dataset`). The gauge caches take it from here rather than as an argument, so it is
+# not part of their cache keys (see `get_gauge`) and cached entries do not keep old datasets in memory
+pinned = threading.local()
+
+# This function returns the dataset pinned by the running callback, or the current dataset if none is
+def get_dataset():
+    return getattr(pinned, 'dataset', None) or dataset
+
+# This function makes every read of the dataset in this thread (see `get_dataset`) use `current` until the end of the `with` block.
+# A callback reads `dataset` once and pins it, so a reload in the middle of the callback cannot mix old & new data, e.g. cache the
+# figures of the new data under the entity version of the old data
+@contextmanager
+def pin_dataset(current):
+    previous = getattr(pinned, 'dataset', None)
+    pinned.dataset = current
+    try:
+        yield current
+    finally:
+        pinned.dataset = previous
+
+# This function checks `xbrl_data.csv` for changes and swaps in the new data. It returns True if the data was reloaded.
+# Cached gauge plots stay valid for the municipalities whose ratios did not change (see `get_gauge`)
+def reload_dataset():
+    global dataset
+    current = dataset
+    if get_source_stat() == current['source_stat']:
+        return False
+    with metrics.timer('data_reload_seconds', failures='data_reload_failures_total'):
+        xbrl_functions.set_populations(xbrl_functions.load_populations())
+        if fact_backend == 'sqlite':
+            if ratio_store.source_hash(csv_path) == current['version']:
+                new_dataset = dict(current, source_stat=get_source_stat())
+            else:
+                new_dataset = load_dataset()
+        else:
+            artifact = ratio_store.refresh_artifact(current['artifact'], csv_path, artifact_path)
+            new_dataset = load_dataset(artifact) if artifact is not None else dict(current, source_stat=get_source_stat())
+    reloaded = new_dataset['version'] != current['version']
+    dataset = new_dataset # single assignment: every request sees either the old or the new data, never a mix
+    if reloaded:
+        metrics.inc('data_reloads_total')
+        # Render the default municipality for the new data now, so the next visitors do not wait for it
+        if default_entity in new_dataset['report_entity_names'] and not clientside_gauges:
+            update_gauge_plots(default_entity)
+    return reloaded
+
+# This function checks for new data every `reload_interval` seconds, in a background thread (see `start_reloader`)
+def reload_loop():
+    while True:
+        time.sleep(reload_interval)
+        try:
+            reload_dataset()
+        except Exception as error: # keep serving the current data, and try again at the next check
+            print('Data reload failed: {!r}'.format(error))
+
+# This function starts the background reload thread (once per process)
+reloader = None
+def start_reloader():
+    global reloader
+    if reload_interval > 0 and reloader is None:
+        reloader = threading.Thread(target=reload_loop, name='data-reloader', daemon=True)
+        reloader.start()
+
+# This function returns the `final_ratios` rows of an entity name (one per ratio, in the order of `RATIO_TARGETS`)
+def get_entity_rows(value):
+    data = get_dataset()
+    if fact_backend == 'sqlite':
+        return fact_db.entity_ratios(data['report_ids'][value], db_path, data['entity_versions'][value])[0]
+    return data['entity_rows'][value]
+
+# This function returns the history of one ratio for an entity name from the ratio panel (see `xbrl_functions.ratio_history`)
+def get_ratio_history(value, ratio_name):
+    data = get_dataset()
+    if fact_backend == 'sqlite':
+        return xbrl_functions.ratio_history(fact_db.entity_ratios(data['report_ids'][value], db_path, data['entity_versions'][value])[1], value, ratio_name)
+    return xbrl_functions.ratio_history(data['ratio_panel'], value, ratio_name)
+
+# Number of gauge plots on the dashboard (gauge-plot1, gauge-plot2, ...), one per ratio
+# # # NOTE: INCREASE THIS (AND ADD THE `gauge-plot**` COMPONENTS TO THE LAYOUT) TO DISPLAY ADDITIONAL RATIOS
+gauge_count = 9
+
+# Maximum number of (entity, ratio) gauge plots & formulas kept in memory
+gauge_cache_size = 1024
+
+# Client-side gauge mode (set the environment variable CLIENTSIDE_GAUGES=1 to enable):
+# The gauges & formulas are rendered in the browser (see `assets/gauges.js`) from the data of the selected municipality, which is
+# fetched from `gauge_api_path` when it is selected (see `get_gauge_rows`), so the page only ever holds the municipalities viewed
+clientside_gauges = os.environ.get('CLIENTSIDE_GAUGES', '0') == '1'
+gauge_api_path = '/api/gauges'
+
+
+# Municipality selected when the dashboard is opened
+default_entity = 'County of Ogemaw'
+
+# This function returns the dropdown options for a list of (entity name, report ID) search results
+# NOTE: The dropdown also filters its options in the browser by the typed text, so the query is added to the `search` text
+# of each option; otherwise fuzzy matches (e.g. `flnt` for `Flint, Michigan`) would be hidden
+def entity_options(results, search_value=''):
+    return [{'label': '{} ({})'.format(entity_name, report_id), 'value': entity_name, 'search': '{} {} {}'.format(entity_name, report_id, search_value)}
+            for entity_name, report_id in results]
 
 
 # Define the Dash app
 app = dash.Dash(__name__)
+server = app.server # WSGI app for gunicorn (see `Procfile` & `gunicorn.conf.py`)
 
 # Defines the layout of the dashboard:
 formula_size = 30
-app.layout = html.Div([
+rank_size = 18
+trend_height = 220
+layout = html.Div([
     html.Meta(name="viewport", content="width=device-width, initial-scale=0.75"),
     html.H1("Government Financial Ratios", style={'textAlign': 'center'}),
     dcc.Dropdown(
-        options=[{'label': value, 'value': value} for value in final_ratios['report_entity_name'].unique()],
-        value='County of Ogemaw',
+        options=entity_options(entity_search.lookup_entity(dataset['search_index'], default_entity)),
+        value=default_entity,
+        placeholder='Search by municipality name or report ID',
         id='report-dropdown',
         clearable=False,
         style={'width': '50%', 'margin': 'auto', 'textAlign': 'center'}
     ), # dropdown menu
+
+    # What-if scenario: each slider changes one reported input by a percentage, and the gauges that use it are recalculated (see `update_scenario`)
+    # NOTE: Hidden in client-side gauge mode, where the dropdown never sends requests to the server (the scenario callbacks are not registered)
+    html.Details([
+        html.Summary("What-if scenario", style={'cursor': 'pointer', 'fontSize': 20}),
+        html.Div([
+            html.Div([
+                html.Label(label),
+                dcc.Slider(id='scenario-{}'.format(input_name), min=-50, max=50, step=5, value=0, updatemode='drag',
+                           marks={-50: '-50%', -25: '-25%', 0: 'As reported', 25: '+25%', 50: '+50%'}),
+            ]) for input_name, label in scenario.SCENARIO_INPUTS.items()
+        ], style={'display': 'grid', 'gridTemplateColumns': 'repeat(auto-fill, minmax(350px, 1fr))', 'gap': '10px 40px', 'padding': '10px'}),
+    ], hidden=clientside_gauges, style={'width': '75%', 'margin': 'auto', 'paddingTop': '20px'}),
     
     html.Br(),
     html.Br(),
@@ -61,6 +240,8 @@ app.layout = html.Div([
             html.Div(children=[
             dcc.Graph(id='gauge-plot1', mathjax=True),
             dcc.Markdown(id='gauge-plot1-text', mathjax=True, style={'fontSize': formula_size, 'textAlign': 'center'}),
+            dcc.Markdown(id='gauge-plot1-rank', style={'fontSize': rank_size, 'textAlign': 'center'}),
+            dcc.Graph(id='gauge-plot1-trend', config={'displayModeBar': False}, style={'height': trend_height}),
             ], style={'border': '3px solid black', 'padding': '20px', 'background-color': 'lavender'}),
             
             html.Br(),
@@ -70,6 +251,8 @@ app.layout = html.Div([
             html.Div(children=[
             dcc.Graph(id='gauge-plot2', mathjax=True),
             dcc.Markdown(id='gauge-plot2-text', mathjax=True, style={'fontSize': formula_size, 'textAlign': 'center'}),
+            dcc.Markdown(id='gauge-plot2-rank', style={'fontSize': rank_size, 'textAlign': 'center'}),
+            dcc.Graph(id='gauge-plot2-trend', config={'displayModeBar': False}, style={'height': trend_height}),
             ], style={'border': '3px solid black', 'padding': '20px', 'background-color': 'lavender'}),
             
             html.Br(),
@@ -79,6 +262,8 @@ app.layout = html.Div([
             html.Div(children=[
             dcc.Graph(id='gauge-plot3', mathjax=True),
             dcc.Markdown(id='gauge-plot3-text', mathjax=True, style={'fontSize': formula_size, 'textAlign': 'center'}),
+            dcc.Markdown(id='gauge-plot3-rank', style={'fontSize': rank_size, 'textAlign': 'center'}),
+            dcc.Graph(id='gauge-plot3-trend', config={'displayModeBar': False}, style={'height': trend_height}),
             ], style={'border': '3px solid black', 'padding': '20px', 'background-color': 'lavender'}),
             
             html.Br(),
@@ -88,6 +273,8 @@ app.layout = html.Div([
             html.Div(children=[
             dcc.Graph(id='gauge-plot4', mathjax=True),
             dcc.Markdown(id='gauge-plot4-text', mathjax=True, style={'fontSize': formula_size, 'textAlign': 'center'}),
+            dcc.Markdown(id='gauge-plot4-rank', style={'fontSize': rank_size, 'textAlign': 'center'}),
+            dcc.Graph(id='gauge-plot4-trend', config={'displayModeBar': False}, style={'height': trend_height}),
             ], style={'border': '3px solid black', 'padding': '20px', 'background-color': 'lavender'}),
             
             html.Br(),
@@ -97,6 +284,8 @@ app.layout = html.Div([
             html.Div(children=[
             dcc.Graph(id='gauge-plot9', mathjax=True),
             dcc.Markdown(id='gauge-plot9-text', mathjax=True, style={'fontSize': formula_size, 'textAlign': 'center'}),
+            dcc.Markdown(id='gauge-plot9-rank', style={'fontSize': rank_size, 'textAlign': 'center'}),
+            dcc.Graph(id='gauge-plot9-trend', config={'displayModeBar': False}, style={'height': trend_height}),
             ], style={'border': '3px solid black', 'padding': '20px', 'background-color': 'lavender'}),
 
             # # # NOTE: UNCOMMENT TO DISPLAY ADDITIONAL GAUGE PLOTS ON THE DASHBOARD (1ST COLUMN)
@@ -107,6 +296,7 @@ app.layout = html.Div([
             # html.Div(children=[
             # dcc.Graph(id='gauge-plot**', mathjax=True), # change `**` to the respective gauge plot number in the `final_ratios` DataFrame
             # dcc.Markdown(id='gauge-plot**-text', mathjax=True, style={'fontSize': formula_size, 'textAlign': 'center'}), # change `**` to the respective gauge plot number in the `final_ratios` DataFrame
+            # dcc.Graph(id='gauge-plot**-trend', config={'displayModeBar': False}, style={'height': trend_height}), # change `**` to the respective gauge plot number in the `final_ratios` DataFrame
             # ], style={'border': '3px solid black', 'padding': '20px', 'background-color': 'lavender'}),
 
         ], style={'padding': 10, 'flex': 0.5, 'textAlign': 'center'}), # 1st column of gauges & formulas
@@ -117,6 +307,8 @@ app.layout = html.Div([
             html.Div(children=[
             dcc.Graph(id='gauge-plot5', mathjax=True),
             dcc.Markdown(id='gauge-plot5-text', mathjax=True, style={'fontSize': formula_size, 'textAlign': 'center'}),
+            dcc.Markdown(id='gauge-plot5-rank', style={'fontSize': rank_size, 'textAlign': 'center'}),
+            dcc.Graph(id='gauge-plot5-trend', config={'displayModeBar': False}, style={'height': trend_height}),
             ], style={'border': '3px solid black', 'padding': '20px', 'background-color': 'lavender'}),
             
             html.Br(),
@@ -126,6 +318,8 @@ app.layout = html.Div([
             html.Div(children=[
             dcc.Graph(id='gauge-plot6', mathjax=True),
             dcc.Markdown(id='gauge-plot6-text', mathjax=True, style={'fontSize': formula_size, 'textAlign': 'center'}),
+            dcc.Markdown(id='gauge-plot6-rank', style={'fontSize': rank_size, 'textAlign': 'center'}),
+            dcc.Graph(id='gauge-plot6-trend', config={'displayModeBar': False}, style={'height': trend_height}),
             ], style={'border': '3px solid black', 'padding': '20px', 'background-color': 'lavender'}),
             
             html.Br(),
@@ -135,6 +329,8 @@ app.layout = html.Div([
             html.Div(children=[
             dcc.Graph(id='gauge-plot7', mathjax=True),
             dcc.Markdown(id='gauge-plot7-text', mathjax=True, style={'fontSize': formula_size, 'textAlign': 'center'}),
+            dcc.Markdown(id='gauge-plot7-rank', style={'fontSize': rank_size, 'textAlign': 'center'}),
+            dcc.Graph(id='gauge-plot7-trend', config={'displayModeBar': False}, style={'height': trend_height}),
             ], style={'border': '3px solid black', 'padding': '20px', 'background-color': 'lavender'}),
             
             html.Br(),
@@ -144,6 +340,8 @@ app.layout = html.Div([
             html.Div(children=[
             dcc.Graph(id='gauge-plot8', mathjax=True),
             dcc.Markdown(id='gauge-plot8-text', mathjax=True, style={'fontSize': formula_size, 'textAlign': 'center'}),
+            dcc.Markdown(id='gauge-plot8-rank', style={'fontSize': rank_size, 'textAlign': 'center'}),
+            dcc.Graph(id='gauge-plot8-trend', config={'displayModeBar': False}, style={'height': trend_height}),
             ], style={'border': '3px solid black', 'padding': '20px', 'background-color': 'lavender'}),
             
             # # # NOTE: UNCOMMENT TO DISPLAY ADDITIONAL GAUGE PLOTS ON THE DASHBOARD (2ND COLUMN)
@@ -154,22 +352,64 @@ app.layout = html.Div([
             # html.Div(children=[
             # dcc.Graph(id='gauge-plot**', mathjax=True), # change `**` to the respective gauge plot number in the `final_ratios` DataFrame
             # dcc.Markdown(id='gauge-plot**-text', mathjax=True, style={'fontSize': formula_size, 'textAlign': 'center'}), # change `**` to the respective gauge plot number in the `final_ratios` DataFrame
+            # dcc.Graph(id='gauge-plot**-trend', config={'displayModeBar': False}, style={'height': trend_height}), # change `**` to the respective gauge plot number in the `final_ratios` DataFrame
             # ], style={'border': '3px solid black', 'padding': '20px', 'background-color': 'lavender'}),
             
         ], style={'padding': 10, 'flex': 1}), # 2nd column of gauges & formulas
 
         html.Div(style={'flex': 0.25})  # empty div for spacing on the right
-    ], style={'display': 'flex', 'flexDirection': 'row'})
+    ], style={'display': 'flex', 'flexDirection': 'row'}),
+
+    # Comparison of many municipalities & ratios side by side (see `update_compare_grid`)
+    html.Hr(),
+    html.H2("Compare Municipalities", style={'textAlign': 'center'}),
+    dcc.Dropdown(
+        options=[],
+        value=[],
+        multi=True,
+        placeholder='Add municipalities by name or report ID',
+        id='compare-entities',
+        style={'width': '75%', 'margin': 'auto'}
+    ), # municipalities to compare
+    html.Br(),
+    dcc.Dropdown(
+        options=[{'label': ratio_name, 'value': ratio} for ratio, ratio_name in enumerate(list(xbrl_functions.RATIO_TARGETS)[:gauge_count])],
+        value=[0],
+        multi=True,
+        placeholder='Choose ratios to compare',
+        id='compare-ratios',
+        style={'width': '75%', 'margin': 'auto'}
+    ), # ratios to compare
+    html.P(id='compare-status', style={'textAlign': 'center'}),
+    html.Div(id='compare-grid', children=[],
+             style={'display': 'grid', 'gridTemplateColumns': 'repeat(auto-fill, minmax(320px, 1fr))', 'gap': '20px', 'padding': '20px'}),
+    html.Div(html.Button('Show more', id='compare-more', n_clicks=0, style={'display': 'none'}), style={'textAlign': 'center', 'paddingBottom': '40px'}),
+    dcc.Store(id='compare-loaded', data=0), # number of cards in `compare-grid`
 ]) # end of layout
 
+# This function returns the `final_ratios` rows of an entity for the browser, each with its `history` from the ratio panel (fiscal years & values)
+# and its peer ranking text (see `update_rank`)
+def entity_records(value):
+    records = get_entity_rows(value).iloc[:gauge_count].to_dict('records')
+    for ratio, record in enumerate(records):
+        history = get_ratio_history(value, record['ratio'])
+        record['history'] = {'years': history['fiscal_year'].tolist(), 'values': history['value'].tolist()}
+        record['rank'] = update_rank(value, ratio)
+    return records
+
 
 # This function creates a gauge plot for a given entity name and ratio index. It returns the gauge plot.
-def create_gauge(value, ratio):
+# `data` is the `final_ratios` row to plot instead of the entity's own (e.g. a what-if scenario, see `update_scenario`)
+@metrics.timed('callback_seconds', {'callback': 'create_gauge'}, 'callback_failures_total')
+def create_gauge(value, ratio, data=None):
     
     # Determines referenece value to calculate `Distance to Target` metric
     # Automates color change for `Distance to Target` metric, based on target ranges
-    data = final_ratios[final_ratios['report_entity_name'] == value].iloc[ratio]
+    if data is None:
+        data = get_entity_rows(value).iloc[ratio]
     ratio_value = data['value']
+    if math.isnan(ratio_value): # the ratio could not be calculated (see `unavailable_reason` in `xbrl_functions.py`)
+        return create_unavailable_gauge(data)
     green1 = data['green_start']
     green2 = data['green_end']
     red1 = data['red_start']
@@ -222,156 +462,353 @@ def create_gauge(value, ratio):
     return fig
 # end of create_gauge
 
+# This function creates the gauge plot of a ratio that could not be calculated: the target ranges without a value, and the reason
+def create_unavailable_gauge(data):
+    fig = go.Figure(go.Indicator(mode="gauge",
+        value=None,
+        domain={'x': [0, 1], 'y': [0, 1]},
+        title={'text': data['ratio'], 'font': {'size': 26, 'color': 'dimgray', 'family': 'Courier'}}, # graph title
+        gauge={
+            'axis': {'range': [None, max([data['green_end'], data['yellow_end'], data['red_end']])], 'tickwidth': 1, 'tickcolor': "black"}, # sets axis range
+            'bgcolor': "white",
+            'borderwidth': 2,
+            'bordercolor': "gray",
+            'steps': [
+                {'range': [data['red_start'], data['red_end']], 'color': 'mistyrose'},  # red range
+                {'range': [data['green_start'], data['green_end']], 'color': 'honeydew'},  # green target range
+                {'range': [data['yellow_start'], data['yellow_end']], 'color': 'lightyellow'}], # yellow/orange range
+        }
+    ))
+    fig.add_annotation(text='<b>Unavailable</b><br>' + '<br>'.join(textwrap.wrap(str(data['unavailable_reason']), 40)),
+                       x=0.5, y=0.1, xref='paper', yref='paper', showarrow=False, font={'size': 14, 'color': 'dimgray'})
+    fig.update_layout(paper_bgcolor="lavender", font={'color': 'dimgray', 'family': 'Courier New', 'size': 18}) # overall background color, font color + style
+    return fig
+# end of create_unavailable_gauge
+
 # This function updates the markdown text for each gauge plot. It takes in the selected entity name and ratio index.
-# It returns a string in LaTeX format that represents the formula for the ratio.
-def update_markdown(value, ratio):
-    data = final_ratios[final_ratios['report_entity_name'] == value].iloc[ratio]
+# It returns a string in LaTeX format that represents the formula for the ratio. `data` is the row to show instead (see `create_gauge`)
+@metrics.timed('callback_seconds', {'callback': 'update_markdown'}, 'callback_failures_total')
+def update_markdown(value, ratio, data=None):
+    if data is None:
+        data = get_entity_rows(value).iloc[ratio]
+    if math.isnan(data['value']): # the ratio could not be calculated, so only the formula is shown
+        return r"""$\text{{Formula}} = \frac{{\text{{ {} }}}}{{\text{{ {} }}}} = \text{{N/A}}$""".format(data['var_1_name'], data['var_2_name'])
     return r"""$\text{{Formula}} = \frac{{\text{{ {} }}}}{{\text{{ {} }}}} = \frac{{\text{{ {} }}}}{{\text{{ {} }}}}$""".format(data['var_1_name'], data['var_2_name'], round(data['var_1_value'], 2), round(data['var_2_value'], 2))
 
-# Define the callback functions to update the gauge plots based on the selected entity name
-@app.callback(
-    Output('gauge-plot1', 'figure'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot1(value):
-    return create_gauge(value, 0)
-
-@app.callback(
-    Output('gauge-plot2', 'figure'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot2(value):
-    return create_gauge(value, 1)
-
-@app.callback(
-    Output('gauge-plot3', 'figure'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot3(value):
-    return create_gauge(value, 2)
-
-@app.callback(
-    Output('gauge-plot4', 'figure'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot4(value):
-    return create_gauge(value, 3)
-
-@app.callback(
-    Output('gauge-plot5', 'figure'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot5(value):
-    return create_gauge(value, 4)
-
-@app.callback(
-    Output('gauge-plot6', 'figure'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot6(value):
-    return create_gauge(value, 5)
-
-@app.callback(
-    Output('gauge-plot7', 'figure'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot7(value):
-    return create_gauge(value, 6)
-
-@app.callback(
-    Output('gauge-plot8', 'figure'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot8(value):
-    return create_gauge(value, 7)
-
-@app.callback(
-    Output('gauge-plot9', 'figure'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot9(value):
-    return create_gauge(value, 8)
-
-# Define the callback functions to update the markdown text (formula) for each gauge plot based on the selected entity name
-@app.callback(
-    Output('gauge-plot1-text', 'children'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot1_text(value):
-    return update_markdown(value, 0)
-
-@app.callback(
-    Output('gauge-plot2-text', 'children'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot2_text(value):
-    return update_markdown(value, 1)
-
-@app.callback(
-    Output('gauge-plot3-text', 'children'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot3_text(value):
-    return update_markdown(value, 2)
-
-@app.callback(
-    Output('gauge-plot4-text', 'children'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot4_text(value):
-    return update_markdown(value, 3)
-
-@app.callback(
-    Output('gauge-plot5-text', 'children'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot5_text(value):
-    return update_markdown(value, 4)
-
-@app.callback(
-    Output('gauge-plot6-text', 'children'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot6_text(value):
-    return update_markdown(value, 5)
-
-@app.callback(
-    Output('gauge-plot7-text', 'children'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot7_text(value):
-    return update_markdown(value, 6)
-
-@app.callback(
-    Output('gauge-plot8-text', 'children'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot8_text(value):
-    return update_markdown(value, 7)
-
-@app.callback(
-    Output('gauge-plot9-text', 'children'),
-    [Input('report-dropdown', 'value')]
-)
-def update_gauge_plot9_text(value):
-    return update_markdown(value, 8)
-
-# # # NOTE: UNCOMMENT TO ADD CALLBACKS FOR ADDITIONAL GAUGE PLOTS
-# @app.callback(
-#     Output('gauge-plot**', 'figure'), # change `**` to the respective gauge plot number in the `final_ratios` DataFrame
-#     [Input('report-dropdown', 'value')]
-# )
-
-# def update_gauge_plot**(value): # change `**` to the respective gauge plot number in the `final_ratios` DataFrame
-#     return create_gauge(value, **) # change `**` to the respective gauge plot number in the `final_ratios` DataFrame
-    
-# @app.callback(
-#     Output('gauge-plot**-text', 'children'), # change `**` to the respective gauge plot number in the `final_ratios` DataFrame
-#     [Input('report-dropdown', 'value')]
-# )
-
-# def update_gauge_plot**_text(value): # change `**` to the respective gauge plot number in the `final_ratios` DataFrame
-#     return update_markdown(value, **) # change `**` to the respective gauge plot number in the `final_ratios` DataFrame
+# This function returns the markdown text ranking an entity against its peers for a given ratio index:
+# its percentile & the median among all filers, and among filers of the same type (see `peer_index.PEER_GROUPINGS`)
+@metrics.timed('callback_seconds', {'callback': 'update_rank'}, 'callback_failures_total')
+def update_rank(value, ratio):
+    data = get_entity_rows(value).iloc[ratio]
+    lines = []
+    for grouping in (None, 'type'):
+        rank = peer_index.peer_rank(get_dataset()['peers'], value, data['ratio'], grouping)
+        if rank is None:
+            return 'Peer ranking unavailable'
+        lines.append('**{}** ({}): {:.0f}th percentile, median {}'.format(rank['group'], rank['count'], rank['percentile'], round(rank['median'], 3)))
+    return '  \n'.join(lines)
+
+# This function creates a trend chart of a ratio over every available fiscal year, for a given entity name and ratio index.
+# The history is a slice of the ratio panel, so no ratios are recalculated. The green target range is shaded.
+@metrics.timed('callback_seconds', {'callback': 'create_trend'}, 'callback_failures_total')
+def create_trend(value, ratio):
+    data = get_entity_rows(value).iloc[ratio]
+    history = get_ratio_history(value, data['ratio'])
+
+    fig = go.Figure(go.Scatter(x=history['fiscal_year'], y=history['value'], mode='lines+markers',
+                               line={'color': 'black', 'width': 2}, marker={'size': 8},
+                               hovertemplate='%{x}: %{y:.3f}<extra></extra>'))
+    fig.add_hrect(y0=data['green_start'], y1=data['green_end'], fillcolor='mediumseagreen', opacity=0.25, line_width=0) # green target range
+    fig.update_layout(paper_bgcolor='lavender', plot_bgcolor='white', height=trend_height, margin={'l': 40, 'r': 20, 't': 40, 'b': 30},
+                      title={'text': 'Trend by Fiscal Year', 'font': {'size': 16, 'family': 'Courier New'}},
+                      xaxis={'tickmode': 'array', 'tickvals': history['fiscal_year'].tolist(), 'tickformat': 'd'},
+                      font={'family': 'Courier New', 'size': 12}, showlegend=False)
+    return fig
+# end of create_trend
+
+# This function returns the gauge plot, markdown text & trend chart for a given entity name and ratio index.
+# Results are kept in an LRU cache keyed by (entity name, ratio index, entity version), so repeat selections are served from memory.
+# The entity version only changes when that entity's ratios change, so a data reload does not empty the cache (see `reload_dataset`)
+# NOTE: The peer ranking is not cached, since it changes whenever any entity's ratios change (see `update_rank`)
+# NOTE: Callers pin the dataset they took the entity version from (see `pin_dataset`), so the entry is built from the same data
+@lru_cache(maxsize=gauge_cache_size)
+def get_gauge(value, ratio, version):
+    return create_gauge(value, ratio), update_markdown(value, ratio), create_trend(value, ratio)
+
+# Parts of the gauge plots & trend charts that change between entities, as paths in the figure. Everything else (the plotly template,
+# fonts, borders, ...) is the same for every entity, so it is only sent once with the layout and the callback sends the parts below.
+# Parts an entity's figure does not have (e.g. the `delta` of a ratio that could not be calculated) are deleted from the figure in the browser
+# NOTE: Add a path here if `create_gauge` or `create_trend` start to set another part differently for different entities
+gauge_patch_paths = [('data', 0, 'mode'), ('data', 0, 'value'), ('data', 0, 'title'), ('data', 0, 'delta'),
+                     ('data', 0, 'gauge', 'axis', 'range'), ('data', 0, 'gauge', 'bar'), ('data', 0, 'gauge', 'steps'), ('data', 0, 'gauge', 'threshold'),
+                     ('layout', 'font', 'color'), ('layout', 'annotations')]
+trend_patch_paths = [('data', 0, 'x'), ('data', 0, 'y'), ('layout', 'shapes'), ('layout', 'xaxis', 'tickvals')]
+
+# This function returns a `Patch` that turns any figure built by the same function into `figure`, by setting only the parts in `paths`
+def figure_patch(figure, paths):
+    source = json.loads(pio.to_json(figure)) # plain JSON values, as the browser would receive them
+    patch = Patch()
+    for path in paths:
+        value, target = source, patch
+        for key in path:
+            value = value[key] if isinstance(value, dict) and key in value or isinstance(value, list) and key < len(value) else None
+        for key in path[:-1]:
+            target = target[key]
+        if value is None:
+            del target[path[-1]]
+        else:
+            target[path[-1]] = value
+    return patch
+
+# This function returns the gauge plot patch, markdown text & trend chart patch for a given entity name and ratio index (see `figure_patch`)
+# Results are kept in an LRU cache keyed by (entity name, ratio index, entity version), like `get_gauge`
+@lru_cache(maxsize=gauge_cache_size)
+def get_gauge_patch(value, ratio, version):
+    figure, text, trend = get_gauge(value, ratio, version)
+    return figure_patch(figure, gauge_patch_paths), text, figure_patch(trend, trend_patch_paths)
+
+# This function returns the version of an entity's ratios, for the gauge cache key (the data version if there is none)
+def get_entity_version(value):
+    data = get_dataset()
+    return data['entity_versions'].get(value, data['version'])
+
+# The gauge plots & trend charts of the layout start as the figures of the default entity, and are patched from there (see `figure_patch`)
+# NOTE: Not needed in client-side gauge mode, where the browser builds the whole figures (see `assets/gauges.js`)
+if not clientside_gauges:
+    template_entity = default_entity if default_entity in dataset['report_entity_names'] else dataset['report_entity_names'][0]
+    for ratio in range(gauge_count):
+        figure, text, trend = get_gauge(template_entity, ratio, get_entity_version(template_entity))
+        layout['gauge-plot{}'.format(ratio + 1)].figure = figure
+        layout['gauge-plot{}-trend'.format(ratio + 1)].figure = trend
+
+# This function returns the layout for each page load, so new visitors always get the current data after a reload
+# In client-side gauge mode, the layout carries what the browser needs to fetch & render a municipality's gauges (see `assets/gauges.js`):
+# `path`: Route of the gauge data (see `get_gauge_rows`)
+# `version`: Version of the data, added to the URL so the browser's HTTP cache never serves the gauges of older data
+# `targets`: Ratio name & target ranges of each gauge, to render the gauges as unavailable if a municipality's data cannot be fetched
+def serve_layout():
+    if clientside_gauges:
+        targets = [dict(targets, ratio=ratio_name) for ratio_name, targets in list(xbrl_functions.RATIO_TARGETS.items())[:gauge_count]]
+        return html.Div(layout.children + [dcc.Store(id='gauge-config', data={'path': gauge_api_path, 'version': dataset['version'], 'targets': targets})])
+    return layout
+
+app.layout = serve_layout
+
+# Reports the hits & misses of the gauge cache on the metrics route
+def gauge_cache_metrics():
+    info = get_gauge_patch.cache_info()
+    return [('gauge_cache_hits_total', 'counter', None, info.hits),
+            ('gauge_cache_misses_total', 'counter', None, info.misses),
+            ('gauge_cache_size', 'gauge', None, info.currsize)]
+
+metrics.register_collector(gauge_cache_metrics)
+
+# Reports the hits & misses of the per-entity ratio cache on the metrics route (SQLite backend only)
+def entity_cache_metrics():
+    info = fact_db.entity_ratios.cache_info()
+    return [('entity_cache_hits_total', 'counter', None, info.hits),
+            ('entity_cache_misses_total', 'counter', None, info.misses),
+            ('entity_cache_size', 'gauge', None, info.currsize)]
+
+if fact_backend == 'sqlite':
+    metrics.register_collector(entity_cache_metrics)
+
+# Define the callback function to update every gauge plot, markdown text (formula), peer ranking & trend chart based on the selected entity name
+# Outputs are grouped by component: every gauge plot first, then every markdown text, and so on (same order as `gauge_components`)
+# Gauge plots & trend charts are sent as patches of the figures already in the browser (see `figure_patch`)
+gauge_components = [('gauge-plot{}', 'figure'), ('gauge-plot{}-text', 'children'), ('gauge-plot{}-rank', 'children'), ('gauge-plot{}-trend', 'figure')]
+gauge_outputs = [Output(component.format(i), prop) for component, prop in gauge_components for i in range(1, gauge_count + 1)]
+
+@metrics.timed('callback_seconds', {'callback': 'update_gauge_plots'}, 'callback_failures_total')
+def update_gauge_plots(value):
+    with pin_dataset(dataset):
+        version = get_entity_version(value)
+        gauges = []
+        for ratio in range(gauge_count):
+            figure, text, trend = get_gauge_patch(value, ratio, version)
+            gauges.append((figure, text, update_rank(value, ratio), trend))
+    return [gauge[part] for part in range(len(gauge_components)) for gauge in gauges]
+
+if clientside_gauges:
+    # Runs in the browser, with the gauge data fetched from `gauge_api_path` (see `assets/gauges.js`)
+    app.clientside_callback(ClientsideFunction(namespace='gauges', function_name='update_gauge_plots'),
+                            gauge_outputs, [Input('report-dropdown', 'value')], [State('gauge-config', 'data')])
+else:
+    app.callback(gauge_outputs, [Input('report-dropdown', 'value')])(update_gauge_plots)
+
+# Define the callback function to search the municipalities as the user types in the dropdown
+# Only the top matches are sent to the browser (see `entity_search.search_entities`), so the layout stays the same size however many municipalities there are
+@app.callback(Output('report-dropdown', 'options'), [Input('report-dropdown', 'search_value')], [State('report-dropdown', 'value')])
+@metrics.timed('callback_seconds', {'callback': 'update_dropdown_options'}, 'callback_failures_total')
+def update_dropdown_options(search_value, value):
+    if not search_value:
+        raise PreventUpdate
+    options = entity_options(entity_search.search_entities(dataset['search_index'], search_value), search_value)
+    # Keep the selected municipality in the options, otherwise the dropdown would clear it
+    if value not in [option['value'] for option in options]:
+        options += entity_options(entity_search.lookup_entity(dataset['search_index'], value))
+    return options
+
+# This function returns the version of a report ID's ratios for the ratio API, or of the whole dataset if `report_id` is None
+def get_api_version(report_id):
+    data = dataset
+    if report_id is None:
+        return data['version']
+    return data['entity_versions'].get(data['entity_names'].get(report_id), data['version'])
+
+# This function returns the `final_ratios` rows of a report ID for the ratio API, or of every municipality if `report_id` is None
+# NOTE: Every municipality's ratios are only available with the artifact backend (the SQLite backend calculates them on demand)
+def get_api_rows(report_id):
+    data = dataset
+    if report_id is None:
+        return data['artifact']['final_ratios'] if fact_backend != 'sqlite' else None
+    if report_id not in data['entity_names']:
+        return None
+    return get_entity_rows(data['entity_names'][report_id])
+
+# Ratios as JSON for embedding & programmatic use, without going through the Dash callbacks (see `ratio_api.py`):
+# `/api/ratios/<report_id>` for one municipality & `/api/ratios` for every municipality
+ratio_api.register_endpoints(app.server, get_api_version, get_api_rows)
+
+# This function returns the gauge data of an entity name for the browser in client-side gauge mode (see `entity_records`), or None if
+# the entity does not exist. Every municipality at once is not available: the browser fetches one municipality at a time
+def get_gauge_rows(value):
+    with pin_dataset(dataset) as current:
+        if value not in current['search_index']['positions']:
+            return None
+        return pd.DataFrame(entity_records(value))
+
+# Gauge data of one municipality for `assets/gauges.js`: `<gauge_api_path>/<entity name>` (same caching, ETags & 404s as the ratio API)
+# NOTE: The version is the whole dataset's, since the peer rankings change whenever any municipality changes
+if clientside_gauges:
+    ratio_api.register_endpoints(app.server, lambda value: dataset['version'], get_gauge_rows, path=gauge_api_path, name='gauges', key='path')
+
+# This function returns the ratio inputs of an entity name as reported (see `scenario.apply_scenario`)
+def get_ratio_inputs(value):
+    data = get_dataset()
+    if fact_backend == 'sqlite':
+        return fact_db.entity_inputs(data['report_ids'][value], db_path, data['entity_versions'][value]).iloc[0]
+    return data['artifact']['ratio_inputs'].loc[get_entity_rows(value)['report_id'].iloc[0]]
+
+# This function returns the gauge plot patch & markdown text of a what-if scenario for a given entity name and ratio index, from the
+# recalculated value & variables of the ratio (see `update_scenario`). NaN values are passed as None, so they match in the cache key.
+# Results are kept in an LRU cache keyed by (entity name, ratio index, entity version, ratio values), like `get_gauge_patch`,
+# so moving a slider back & forth does not build the same figures again
+@lru_cache(maxsize=gauge_cache_size)
+def get_scenario_gauge_patch(value, ratio, version, ratio_value, var_1_value, var_2_value, unavailable_reason):
+    data = get_entity_rows(value).iloc[ratio].copy()
+    data['value'], data['var_1_value'], data['var_2_value'] = [math.nan if x is None else x for x in (ratio_value, var_1_value, var_2_value)]
+    data['unavailable_reason'] = unavailable_reason
+    return figure_patch(create_gauge(value, ratio, data), gauge_patch_paths), update_markdown(value, ratio, data)
+
+# Define the callback function to set the what-if sliders back to the reported value when another entity is selected
+# Only the sliders that were moved are reset, so selecting an entity without a scenario does not trigger `update_scenario` at all
+scenario_sliders = ['scenario-{}'.format(input_name) for input_name in scenario.SCENARIO_INPUTS]
+
+def reset_scenario(value, *percents):
+    if not any(percents):
+        raise PreventUpdate
+    return [0 if percent else dash.no_update for percent in percents]
+
+# Define the callback function to recalculate the gauges of a what-if scenario as the sliders move
+# Only the ratios that depend on the moved sliders' inputs are recalculated & sent (see `scenario.apply_scenario`), as patches of the gauge plots.
+# When every slider is back at the reported value, those gauges are sent as reported, from the gauge cache (see `get_gauge_patch`)
+# NOTE: The peer rankings & trend charts keep the reported values
+@metrics.timed('callback_seconds', {'callback': 'update_scenario'}, 'callback_failures_total')
+def update_scenario(*args):
+    percents, value = args[:-1], args[-1]
+    if value is None:
+        raise PreventUpdate
+    with pin_dataset(dataset):
+        version = get_entity_version(value)
+        changed = [prop_id.split('.')[0][len('scenario-'):] for prop_id in dash.ctx.triggered_prop_ids]
+        figures, texts = [dash.no_update] * gauge_count, [dash.no_update] * gauge_count
+
+        if not any(percents):
+            ratio_names = scenario.affected_ratios(changed)
+            for ratio, ratio_name in enumerate(get_entity_rows(value)['ratio'].iloc[:gauge_count]):
+                if ratio_name in ratio_names:
+                    figures[ratio], texts[ratio] = get_gauge_patch(value, ratio, version)[:2]
+            return figures + texts
+
+        inputs = get_ratio_inputs(value)
+        overrides = {input_name: inputs[input_name] * (1 + percent / 100) for input_name, percent in zip(scenario.SCENARIO_INPUTS, percents) if percent}
+        rows, ratio_names = scenario.apply_scenario(inputs, get_entity_rows(value), overrides, changed)
+        for ratio, ratio_name in enumerate(rows['ratio'].iloc[:gauge_count]):
+            if ratio_name in ratio_names:
+                data = rows.iloc[ratio]
+                key = [None if math.isnan(data[column]) else float(data[column]) for column in ['value', 'var_1_value', 'var_2_value']]
+                figures[ratio], texts[ratio] = get_scenario_gauge_patch(value, ratio, version, *key, data['unavailable_reason'])
+        return figures + texts
+
+if not clientside_gauges:
+    app.callback([Output(slider, 'value') for slider in scenario_sliders], [Input('report-dropdown', 'value')],
+                 [State(slider, 'value') for slider in scenario_sliders], prevent_initial_call=True)(reset_scenario)
+    app.callback([Output('gauge-plot{}'.format(i), 'figure', allow_duplicate=True) for i in range(1, gauge_count + 1)]
+                 + [Output('gauge-plot{}-text'.format(i), 'children', allow_duplicate=True) for i in range(1, gauge_count + 1)],
+                 [Input(slider, 'value') for slider in scenario_sliders], [State('report-dropdown', 'value')], prevent_initial_call=True)(update_scenario)
+
+# Number of comparison cards sent at a time, and height of the gauge plot of each card
+# The next cards are only rendered & sent when the `Show more` button scrolls into view (see `assets/compare.js`) or is clicked
+compare_page_size = 12
+compare_card_height = 280
+
+# This function returns the comparison cards for the selected entity names & ratio indexes, as (entity name, ratio index):
+# every entity for the first ratio, then every entity for the next ratio, and so on. Entity names no longer in the data are left out
+def compare_cards(entities, ratios):
+    positions = get_dataset()['search_index']['positions']
+    return [(value, ratio) for ratio in ratios for value in entities if value in positions]
+
+# This function creates a comparison card: the entity name & its gauge plot for a given ratio index (from the gauge cache, see `get_gauge`)
+def create_compare_card(value, ratio):
+    figure = get_gauge(value, ratio, get_entity_version(value))[0]
+    return html.Div([
+        html.H4(value, style={'textAlign': 'center', 'margin': '5px'}),
+        dcc.Graph(figure=figure, config={'displayModeBar': False}, style={'height': compare_card_height}),
+    ], style={'border': '3px solid black', 'padding': '10px', 'background-color': 'lavender'})
+
+# Define the callback function to fill the comparison grid, one page of cards at a time
+# A new selection replaces the grid with the first page; `Show more` appends the next page to the cards already in the browser (as a patch)
+@app.callback([Output('compare-grid', 'children'), Output('compare-loaded', 'data'), Output('compare-more', 'style'), Output('compare-status', 'children')],
+              [Input('compare-entities', 'value'), Input('compare-ratios', 'value'), Input('compare-more', 'n_clicks')],
+              [State('compare-loaded', 'data')])
+@metrics.timed('callback_seconds', {'callback': 'update_compare_grid'}, 'callback_failures_total')
+def update_compare_grid(entities, ratios, n_clicks, loaded):
+    with pin_dataset(dataset):
+        cards = compare_cards(entities or [], ratios or [])
+        if dash.ctx.triggered_id == 'compare-more':
+            start = loaded or 0
+            children = Patch()
+            children.extend([create_compare_card(value, ratio) for value, ratio in cards[start:start + compare_page_size]])
+        else:
+            start = 0
+            children = [create_compare_card(value, ratio) for value, ratio in cards[:compare_page_size]]
+        loaded = min(start + compare_page_size, len(cards))
+        more_style = {'display': 'none'} if loaded >= len(cards) else {'fontSize': 18, 'padding': '10px 30px'}
+        status = 'Showing {} of {} gauges'.format(loaded, len(cards)) if cards else ''
+        return children, loaded, more_style, status
+
+# Define the callback function to search the municipalities to compare as the user types (see `update_dropdown_options`)
+@app.callback(Output('compare-entities', 'options'), [Input('compare-entities', 'search_value')], [State('compare-entities', 'value')])
+@metrics.timed('callback_seconds', {'callback': 'update_compare_options'}, 'callback_failures_total')
+def update_compare_options(search_value, values):
+    if not search_value:
+        raise PreventUpdate
+    options = entity_options(entity_search.search_entities(dataset['search_index'], search_value), search_value)
+    # Keep the selected municipalities in the options, otherwise the dropdown would remove them
+    shown = {option['value'] for option in options}
+    for value in values or []:
+        if value not in shown:
+            options += entity_options(entity_search.lookup_entity(dataset['search_index'], value))
+    return options
+
+# Timings & counters of the startup stages, ratio functions & callbacks, for Prometheus to scrape (see `metrics.py`)
+metrics.register_endpoint(app.server, '/metrics')
+
+# Starts checking for new data in the background (see `reload_dataset`)
+# NOTE: Under gunicorn, the app is loaded before the workers are forked and each worker starts its own thread (see `gunicorn.conf.py`)
+if os.environ.get('RELOAD_AFTER_FORK') != '1':
+    start_reloader()
 
 # Run the dash app
 if __name__ == '__main__':
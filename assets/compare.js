@@ -0,0 +1,53 @@
+// Loads the next page of comparison cards when the `Show more` button scrolls into view (see `update_compare_grid` in `app.py`),
+// so cards are only rendered & sent by the server as the user scrolls through the comparison grid.
+// NOTE: The button is clicked once per page: it is clicked again only after the server has answered (the grid or the button changed),
+// whether with the next page or with the first page of a new selection
+
+// Distance (pixels) below the bottom of the window at which the next page starts loading
+var COMPARE_PRELOAD_MARGIN = 400;
+
+(function () {
+    var pending = false; // a page was requested and the server has not answered yet
+
+    // Clicks the button if it is shown & within COMPARE_PRELOAD_MARGIN of the window, and no page is pending
+    // NOTE: The position is measured here rather than taken from the IntersectionObserver, whose entries arrive a frame late
+    function loadMore() {
+        var button = document.getElementById('compare-more');
+        if (pending || !button || button.offsetParent === null) {
+            return; // waiting for the server, or hidden (every card is loaded, or no selection)
+        }
+        if (button.getBoundingClientRect().top < window.innerHeight + COMPARE_PRELOAD_MARGIN) {
+            pending = true;
+            button.click();
+        }
+    }
+
+    function watch(button, grid) {
+        // The button scrolled into (or near) view
+        new IntersectionObserver(function (entries) {
+            if (entries.some(function (entry) { return entry.isIntersecting; })) {
+                loadMore();
+            }
+        }, {rootMargin: '0px 0px ' + COMPARE_PRELOAD_MARGIN + 'px 0px'}).observe(button);
+
+        // The server answered: new cards were added, a new selection replaced them, or the button was shown or hidden.
+        // If the button is still in view (e.g. a short page), the next page is requested right away
+        var answered = new MutationObserver(function () {
+            pending = false;
+            loadMore();
+        });
+        answered.observe(grid, {childList: true});
+        answered.observe(button, {attributes: true, attributeFilter: ['style']});
+    }
+
+    // Dash renders the layout after the assets are loaded, so wait for the grid & button to appear
+    var rendered = new MutationObserver(function () {
+        var button = document.getElementById('compare-more');
+        var grid = document.getElementById('compare-grid');
+        if (button && grid) {
+            rendered.disconnect();
+            watch(button, grid);
+        }
+    });
+    rendered.observe(document.documentElement, {childList: true, subtree: true});
+})();
@@ -0,0 +1,184 @@
+// Client-side versions of `create_gauge`, `create_unavailable_gauge`, `update_markdown` and `create_trend` in `app.py`
+// Used when the dashboard runs in client-side gauge mode (CLIENTSIDE_GAUGES=1): the data of the selected municipality is fetched
+// from the gauge route (see `get_gauge_rows` in `app.py`) and the gauges are rendered in the browser.
+// NOTE: Keep in sync with `create_gauge`, `update_markdown` and `create_trend` in `app.py`
+
+// Rounds a number to `digits` decimal places (equivalent of Python's `round`)
+function roundTo(value, digits) {
+    var factor = Math.pow(10, digits);
+    return Math.round(value * factor) / factor;
+}
+
+// Formats a rounded number the way Python prints floats (ex: 9789704.0)
+function formatNumber(value) {
+    return Number.isInteger(value) ? value.toFixed(1) : String(value);
+}
+
+// Returns true if the ratio could not be calculated (NaN values arrive as null)
+function isUnavailable(data) {
+    return data.value === null || isNaN(data.value);
+}
+
+// Wraps text into lines of up to `width` characters (equivalent of Python's `textwrap.wrap`, for whole words)
+function wrapText(text, width) {
+    var lines = [];
+    String(text).split(/\s+/).forEach(function(word) {
+        if (lines.length && (lines[lines.length - 1] + ' ' + word).length <= width) {
+            lines[lines.length - 1] += ' ' + word;
+        } else {
+            lines.push(word);
+        }
+    });
+    return lines;
+}
+
+// Creates the gauge plot figure of a ratio that could not be calculated: the target ranges without a value, and the reason
+function createUnavailableGauge(data) {
+    return {
+        data: [{
+            type: 'indicator',
+            mode: 'gauge',
+            value: null,
+            domain: {x: [0, 1], y: [0, 1]},
+            title: {text: data.ratio, font: {size: 26, color: 'dimgray', family: 'Courier'}}, // graph title
+            gauge: {
+                axis: {range: [null, Math.max(data.green_end, data.yellow_end, data.red_end)], tickwidth: 1, tickcolor: 'black'}, // sets axis range
+                bgcolor: 'white',
+                borderwidth: 2,
+                bordercolor: 'gray',
+                steps: [
+                    {range: [data.red_start, data.red_end], color: 'mistyrose'}, // red range
+                    {range: [data.green_start, data.green_end], color: 'honeydew'}, // green target range
+                    {range: [data.yellow_start, data.yellow_end], color: 'lightyellow'}] // yellow/orange range
+            }
+        }],
+        layout: {
+            paper_bgcolor: 'lavender', font: {color: 'dimgray', family: 'Courier New', size: 18}, // overall background color, font color + style
+            annotations: [{text: '<b>Unavailable</b><br>' + wrapText(data.unavailable_reason, 40).join('<br>'),
+                           x: 0.5, y: 0.1, xref: 'paper', yref: 'paper', showarrow: false, font: {size: 14, color: 'dimgray'}}]
+        }
+    };
+}
+
+// Creates the gauge plot figure for one row of the ratio table
+function createGauge(data) {
+    if (isUnavailable(data)) {
+        return createUnavailableGauge(data);
+    }
+    // Determines reference value to calculate `Distance to Target` metric
+    // Automates color change for `Distance to Target` metric, based on target ranges
+    var ratioValue = data.value;
+    var green1 = data.green_start;
+    var green2 = data.green_end;
+    var red1 = data.red_start;
+    var red2 = data.red_end;
+    var fontColor = 'black';
+    var distanceMetricColor;
+    var ref;
+    if (ratioValue <= green2 && ratioValue >= green1) { // green target range
+        distanceMetricColor = 'lavender'; // hides `Distance to Target` metric
+        fontColor = 'darkgreen'; // changes overall font color
+        ref = ratioValue;
+    } else {
+        distanceMetricColor = (ratioValue <= red2 && ratioValue >= red1) ? 'crimson' : 'darkorange'; // red range : yellow/orange range
+        ref = (Math.abs(ratioValue - green1) < Math.abs(ratioValue - green2)) ? green1 : green2;
+    }
+
+    return {
+        data: [{
+            type: 'indicator',
+            mode: 'gauge+number+delta',
+            value: roundTo(data.value, 3), // Ratio value
+            domain: {x: [0, 1], y: [0, 1]},
+            title: {text: data.ratio, font: {size: 26, color: fontColor, family: 'Courier'}}, // graph title
+            delta: {reference: ref, increasing: {color: distanceMetricColor}, decreasing: {color: distanceMetricColor}, font: {size: 30}, position: 'bottom'}, // `Distance to Target` metric
+            gauge: {
+                axis: {range: [null, Math.max(data.green_end, data.yellow_end, data.red_end)], tickwidth: 1, tickcolor: 'black'}, // sets axis range
+                bar: {color: 'black'},
+                bgcolor: 'white',
+                borderwidth: 2,
+                bordercolor: 'gray',
+                steps: [
+                    {range: [data.red_start, data.red_end], color: 'crimson'}, // red range
+                    {range: [data.green_start, data.green_end], color: 'mediumseagreen'}, // green target range
+                    {range: [data.yellow_start, data.yellow_end], color: 'gold'}], // yellow/orange range
+                threshold: {
+                    line: {color: 'black', width: 4},
+                    thickness: 0.75,
+                    value: data.value // tick marked on the gauge plot
+                }
+            }
+        }],
+        layout: {paper_bgcolor: 'lavender', font: {color: fontColor, family: 'Courier New', size: 18}} // overall background color, font color + style
+    };
+}
+
+// Creates the LaTeX formula for one row of the ratio table
+function updateMarkdown(data) {
+    if (isUnavailable(data)) { // the ratio could not be calculated, so only the formula is shown
+        return '$\\text{Formula} = \\frac{\\text{ ' + data.var_1_name + ' }}{\\text{ ' + data.var_2_name + ' }} = \\text{N/A}$';
+    }
+    return '$\\text{Formula} = \\frac{\\text{ ' + data.var_1_name + ' }}{\\text{ ' + data.var_2_name + ' }} = \\frac{\\text{ '
+        + formatNumber(roundTo(data.var_1_value, 2)) + ' }}{\\text{ ' + formatNumber(roundTo(data.var_2_value, 2)) + ' }}$';
+}
+
+// Creates the trend chart for one row of the ratio table (history of the ratio by fiscal year, green target range shaded)
+function createTrend(data) {
+    return {
+        data: [{
+            type: 'scatter', mode: 'lines+markers',
+            x: data.history.years, y: data.history.values,
+            line: {color: 'black', width: 2}, marker: {size: 8},
+            hovertemplate: '%{x}: %{y:.3f}<extra></extra>'
+        }],
+        layout: {
+            paper_bgcolor: 'lavender', plot_bgcolor: 'white', height: 220, margin: {l: 40, r: 20, t: 40, b: 30},
+            title: {text: 'Trend by Fiscal Year', font: {size: 16, family: 'Courier New'}},
+            xaxis: {tickmode: 'array', tickvals: data.history.years, tickformat: 'd'},
+            font: {family: 'Courier New', size: 12}, showlegend: false,
+            shapes: [{type: 'rect', xref: 'x domain', yref: 'y', x0: 0, x1: 1, y0: data.green_start, y1: data.green_end,
+                      fillcolor: 'mediumseagreen', opacity: 0.25, line: {width: 0}, layer: 'below'}] // green target range
+        }
+    };
+}
+
+// Returns the rows to render when a municipality's data could not be fetched: every gauge unavailable, with the reason
+function unavailableRows(targets, reason) {
+    return targets.map(function(target) {
+        return Object.assign({}, target, {value: null, unavailable_reason: reason, rank: 'Peer ranking unavailable',
+                                          history: {years: [], values: []}});
+    });
+}
+
+// Fetches the rows of a municipality from the gauge route (one row per gauge, in the order of the gauges)
+// The data version is part of the URL, so the browser's HTTP cache is reused until the data changes
+function fetchRows(value, config) {
+    return fetch(config.path + '/' + encodeURIComponent(value) + '?v=' + encodeURIComponent(config.version)).then(function(response) {
+        if (!response.ok) {
+            throw new Error(response.status === 404 ? 'No data for this municipality' : 'Data could not be loaded (' + response.status + ')');
+        }
+        return response.json();
+    }).then(function(payload) {
+        return payload.ratios;
+    });
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    gauges: {
+        // Returns every gauge plot, then every markdown text, then every peer ranking, then every trend chart, in the order of the callback outputs
+        // (the peer ranking text is rendered on the server, see `update_rank` in app.py)
+        // A gauge without data (the request failed, or a ratio is missing from the response) is rendered as unavailable
+        update_gauge_plots: function(value, config) {
+            if (!value) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            return fetchRows(value, config).catch(function(error) {
+                return unavailableRows(config.targets, error.message);
+            }).then(function(rows) {
+                var fallback = unavailableRows(config.targets, 'No data for this ratio');
+                rows = config.targets.map(function(target, i) { return (rows && rows[i]) || fallback[i]; });
+                return rows.map(createGauge).concat(rows.map(updateMarkdown), rows.map(function(data) { return data.rank; }), rows.map(createTrend));
+            });
+        }
+    }
+});
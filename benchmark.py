@@ -0,0 +1,243 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import xbrl_functions
+import peer_index
+import entity_search
+
+# Entity counts & fiscal-year depth benchmarked by default (`python benchmark.py`)
+ENTITY_COUNTS = [2, 100, 1000, 10000]
+YEARS = 2
+
+# Number of entities the dashboard callbacks are timed for (each callback is timed once per entity & ratio, with an empty cache)
+CALLBACK_SAMPLE = 20
+
+# The nine ratio functions that `app.py` used to call for each municipality, in the same order (that of `RATIO_TARGETS`), timed against the fact index
+RATIO_FUNCTIONS = [
+    xbrl_functions.get_short_run,
+    xbrl_functions.get_days_cash_on_hand,
+    xbrl_functions.get_liquidity,
+    xbrl_functions.get_gov_debt_coverage,
+    xbrl_functions.get_expenditure_per_capita,
+    xbrl_functions.get_net_asset_growth,
+    xbrl_functions.get_captial_asset_ga,
+    xbrl_functions.get_captial_asset_bta,
+    xbrl_functions.get_own_source_rev,
+]
+
+# Entity counts `xbrl_functions.PARALLEL_MIN_ENTITIES` is calibrated over (`python benchmark.py --calibrate`, see `calibrate_parallel`)
+CALIBRATION_COUNTS = [25, 50, 100, 200, 400, 800, 1600]
+
+# First report ID given to the synthetic municipalities (well above the IDs used by XBRL US today)
+SYNTHETIC_REPORT_ID = 9000000
+
+
+# Function to generate a synthetic fact table in the same format as `xbrl_data.csv`, for `entities` municipalities & `years` fiscal years each
+# Every municipality is a copy of one of the municipalities in `template` (Flint & Ogemaw in `xbrl_data.csv`), so the concepts,
+# statements & dimension members are the same as in real filings. Values are scaled by a random size per municipality and
+# varied by up to +/-10% per fact, so every municipality has different ratios.
+# Fiscal years are stacked newest first, like a report that restates prior years; a population is added for each
+# municipality to the population table (`xbrl_functions.POPULATIONS`)
+def generate_facts(template, entities, years=YEARS, seed=0):
+    rng = np.random.default_rng(seed)
+    template = xbrl_functions.ensure_dimension_columns(template)
+    templates = [rows for report_id, rows in template.groupby('report.id', sort=False)]
+
+    frames = []
+    populations = []
+    for i in range(entities):
+        rows = templates[i % len(templates)]
+        report_id = SYNTHETIC_REPORT_ID + i
+        kind = 'County of Synthetic {}' if 'county' in rows['report.entity-name'].iloc[0].lower() else 'City of Synthetic {}'
+        scale = rng.lognormal(0, 1)
+        populations.append({'report_id': report_id, 'fiscal_year': int(rows['period.fiscal-year'].max()),
+                            'population': int(xbrl_functions.LATEST_POPULATIONS.get(int(rows['report.id'].iloc[0]), 25000) * scale)})
+        for year in range(years):
+            frame = rows.copy()
+            frame['report.id'] = report_id
+            frame['report.entity-name'] = kind.format(i + 1)
+            frame['period.fiscal-year'] = frame['period.fiscal-year'] - year
+            frame['fact.value'] = frame['fact.value'] * scale * rng.uniform(0.9, 1.1, len(frame))
+            frames.append(frame)
+    xbrl_functions.set_populations(pd.concat([xbrl_functions.POPULATIONS, pd.DataFrame(populations, columns=['report_id', 'fiscal_year', 'population'])], ignore_index=True))
+    return pd.concat(frames, ignore_index=True)
+
+# Function to time a stage, returning (result, stage statistics)
+# Stage statistics keys & values are as follows:
+# `seconds`: Wall-clock time of the stage
+# `items`: Number of items processed (e.g. rows, entities or ratios, see `run`)
+# `items_per_second`: Throughput of the stage
+# `peak_memory_mb`: Peak memory allocated by Python during the stage (only if memory tracing is on, see `--no-memory`)
+# `frame_mb`: Size of the loaded DataFrame (loading stages only)
+def time_stage(function, items, *args):
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    stats = {'seconds': round(seconds, 6), 'items': items, 'items_per_second': round(items / seconds, 1) if seconds else None}
+    if tracemalloc.is_tracing():
+        stats['peak_memory_mb'] = round((tracemalloc.get_traced_memory()[1] - start_memory) / 2**20, 3)
+    return result, stats
+
+# Function to summarize a list of latencies (seconds) in milliseconds
+def latency_stats(latencies):
+    latencies = sorted(latencies)
+    return {'calls': len(latencies),
+            'mean_ms': round(1000 * statistics.mean(latencies), 3),
+            'p50_ms': round(1000 * latencies[len(latencies) // 2], 3),
+            'p95_ms': round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+            'max_ms': round(1000 * latencies[-1], 3)}
+
+# Function to call every ratio function for every municipality, returning the number of calls that failed (e.g. a fact was not reported)
+def run_ratio_functions(index):
+    errors = 0
+    for report_id in index['entities']:
+        for function in RATIO_FUNCTIONS:
+            try:
+                function(index, report_id)
+            except (KeyError, IndexError, ZeroDivisionError):
+                errors += 1
+    return errors
+
+# Function to benchmark every stage for one dataset size, in the current process
+# NOTE: `app.py` is imported from `workdir`, so this can only run once per process (see `main`, which runs each size in a new process)
+def run(template_path, entities, years, workdir, trace_memory=True):
+    if trace_memory:
+        tracemalloc.start()
+    template = pd.read_csv(template_path)
+    stages = {}
+
+    df, stages['generate'] = time_stage(generate_facts, entities, template, entities, years)
+    csv_path = os.path.join(workdir, 'xbrl_data.csv')
+    df.to_csv(csv_path, index=False)
+    rows = len(df)
+    del df
+
+    df, stages['read_csv'] = time_stage(pd.read_csv, rows, csv_path)
+    stages['read_csv']['frame_mb'] = round(df.memory_usage(deep=True).sum() / 2**20, 3)
+    del df
+    df, stages['load_fact_table'] = time_stage(xbrl_functions.load_fact_table, rows, csv_path)
+    stages['load_fact_table']['frame_mb'] = round(df.memory_usage(deep=True).sum() / 2**20, 3)
+    _, stages['process_dataframe'] = time_stage(xbrl_functions.process_dataframe, rows, df)
+    index, stages['build_fact_index'] = time_stage(xbrl_functions.build_fact_index, rows, df)
+    errors, stages['ratio_functions'] = time_stage(run_ratio_functions, entities * len(RATIO_FUNCTIONS), index)
+    stages['ratio_functions']['errors'] = errors
+    final_ratios, stages['compute_ratios'] = time_stage(xbrl_functions.compute_ratios, rows, df)
+    _, stages['compute_ratio_panel'] = time_stage(xbrl_functions.compute_ratio_panel, rows, df)
+    _, stages['build_peer_index'] = time_stage(peer_index.build_peer_index, len(final_ratios), final_ratios)
+    _, stages['build_search_index'] = time_stage(entity_search.build_search_index, entities, final_ratios)
+    del df, index
+
+    # Dashboard startup: `app.py` builds the ratio artifact from `xbrl_data.csv` on first import (cold), and loads it afterwards (warm)
+    os.chdir(workdir)
+    import ratio_store
+    _, stages['startup_cold'] = time_stage(ratio_store.load_artifact, entities)
+    _, stages['startup_warm'] = time_stage(ratio_store.load_artifact, entities)
+    app, stages['import_app'] = time_stage(__import__, entities, 'app')
+
+    # Dashboard callbacks, timed per call for a sample of municipalities
+    if trace_memory:
+        tracemalloc.stop() # tracing would inflate the latencies
+    callbacks = {'create_gauge': [], 'update_markdown': [], 'update_rank': [], 'create_trend': [], 'update_gauge_plots': []}
+    for entity_name in app.dataset['report_entity_names'][:CALLBACK_SAMPLE]:
+        for ratio in range(app.gauge_count):
+            for name in ['create_gauge', 'update_markdown', 'update_rank', 'create_trend']:
+                start = time.perf_counter()
+                getattr(app, name)(entity_name, ratio)
+                callbacks[name].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        app.update_gauge_plots(entity_name)
+        callbacks['update_gauge_plots'].append(time.perf_counter() - start)
+
+    return {'entities': entities, 'years': years, 'rows': rows, 'ratios': len(final_ratios),
+            'stages': stages, 'callbacks': {name: latency_stats(latencies) for name, latencies in callbacks.items()}}
+
+
+# Function to time `xbrl_functions.compute_ratio_tables` in one process & across `workers` processes (None: one per CPU core) for each
+# entity count, to choose `xbrl_functions.PARALLEL_MIN_ENTITIES`. Returns the timings and the `threshold`: the smallest count from which
+# the processes are faster at every larger count (None if they are never faster, e.g. on a single core)
+def calibrate_parallel(template, counts=CALIBRATION_COUNTS, years=YEARS, workers=None):
+    workers = workers or os.cpu_count() or 1
+    threshold = xbrl_functions.PARALLEL_MIN_ENTITIES
+    xbrl_functions.PARALLEL_MIN_ENTITIES = 0 # split the work across processes at every count
+    timings = []
+    try:
+        for entities in counts:
+            df = generate_facts(template, entities, years)
+            _, single = time_stage(xbrl_functions.compute_ratio_tables, entities, df, 1)
+            _, parallel = time_stage(xbrl_functions.compute_ratio_tables, entities, df, workers)
+            timings.append({'entities': entities, 'single_seconds': single['seconds'], 'parallel_seconds': parallel['seconds']})
+    finally:
+        xbrl_functions.PARALLEL_MIN_ENTITIES = threshold
+    slower = [timing['entities'] for timing in timings if timing['parallel_seconds'] >= timing['single_seconds']]
+    faster = [entities for entities in counts if not slower or entities > max(slower)]
+    return {'workers': workers, 'cpus': os.cpu_count(), 'timings': timings, 'threshold': faster[0] if faster else None}
+
+
+# Command line: `python benchmark.py [--entities 2 100 1000 10000] [--years 2] [--output benchmark_results.json]`
+# `python benchmark.py --calibrate [--workers N]` times the ratio calculation in one process & across processes instead (see `calibrate_parallel`)
+# Each dataset size runs in a new Python process, so imports, caches & peak memory do not carry over between sizes
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the dashboard pipeline on synthetic XBRL data.')
+    parser.add_argument('--entities', nargs='+', type=int, default=ENTITY_COUNTS, help='numbers of municipalities to generate')
+    parser.add_argument('--years', type=int, default=YEARS, help='fiscal years per municipality')
+    parser.add_argument('--template', default='xbrl_data.csv', help='CSV file the synthetic municipalities are copied from')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file to write the results to (use "" to skip)')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace memory (tracing slows down every stage)')
+    parser.add_argument('--calibrate', action='store_true', help='calibrate xbrl_functions.PARALLEL_MIN_ENTITIES instead of benchmarking the pipeline')
+    parser.add_argument('--workers', type=int, help='worker processes to calibrate with (default: one per CPU)')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS) # internal: benchmark one size in this process
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    template_path = os.path.abspath(args.template)
+
+    if args.calibrate:
+        result = calibrate_parallel(pd.read_csv(template_path), years=args.years, workers=args.workers)
+        for timing in result['timings']:
+            print('{:>6} entities: {:.3f}s in one process, {:.3f}s in {} processes'.format(
+                timing['entities'], timing['single_seconds'], timing['parallel_seconds'], result['workers']), file=sys.stderr)
+        print(json.dumps(result, indent=2))
+        return
+
+    if args.run is not None:
+        result = run(template_path, args.run, args.years, args.workdir, not args.no_memory)
+        print(json.dumps(result))
+        return
+
+    results = {'generated_at': datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'pandas': pd.__version__, 'platform': platform.platform(),
+               'memory_traced': not args.no_memory, 'runs': []}
+    for entities in args.entities:
+        with tempfile.TemporaryDirectory() as workdir:
+            command = [sys.executable, os.path.abspath(__file__), '--run', str(entities), '--years', str(args.years),
+                       '--template', template_path, '--workdir', workdir] + (['--no-memory'] if args.no_memory else [])
+            # No background reload thread in the run (see `app.reload_dataset`): a reload mid-run would recalculate every ratio and
+            # read `population.csv` over the synthetic populations (see `generate_facts`)
+            env = dict(os.environ, RELOAD_INTERVAL='0')
+            output = subprocess.run(command, check=True, capture_output=True, text=True, env=env).stdout
+        run_result = json.loads(output.strip().splitlines()[-1])
+        results['runs'].append(run_result)
+        print('{:>6} entities, {:>8} rows: {}'.format(entities, run_result['rows'],
+              ', '.join('{} {:.3f}s'.format(name, stage['seconds']) for name, stage in run_result['stages'].items())), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
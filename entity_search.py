@@ -0,0 +1,85 @@
+from bisect import bisect_left
+import difflib
+import re
+
+# Maximum number of matches returned to the dropdown
+SEARCH_LIMIT = 10
+
+# Minimum similarity (0 to 1) of a misspelled word to a word of an entity name, for fuzzy matches
+FUZZY_CUTOFF = 0.75
+
+
+# Function to split an entity name (or a search query) into lowercase words, ignoring punctuation
+def tokenize(text):
+    return re.findall(r'[a-z0-9]+', str(text).lower())
+
+# Function to build the search index over entity names & report IDs from the `final_ratios` DataFrame
+# Index keys & values are as follows:
+# `entities`: List of (entity name, report ID), in the order they appear in `final_ratios`
+# `positions`: Entity name -> position in `entities`
+# `names`: Sorted list of (lowercase entity name, entity position), for prefix matches on the whole name
+# `words`: Sorted list of (word, entity position) for every word of every entity name, for prefix matches on any word
+# `report_ids`: Sorted list of (report ID as text, entity position), for prefix matches on the report ID
+# `vocabulary`: Sorted list of the distinct words, for fuzzy matches
+def build_search_index(final_ratios):
+    entities = list(final_ratios[['report_entity_name', 'report_id']].drop_duplicates('report_entity_name').itertuples(index=False, name=None))
+    names, words, report_ids = [], [], []
+    for position, (entity_name, report_id) in enumerate(entities):
+        names.append((' '.join(tokenize(entity_name)), position))
+        words.extend((word, position) for word in set(tokenize(entity_name)))
+        report_ids.append((str(report_id), position))
+    return {'entities': [(entity_name, int(report_id)) for entity_name, report_id in entities],
+            'positions': {entity_name: position for position, (entity_name, report_id) in enumerate(entities)},
+            'names': sorted(names),
+            'words': sorted(words),
+            'report_ids': sorted(report_ids),
+            'vocabulary': sorted({word for word, position in words})}
+
+# Function to return the positions of every entry of a sorted (key, position) list whose key starts with `prefix`
+def _prefix_matches(entries, prefix):
+    matches = set()
+    start = bisect_left(entries, (prefix,))
+    for key, position in entries[start:]:
+        if not key.startswith(prefix):
+            break
+        matches.add(position)
+    return matches
+
+# Function to search the entities by name or report ID, returning up to `limit` (entity name, report ID) tuples, best matches first
+# Matches are ranked as follows (ties keep the order of `final_ratios`):
+# 1. The whole name starts with the query
+# 2. Every word of the query is the start of a word of the name (e.g. `ogem cou` matches `County of Ogemaw`)
+# 3. The report ID starts with the query
+# 4. Every word of the query is the start of, or close to (misspelled), a word of the name
+# NOTE: An empty query returns the first `limit` entities
+def search_entities(index, query, limit=SEARCH_LIMIT):
+    query_words = tokenize(query)
+    if not query_words:
+        return index['entities'][:limit]
+
+    ranked = []
+    seen = set()
+    def add(positions):
+        for position in sorted(positions - seen):
+            ranked.append(position)
+            seen.add(position)
+
+    add(_prefix_matches(index['names'], ' '.join(query_words)))
+    word_matches = [_prefix_matches(index['words'], word) for word in query_words]
+    add(set.intersection(*word_matches))
+    if len(query_words) == 1 and query_words[0].isdigit():
+        add(_prefix_matches(index['report_ids'], query_words[0]))
+
+    # Fuzzy matches are only needed when the exact matches do not fill the list
+    if len(ranked) < limit:
+        for word, matches in zip(query_words, word_matches):
+            for close_word in difflib.get_close_matches(word, index['vocabulary'], n=5, cutoff=FUZZY_CUTOFF):
+                matches |= _prefix_matches(index['words'], close_word)
+        add(set.intersection(*word_matches))
+
+    return [index['entities'][position] for position in ranked[:limit]]
+
+# Function to look up a single entity by its exact name, returning [(entity name, report ID)] (or [] if the name is not in the index)
+def lookup_entity(index, entity_name):
+    position = index['positions'].get(entity_name)
+    return [] if position is None else [index['entities'][position]]
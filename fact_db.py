@@ -0,0 +1,264 @@
+import os
+import pickle
+import shutil
+import sqlite3
+import sys
+import threading
+from contextlib import closing
+from functools import lru_cache
+import pandas as pd
+import xbrl_functions
+import peer_index
+import ratio_store
+import metrics
+
+# Default location of the fact database (NOTE: the source data is still `xbrl_data.csv`, see `ratio_store.CSV_PATH`)
+DB_PATH = 'xbrl_facts.db'
+
+# Number of CSV rows written to the database at a time, and number of municipalities whose ratios are calculated at a time
+# while building the peer index, so building the database never holds the whole dataset in memory
+CHUNK_ROWS = 100000
+PEER_BATCH = 500
+
+# Maximum number of municipalities whose ratios are kept in memory (least recently used are evicted first)
+ENTITY_CACHE_SIZE = 256
+
+# Columns of the `facts` table & the `xbrl_data.csv` column each is loaded from
+# Member columns (`member1`, `member2`, ...) keep their names and are added as the data needs them
+FACT_COLUMNS = {
+    'report_id': 'report.id',
+    'fiscal_year': 'period.fiscal-year',
+    'dimensions_count': 'dimensions.count',
+    'concept': 'cube.primary-local-name',
+    'value': 'fact.value',
+}
+
+# One connection per thread (NOTE: sqlite3 connections cannot be shared between threads)
+_local = threading.local()
+
+
+# Function to build the fact database from the source data (NOTE: run at deploy time, like `ratio_store.build_artifact`)
+# The database has the following tables:
+# `facts`: One row per fact, in the order of the source data, indexed on (report ID, concept, member1, fiscal year)
+# `entities`: Report ID -> name of the municipality, its position in the source data, its latest fiscal year & the hash of its facts
+# (see `ratio_store.fact_hashes`)
+# `metadata`: `source_hash` (see `ratio_store.source_hash`), `artifact_version` (see `ratio_store.ARTIFACT_VERSION`)
+# & `peer_index` (pickled, see `peer_index.build_peer_index`)
+def build_database(csv_path=ratio_store.CSV_PATH, db_path=DB_PATH):
+    tmp_path = '{}.{}.tmp'.format(db_path, os.getpid()) # one temporary file per process, so processes building at the same time never share one
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute('CREATE TABLE facts (row_id INTEGER PRIMARY KEY, report_id INTEGER NOT NULL, fiscal_year INTEGER, dimensions_count INTEGER, concept TEXT NOT NULL, value REAL)')
+    conn.execute('CREATE TABLE entities (report_id INTEGER PRIMARY KEY, entity_name TEXT NOT NULL, position INTEGER NOT NULL, fiscal_year INTEGER, fact_hash TEXT NOT NULL)')
+    conn.execute('CREATE TABLE metadata (key TEXT PRIMARY KEY, value BLOB)')
+
+    # Facts, one chunk at a time
+    members = []
+    reports = _scan_source(csv_path, lambda chunk: _insert_facts(conn, chunk, members))
+    _write_entities(conn, reports)
+    conn.execute('CREATE INDEX facts_lookup ON facts (report_id, concept, {}fiscal_year)'.format('member1, ' if members else ''))
+    conn.commit()
+
+    # Peer index, from the latest report of each municipality
+    peers = peer_index.build_peer_index(pd.DataFrame(columns=xbrl_functions.RATIO_COLUMNS))
+    _add_to_peer_index(conn, peers, list(_list_entities(conn)['report_id']))
+    _write_metadata(conn, csv_path, peers)
+    conn.close()
+    os.replace(tmp_path, db_path)
+
+# Function to update the fact database after the source data has changed, rewriting only the facts & peer index entries of the
+# municipalities whose facts changed (see `ratio_store.fact_hashes`), like `ratio_store.refresh_artifact` does for the artifact
+# The update is made on a copy of the database that then replaces it, so readers keep the old data until they reopen it (see `connect`)
+def update_database(csv_path=ratio_store.CSV_PATH, db_path=DB_PATH):
+    tmp_path = '{}.{}.tmp'.format(db_path, os.getpid())
+    shutil.copyfile(db_path, tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    old_hashes = dict(conn.execute('SELECT report_id, fact_hash FROM entities'))
+    old_latest = _latest_report_ids(conn)
+    members = [row[1] for row in conn.execute('PRAGMA table_info(facts)') if row[1].startswith('member')]
+
+    # Find the reports whose facts changed (a first pass over the source data, writing nothing)
+    reports = _scan_source(csv_path, lambda chunk: None)
+    changed = [report_id for report_id, report in reports.items() if old_hashes.get(report_id) != report[3]]
+    stale = set(changed) | (set(old_hashes) - set(reports)) # changed & removed reports
+    metrics.inc('reload_changed_entities_total', amount=len(stale))
+
+    # Replace the facts of the changed & removed reports (each report's facts stay in the order of the source data)
+    conn.executemany('DELETE FROM facts WHERE report_id = ?', [(report_id,) for report_id in stale])
+    had_members = bool(members)
+    for chunk in xbrl_functions.load_fact_table(csv_path, chunksize=CHUNK_ROWS):
+        _insert_facts(conn, chunk[chunk['report.id'].isin(changed)], members)
+    if members and not had_members: # the lookup index includes `member1` once the data has dimensions (see `build_database`)
+        conn.execute('DROP INDEX facts_lookup')
+        conn.execute('CREATE INDEX facts_lookup ON facts (report_id, concept, member1, fiscal_year)')
+    conn.execute('DELETE FROM entities')
+    _write_entities(conn, reports)
+    conn.commit()
+
+    # Replace the peer index entries of the municipalities whose latest report changed, was superseded or was removed
+    new_latest = _latest_report_ids(conn)
+    peers = pickle.loads(conn.execute("SELECT value FROM metadata WHERE key = 'peer_index'").fetchone()[0])
+    for entity_name, report_id in old_latest.items():
+        if new_latest.get(entity_name) != report_id or report_id in stale:
+            for ratio_name in xbrl_functions.RATIO_TARGETS:
+                peer_index.remove_from_peer_index(peers, entity_name, ratio_name)
+    _add_to_peer_index(conn, peers, [report_id for entity_name, report_id in new_latest.items()
+                                     if old_latest.get(entity_name) != report_id or report_id in stale])
+    _write_metadata(conn, csv_path, peers)
+    conn.close()
+    os.replace(tmp_path, db_path)
+
+# Function to read the source data one chunk at a time (see `xbrl_functions.load_fact_table`), calling `on_chunk(chunk)` for each chunk
+# Returns a dictionary of report ID -> (entity name, position in the source data, latest fiscal year, hash of its facts), in the order of the source data
+def _scan_source(csv_path, on_chunk):
+    entities = {}
+    fiscal_years = {}
+    digests = {}
+    for chunk in xbrl_functions.load_fact_table(csv_path, chunksize=CHUNK_ROWS):
+        on_chunk(chunk)
+        for report_id, entity_name in chunk[['report.id', 'report.entity-name']].drop_duplicates('report.id').itertuples(index=False, name=None):
+            entities.setdefault(int(report_id), (entity_name, len(entities)))
+        for report_id, fiscal_year in chunk.groupby('report.id', sort=False)['period.fiscal-year'].max().dropna().items():
+            fiscal_years[int(report_id)] = max(fiscal_years.get(int(report_id), int(fiscal_year)), int(fiscal_year))
+        ratio_store.update_fact_hashes(digests, chunk)
+    hashes = ratio_store.finish_fact_hashes(digests)
+    return {report_id: (entity_name, position, fiscal_years.get(report_id), hashes[report_id]) for report_id, (entity_name, position) in entities.items()}
+
+# Function to write a chunk of the source data to the `facts` table, adding the member columns it needs (`members` is updated in place)
+def _insert_facts(conn, chunk, members):
+    for member in xbrl_functions.member_columns(chunk):
+        if member not in members:
+            conn.execute('ALTER TABLE facts ADD COLUMN {} TEXT'.format(member))
+            members.append(member)
+    rows = chunk.reindex(columns=list(FACT_COLUMNS.values()) + members).astype(object)
+    rows = rows.where(rows.notna(), None)
+    conn.executemany('INSERT INTO facts ({}) VALUES ({})'.format(', '.join(list(FACT_COLUMNS) + members), ', '.join('?' * rows.shape[1])),
+                     rows.itertuples(index=False, name=None))
+
+# Function to write the `entities` table from the reports found by `_scan_source`
+def _write_entities(conn, reports):
+    conn.executemany('INSERT INTO entities VALUES (?, ?, ?, ?, ?)', [(report_id,) + report for report_id, report in reports.items()])
+
+# Function to add the ratios of some reports to the peer index (in place), a batch of municipalities at a time (see `peer_index.update_peer_index`)
+def _add_to_peer_index(conn, peers, report_ids):
+    for start in range(0, len(report_ids), PEER_BATCH):
+        peer_index.update_peer_index(peers, xbrl_functions.compute_ratios(_read_facts(conn, report_ids[start:start + PEER_BATCH])))
+
+# Function to write the `metadata` table for the current source data, and commit
+def _write_metadata(conn, csv_path, peers):
+    conn.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)', [('source_hash', ratio_store.source_hash(csv_path)),
+                                                                        ('artifact_version', ratio_store.ARTIFACT_VERSION),
+                                                                        ('peer_index', pickle.dumps(peers, protocol=pickle.HIGHEST_PROTOCOL))])
+    conn.commit()
+
+# Function to open the fact database, updating it only if the source data has changed
+# Only the municipalities whose facts changed are rewritten (see `update_database`); the database is built from scratch if it does not
+# exist yet or was built by another version of the ratio calculations
+# Returns the database's metadata (`source_hash` & `peer_index`, see `build_database`)
+def load_database(csv_path=ratio_store.CSV_PATH, db_path=DB_PATH):
+    with metrics.timer('startup_stage_seconds', {'stage': 'source_hash'}):
+        current_hash = ratio_store.source_hash(csv_path)
+    if read_metadata(db_path, 'source_hash') != current_hash:
+        with ratio_store.build_lock(db_path): # processes loading at the same time wait for the first one to build (see `ratio_store.build_lock`)
+            if read_metadata(db_path, 'source_hash') != current_hash:
+                if read_metadata(db_path, 'artifact_version') == ratio_store.ARTIFACT_VERSION:
+                    with metrics.timer('startup_stage_seconds', {'stage': 'update_database'}):
+                        update_database(csv_path, db_path)
+                else:
+                    with metrics.timer('startup_stage_seconds', {'stage': 'build_database'}):
+                        build_database(csv_path, db_path)
+    return {'source_hash': current_hash, 'peer_index': pickle.loads(read_metadata(db_path, 'peer_index'))}
+
+# Function to return this thread's connection to the fact database (opened read-only)
+# The connection is opened again when the database file has been replaced (see `build_database`), so a rebuilt database is picked up
+# without restarting the server
+def connect(db_path=DB_PATH):
+    connections = _local.__dict__.setdefault('connections', {})
+    inode = os.stat(db_path).st_ino
+    if db_path not in connections or connections[db_path][0] != inode:
+        if db_path in connections:
+            connections[db_path][1].close()
+        connections[db_path] = (inode, sqlite3.connect('file:{}?mode=ro'.format(os.path.abspath(db_path)), uri=True))
+    return connections[db_path][1]
+
+# Function to forget the connections & per-municipality results of the parent process, in a process forked after they were made
+# (e.g. a gunicorn worker, see `gunicorn.conf.py`). sqlite3 connections must not be used across a fork, so each worker opens its own
+def reset_after_fork():
+    global _local
+    _local = threading.local()
+    entity_ratios.cache_clear()
+    entity_inputs.cache_clear()
+
+# Function to read one value from the `metadata` table (returns None if the database does not exist or is incomplete)
+def read_metadata(db_path, key):
+    if not os.path.exists(db_path):
+        return None
+    try:
+        with closing(sqlite3.connect('file:{}?mode=ro'.format(os.path.abspath(db_path)), uri=True)) as conn:
+            row = conn.execute('SELECT value FROM metadata WHERE key = ?', (key,)).fetchone()
+    except sqlite3.DatabaseError:
+        return None
+    return row[0] if row else None
+
+# Function to list every municipality as a DataFrame with `report_id` & `report_entity_name` columns, in the order of the source data
+# A municipality that filed several reports is listed once, with its latest report (see `xbrl_functions.latest_report_ids`)
+def list_entities(db_path=DB_PATH):
+    return _list_entities(connect(db_path))
+
+# Function to list every municipality from an open connection to the fact database (see `list_entities`)
+def _list_entities(conn):
+    return _read_entities(conn)[['report_id', 'report_entity_name']].reset_index(drop=True)
+
+# Function to read the `entities` rows of the latest report of every municipality, in the order of the source data
+def _read_entities(conn):
+    entities = pd.read_sql_query('SELECT report_id, entity_name AS report_entity_name, fiscal_year, fact_hash FROM entities ORDER BY position', conn)
+    return entities[entities['report_id'].isin(xbrl_functions.latest_report_ids(entities))]
+
+# Function to map every municipality to its latest report ID, from an open connection to the fact database
+def _latest_report_ids(conn):
+    entities = _read_entities(conn)
+    return dict(zip(entities['report_entity_name'], entities['report_id']))
+
+# Function to return the version of every municipality's data: entity name -> hash of the facts of its latest report (see `ratio_store.fact_hashes`)
+# Part of the cache keys in `app.py` (like `ratio_store.entity_versions`), so the cached results of unchanged municipalities stay valid after an update
+def entity_versions(db_path=DB_PATH):
+    entities = _read_entities(connect(db_path))
+    return dict(zip(entities['report_entity_name'], entities['fact_hash']))
+
+# Function to read the facts of some municipalities in the format of `xbrl_functions.load_fact_table`, in the order of the source data
+def _read_facts(conn, report_ids):
+    members = [row[1] for row in conn.execute('PRAGMA table_info(facts)') if row[1].startswith('member')]
+    query = 'SELECT {}, entity_name, {} FROM facts JOIN entities USING (report_id) WHERE report_id IN ({}) ORDER BY row_id'.format(
+        ', '.join('facts.' + column for column in FACT_COLUMNS), ', '.join(['facts.' + member for member in members] or ['NULL AS member1']),
+        ', '.join('?' * len(report_ids)))
+    df = pd.read_sql_query(query, conn, params=[int(report_id) for report_id in report_ids])
+    return df.rename(columns=dict(FACT_COLUMNS, entity_name='report.entity-name'))
+
+# Function to read the facts of one municipality (see `_read_facts`)
+def load_entity_facts(report_id, db_path=DB_PATH):
+    return _read_facts(connect(db_path), [report_id])
+
+# Function to calculate the ratios of one municipality on demand, from its facts only
+# Returns (`final_ratios` rows of the municipality, ratio panel of the municipality) (see `xbrl_functions.compute_ratios` & `compute_ratio_panel`)
+# Results are kept in an LRU cache keyed by (report ID, database path, version of its facts (see `entity_versions`)), so only recently viewed
+# municipalities stay in memory, and the results of municipalities whose facts did not change stay valid after an update
+@lru_cache(maxsize=ENTITY_CACHE_SIZE)
+def entity_ratios(report_id, db_path=DB_PATH, version=None):
+    with metrics.timer('entity_load_seconds'):
+        facts = load_entity_facts(report_id, db_path)
+        return xbrl_functions.compute_ratios(facts), xbrl_functions.compute_ratio_panel(facts)
+
+# Function to pivot the ratio inputs of one municipality on demand (see `xbrl_functions.pivot_ratio_inputs`), for what-if scenarios
+# Results are kept in an LRU cache keyed by (report ID, database path, version of its facts), like `entity_ratios`
+@lru_cache(maxsize=ENTITY_CACHE_SIZE)
+def entity_inputs(report_id, db_path=DB_PATH, version=None):
+    return xbrl_functions.pivot_ratio_inputs(xbrl_functions.build_fact_table(load_entity_facts(report_id, db_path)))
+
+
+# Build step: `python fact_db.py [CSV_PATH] [DB_PATH]`
+if __name__ == '__main__':
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else ratio_store.CSV_PATH
+    db_path = sys.argv[2] if len(sys.argv) > 2 else DB_PATH
+    build_database(csv_path, db_path)
+    print('Wrote {} municipalities to {}'.format(len(list_entities(db_path)), db_path))
@@ -0,0 +1,49 @@
+import gc
+import os
+import shutil
+import tempfile
+
+# Gunicorn settings for the dashboard (`gunicorn -c gunicorn.conf.py app:server`, see `Procfile`)
+#
+# The app is imported once in the master process, so the data (ratio tables, peer index, search index, see `app.load_dataset`)
+# is loaded & the ratios are calculated once, before the workers are forked. Workers share the master's memory pages
+# (copy-on-write), so adding workers costs almost no extra memory or startup time.
+# NOTE: A worker only gets its own copy of the data after it reloads new data (see `app.reload_dataset`). When the source data
+# changes, the first worker to notice rebuilds the artifact (or fact database) and the others load it (see `ratio_store.build_lock`)
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', '8080'))
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+preload_app = True
+
+# Tells `app.py` that the workers start the background reload thread after the fork (see `post_fork`);
+# a thread started in the master process would not be copied to the workers
+os.environ['RELOAD_AFTER_FORK'] = '1'
+
+# Every process writes its metrics to this directory, so the metrics route shows the sum of every worker (see `metrics.METRICS_DIR`)
+# NOTE: One directory per server run (named after the master process), removed when the server stops (see `on_exit`)
+_metrics_dir = os.path.join(tempfile.gettempdir(), 'xbrl-metrics-{}'.format(os.getpid()))
+os.environ.setdefault('METRICS_DIR', _metrics_dir)
+
+
+# Function to move everything loaded so far out of the garbage collector's view, before the workers are forked
+# Otherwise every garbage collection in a worker would write to the shared objects' headers, copying their memory pages
+def when_ready(server):
+    gc.freeze()
+
+# Function to set up each worker: drop the SQLite connections opened by the master (they must not be used across a fork,
+# see `fact_db.reset_after_fork`), then start the worker's background reload thread
+def post_fork(server, worker):
+    import app
+    import fact_db
+    fact_db.reset_after_fork()
+    app.start_reloader()
+
+# Function to forget the cache sizes & other collected samples of a worker that exited (its counters are kept, see `metrics.mark_process_dead`)
+def child_exit(server, worker):
+    import metrics
+    metrics.mark_process_dead(worker.pid)
+
+# Function to remove the metrics directory when the server stops (unless it was set with the environment variable METRICS_DIR)
+def on_exit(server):
+    if os.environ['METRICS_DIR'] == _metrics_dir:
+        shutil.rmtree(_metrics_dir, ignore_errors=True)
@@ -0,0 +1,228 @@
+import glob
+import os
+import pickle
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Help text of each metric, shown on the metrics route (metric name -> description)
+DESCRIPTIONS = {
+    'startup_stage_seconds': 'Time spent in each stage of loading the data & building the ratios',
+    'ratio_function_seconds': 'Latency of the ratio functions, per ratio',
+    'ratio_function_failures_total': 'Ratio function calls that raised an error, per ratio & error type',
+    'ratio_fallbacks_total': 'Ratios calculated with a default for an input that was not reported, per ratio & input',
+    'ratio_unavailable_total': 'Ratios that could not be calculated in the batch engine (value is NaN), per ratio & table',
+    'entity_load_seconds': 'Time to load one municipality from the fact database & calculate its ratios',
+    'entity_failures_total': 'Municipalities whose filing could not be processed (every ratio is unavailable), per error type',
+    'callback_seconds': 'Latency of the dashboard callbacks, per callback',
+    'callback_failures_total': 'Dashboard callbacks that raised an error, per callback & error type',
+    'gauge_cache_hits_total': 'Gauge plot requests served from the gauge cache',
+    'gauge_cache_misses_total': 'Gauge plot requests that had to be rendered',
+    'gauge_cache_size': 'Number of gauge plots in the gauge cache',
+    'entity_cache_hits_total': 'Municipality ratio requests served from the entity cache (SQLite backend)',
+    'entity_cache_misses_total': 'Municipality ratio requests that were calculated from the fact database (SQLite backend)',
+    'entity_cache_size': 'Number of municipalities in the entity cache (SQLite backend)',
+    'api_seconds': 'Latency of the ratio API routes, per route',
+    'api_failures_total': 'Ratio API requests that raised an error, per route & error type',
+    'api_not_modified_total': 'Ratio API requests answered with 304 Not Modified (the client already had the current version), per route',
+    'api_cache_hits_total': 'Ratio API responses served from the response cache',
+    'api_cache_misses_total': 'Ratio API responses that had to be serialized & compressed',
+    'api_cache_size': 'Number of responses in the ratio API response cache',
+    'data_reload_seconds': 'Time to reload the data after `xbrl_data.csv` changed, including recalculating the changed municipalities',
+    'data_reload_failures_total': 'Data reloads that raised an error (the previous data is kept), per error type',
+    'data_reloads_total': 'Data reloads that swapped in new data',
+    'reload_changed_entities_total': 'Municipalities recalculated by the data reloads (new, changed or removed)',
+}
+
+# Directory shared by the processes of a multi-process server (set the environment variable METRICS_DIR, see `gunicorn.conf.py`)
+# Each process writes its metrics to its own file in the directory, and the metrics route adds up the files of every process, so a
+# scrape sees every worker whichever worker serves it (like the multiprocess mode of `prometheus_client`). None: metrics are per process
+METRICS_DIR = os.environ.get('METRICS_DIR') or None
+
+# Seconds between writes of each process's metrics to its file in METRICS_DIR (the metrics route can lag behind by this much)
+FLUSH_INTERVAL = 1.0
+
+# Metric values, keyed by (metric name, labels) where labels is a sorted tuple of (label, value) pairs
+# `_counters`: key -> count
+# `_histograms`: key -> [count in each bucket (not cumulative, last one is +Inf), sum of the observations]
+_counters = {}
+_histograms = {}
+
+# Functions called when the metrics are rendered, each returning a list of (metric name, type, labels, value) for values
+# that are read from somewhere else (e.g. the hit count of an `lru_cache`)
+_collectors = []
+
+_lock = threading.Lock()
+
+# Process the metric values belong to, and whether it has started its flush thread (see `_check_process`)
+_pid = os.getpid()
+_flushing = False
+
+
+# Function to turn a labels dictionary into the hashable form used in the metric keys
+def _labels_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+# Function to start writing this process's metrics to METRICS_DIR (must be called with `_lock` held)
+# A process forked from another one (e.g. a gunicorn worker) starts from zero: the values it inherited are the parent's, and are
+# already counted in the parent's file
+def _check_process():
+    global _pid, _flushing
+    if METRICS_DIR is None or (_flushing and _pid == os.getpid()):
+        return
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _counters.clear()
+        _histograms.clear()
+    _flushing = True
+    threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+
+# Function to write this process's metrics to METRICS_DIR every FLUSH_INTERVAL seconds, in a background thread (see `_check_process`)
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
+
+# Function to add `amount` to a counter
+def inc(name, labels=None, amount=1):
+    key = (name, _labels_key(labels))
+    with _lock:
+        _check_process()
+        _counters[key] = _counters.get(key, 0) + amount
+
+# Function to record one observation (seconds) in a latency histogram
+def observe(name, seconds, labels=None):
+    key = (name, _labels_key(labels))
+    bucket = next((i for i, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))
+    with _lock:
+        _check_process()
+        histogram = _histograms.setdefault(key, [[0] * (len(BUCKETS) + 1), 0.0])
+        histogram[0][bucket] += 1
+        histogram[1] += seconds
+
+# Context manager to time a block of code into a latency histogram
+# Errors are counted in the `failures` counter (if given) with an additional `error` label, and raised again
+@contextmanager
+def timer(name, labels=None, failures=None):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as error:
+        if failures:
+            inc(failures, dict(labels or {}, error=type(error).__name__))
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, labels)
+
+# Decorator to time every call of a function into a latency histogram (see `timer`)
+def timed(name, labels=None, failures=None):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(name, labels, failures):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Function to register a collector (see `_collectors`)
+def register_collector(collector):
+    _collectors.append(collector)
+
+# Function to format a labels key in the Prometheus text format, e.g. {ratio="Days of Cash on Hand"}
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for label, value in labels) + '}'
+
+# Function to copy this process's metrics: (counters, histograms, collected samples) (see `_counters`, `_histograms` & `_collectors`)
+def _snapshot():
+    with _lock:
+        _check_process()
+        counters = dict(_counters)
+        histograms = {key: (list(buckets), total) for key, (buckets, total) in _histograms.items()}
+    collected = [(name, metric_type, _labels_key(labels), value) for collector in _collectors for name, metric_type, labels, value in collector()]
+    return counters, histograms, collected
+
+# Function to return the file of a process's metrics in METRICS_DIR
+def _process_path(pid):
+    return os.path.join(METRICS_DIR, 'metrics_{}.pkl'.format(pid))
+
+# Function to write this process's metrics to its file in METRICS_DIR (written to a temporary file first, so readers never see half a file)
+def flush():
+    if METRICS_DIR is None:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = _process_path(os.getpid())
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(_snapshot(), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+# Function to drop the collected samples (e.g. cache sizes) of a process that has exited, from its file in METRICS_DIR
+# Its counters & histograms are kept, so the totals of the metrics route never go down when a worker is replaced
+def mark_process_dead(pid):
+    if METRICS_DIR is None:
+        return
+    try:
+        with open(_process_path(pid), 'rb') as f:
+            counters, histograms, collected = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return
+    with open(_process_path(pid) + '.tmp', 'wb') as f:
+        pickle.dump((counters, histograms, []), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(_process_path(pid) + '.tmp', _process_path(pid))
+
+# Function to add up the metrics of every process in METRICS_DIR (see `flush`)
+# Counters & histograms are summed across processes; collected samples are per process, with a `pid` label
+def _read_processes():
+    flush() # this process's file is brought up to date first
+    counters, histograms, collected = {}, {}, []
+    for path in glob.glob(_process_path('*')):
+        try:
+            with open(path, 'rb') as f:
+                process_counters, process_histograms, process_collected = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            continue
+        pid = os.path.basename(path)[len('metrics_'):-len('.pkl')]
+        for key, value in process_counters.items():
+            counters[key] = counters.get(key, 0) + value
+        for key, (buckets, total) in process_histograms.items():
+            merged = histograms.setdefault(key, ([0] * (len(BUCKETS) + 1), 0.0))
+            histograms[key] = ([a + b for a, b in zip(merged[0], buckets)], merged[1] + total)
+        collected.extend((name, metric_type, labels + (('pid', pid),), value) for name, metric_type, labels, value in process_collected)
+    return counters, histograms, collected
+
+# Function to render every metric in the Prometheus text exposition format (of every process if METRICS_DIR is set)
+def render():
+    samples = {} # metric name -> (type, list of sample lines)
+    counters, histograms, collected = _read_processes() if METRICS_DIR is not None else _snapshot()
+
+    for (name, labels), value in counters.items():
+        samples.setdefault(name, ('counter', []))[1].append('{}{} {}'.format(name, _format_labels(labels), value))
+    for (name, labels), (buckets, total) in histograms.items():
+        lines = samples.setdefault(name, ('histogram', []))[1]
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ['+Inf'], buckets):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', bound),)), cumulative))
+        lines.append('{}_sum{} {}'.format(name, _format_labels(labels), total))
+        lines.append('{}_count{} {}'.format(name, _format_labels(labels), cumulative))
+    for name, metric_type, labels, value in collected:
+        samples.setdefault(name, (metric_type, []))[1].append('{}{} {}'.format(name, _format_labels(labels), value))
+
+    output = []
+    for name in sorted(samples):
+        metric_type, lines = samples[name]
+        output.append('# HELP {} {}'.format(name, DESCRIPTIONS.get(name, name)))
+        output.append('# TYPE {} {}'.format(name, metric_type))
+        output.extend(lines)
+    return '\n'.join(output) + '\n'
+
+# Function to add the metrics route to a Flask server (e.g. `app.server` of a Dash app)
+# NOTE: Without METRICS_DIR, metrics are kept per process -- with several gunicorn workers, each scrape would only see the worker that served it
+def register_endpoint(server, path='/metrics'):
+    from flask import Response
+    server.add_url_rule(path, 'metrics', lambda: Response(render(), mimetype='text/plain; version=0.0.4'))
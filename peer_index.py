@@ -0,0 +1,88 @@
+from bisect import bisect_left, bisect_right, insort
+import math
+import xbrl_functions
+
+# Peer group name used for the comparison against every filer
+ALL_FILERS = 'All Filers'
+
+# Function to assign an entity to a peer group by type of government, based on its name
+def entity_type(report_id, entity_name):
+    if 'county' in entity_name.lower():
+        return 'Counties'
+    return 'Cities & Other Municipalities'
+
+# Function to assign an entity to a peer group by population band, from its most recent population (see `xbrl_functions.LATEST_POPULATIONS`)
+def population_band(report_id, entity_name):
+    population = xbrl_functions.LATEST_POPULATIONS.get(int(report_id), 0)
+    if not population > 0:
+        return 'Population Unknown'
+    elif population < 25000:
+        return 'Population under 25,000'
+    elif population < 100000:
+        return 'Population 25,000 - 100,000'
+    return 'Population over 100,000'
+
+# Ways to split the filers into peer groups: grouping name -> function(report ID, entity name) returning the peer group
+PEER_GROUPINGS = {
+    'type': entity_type,
+    'population': population_band,
+}
+
+
+# Function to build the peer-group percentile index from the `final_ratios` DataFrame
+# Index keys & values are as follows:
+# `values`: (grouping, peer group, ratio) -> sorted list of the ratio values of every entity in the peer group
+# `members`: (entity name, ratio) -> (value, {grouping: peer group}) for every entity & ratio in the index
+# NOTE: Every entity is also part of the `ALL_FILERS` peer group (grouping None); missing (NaN) values are left out
+def build_peer_index(final_ratios):
+    index = {'values': {}, 'members': {}}
+    update_peer_index(index, final_ratios)
+    return index
+
+# Function to add or replace the rows of some entities in the peer-group percentile index (in place)
+# Only the peer groups of the given rows are touched, so refreshing a few entities does not rebuild the index
+def update_peer_index(index, final_ratios):
+    for report_id, entity_name, ratio_name, value in final_ratios[['report_id', 'report_entity_name', 'ratio', 'value']].itertuples(index=False, name=None):
+        remove_from_peer_index(index, entity_name, ratio_name)
+        if value is None or math.isnan(value):
+            continue
+        groups = {None: ALL_FILERS}
+        groups.update({grouping: assign(report_id, entity_name) for grouping, assign in PEER_GROUPINGS.items()})
+        for grouping, group in groups.items():
+            insort(index['values'].setdefault((grouping, group, ratio_name), []), value)
+        index['members'][(entity_name, ratio_name)] = (value, groups)
+    return index
+
+# Function to remove one entity's ratio from the peer-group percentile index (in place)
+# Peer groups left empty are removed too, so the index is the same as one built without the entity
+def remove_from_peer_index(index, entity_name, ratio_name):
+    member = index['members'].pop((entity_name, ratio_name), None)
+    if member is None:
+        return
+    value, groups = member
+    for grouping, group in groups.items():
+        values = index['values'][(grouping, group, ratio_name)]
+        del values[bisect_left(values, value)]
+        if not values:
+            del index['values'][(grouping, group, ratio_name)]
+
+# Function to look up an entity's peer group, percentile & the peer median for a ratio
+# The percentile is the share of peers with a lower value (ties count half), from 0 to 100; both lookups are O(log n)
+# Returns None if the entity has no value for the ratio
+# Return dictionary keys & values are as follows:
+# `group`: Name of the peer group
+# `count`: Number of entities in the peer group
+# `percentile`: Percentile of the entity within the peer group
+# `median`: Median value of the peer group
+def peer_rank(index, entity_name, ratio_name, grouping=None):
+    member = index['members'].get((entity_name, ratio_name))
+    if member is None:
+        return None
+    value, groups = member
+    values = index['values'][(grouping, groups[grouping], ratio_name)]
+    below = bisect_left(values, value)
+    ties = bisect_right(values, value) - below
+    count = len(values)
+    middle = count // 2
+    median = values[middle] if count % 2 else (values[middle - 1] + values[middle]) / 2
+    return {'group': groups[grouping], 'count': count, 'percentile': 100 * (below + ties / 2) / count, 'median': median}
@@ -0,0 +1,85 @@
+import gzip
+import hashlib
+import json
+from functools import lru_cache
+import metrics
+
+# Number of seconds downstream sites & proxies may reuse a response without checking the ETag again
+MAX_AGE = 300
+
+# Maximum number of serialized responses kept in memory (least recently used are evicted first)
+RESPONSE_CACHE_SIZE = 512
+
+# Level of the gzip compression (1 is fastest, 9 is smallest); responses are compressed once, then served from the cache
+GZIP_LEVEL = 6
+
+
+# Function to serialize `final_ratios` rows to a JSON payload, compressed with gzip
+# Payload keys & values are as follows:
+# `version`: Version of the data the rows come from (the ETag is derived from it, see `register_endpoints`)
+# `ratios`: List of `final_ratios` rows (see `xbrl_functions.RATIO_COLUMNS`), ratios that could not be calculated have a null `value`
+# Any other `fields` (e.g. `report_id`) are added to the payload as is
+def serialize(rows, version, **fields):
+    header = json.dumps(dict(version=version, **fields))
+    payload = header[:-1] + ', "ratios": ' + rows.to_json(orient='records', double_precision=15) + '}'
+    return gzip.compress(payload.encode('utf-8'), GZIP_LEVEL)
+
+# Function to add the ratio routes to a Flask server (e.g. `app.server` of a Dash app)
+# `get_version(report_id)`: Returns the version of a municipality's ratios, or of the whole dataset if `report_id` is None
+# `get_rows(report_id)`: Returns the `final_ratios` rows of a municipality, or of every municipality if `report_id` is None (None if not available)
+# `name`: Name of the routes (and `api` label of their metrics), so the routes can be added more than once under different paths
+# `key`: Flask converter of the municipality part of the URL: `int` for report IDs, `path` for entity names (which can contain slashes)
+# Routes (NOTE: the responses are cached per version, so each one is only serialized & compressed once):
+# `<path>/<report_id>`: Ratios of one municipality
+# `<path>`: Ratios of every municipality
+def register_endpoints(server, get_version, get_rows, path='/api/ratios', name='ratios', key='int'):
+    from flask import Response, request
+
+    # Serialized responses, keyed by (report ID, version) so a new version of the data is never served from an old entry
+    # NOTE: Unknown report IDs raise KeyError, which is not cached, so requests for random IDs never evict real responses
+    @lru_cache(maxsize=RESPONSE_CACHE_SIZE)
+    def cached_body(report_id, version):
+        rows = get_rows(report_id)
+        if rows is None:
+            raise KeyError(report_id)
+        if report_id is None:
+            return serialize(rows, version)
+        return serialize(rows, version, report_id=int(rows['report_id'].iloc[0]) if len(rows) else report_id,
+                         report_entity_name=rows['report_entity_name'].iloc[0] if len(rows) else None)
+
+    # Function to answer a request from the response cache, with a strong ETag tied to the data version & the encoding of the body
+    # (the gzip & uncompressed bodies are different bytes, so each gets its own ETag)
+    # Returns 404 if the report ID does not exist, 304 (no body) if the client already has this version, and the uncompressed JSON
+    # if the client does not accept gzip
+    def respond(report_id, route):
+        labels = {'api': name, 'route': route}
+        with metrics.timer('api_seconds', labels, 'api_failures_total'):
+            version = get_version(report_id)
+            try:
+                body = cached_body(report_id, version)
+            except KeyError:
+                return Response(json.dumps({'error': 'Not found'}), status=404, mimetype='application/json')
+            compressed = 'gzip' in request.accept_encodings
+            etag = hashlib.sha1('{}:{}'.format(report_id, version).encode('utf-8')).hexdigest() + ('-gz' if compressed else '')
+            headers = {'ETag': '"{}"'.format(etag), 'Cache-Control': 'public, max-age={}'.format(MAX_AGE), 'Vary': 'Accept-Encoding',
+                       'Access-Control-Allow-Origin': '*'}
+            if etag in request.if_none_match:
+                metrics.inc('api_not_modified_total', labels)
+                return Response(status=304, headers=headers)
+            if compressed:
+                headers['Content-Encoding'] = 'gzip'
+            else:
+                body = gzip.decompress(body)
+            return Response(body, mimetype='application/json', headers=headers)
+
+    server.add_url_rule(path, name, lambda: respond(None, 'all'))
+    server.add_url_rule(path + '/<{}:report_id>'.format(key), 'entity_' + name, lambda report_id: respond(report_id, 'entity'))
+
+    # Reports the hits & misses of the response cache on the metrics route
+    def response_cache_metrics():
+        info = cached_body.cache_info()
+        return [('api_cache_hits_total', 'counter', {'api': name}, info.hits),
+                ('api_cache_misses_total', 'counter', {'api': name}, info.misses),
+                ('api_cache_size', 'gauge', {'api': name}, info.currsize)]
+
+    metrics.register_collector(response_cache_metrics)
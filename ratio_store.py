@@ -0,0 +1,202 @@
+import copy
+import hashlib
+import os
+import pickle
+import sys
+from contextlib import contextmanager
+import pandas as pd
+import xbrl_functions
+import peer_index
+import entity_search
+import metrics
+
+try:
+    import fcntl
+except ImportError: # not available on Windows, where each process builds on its own (see `build_lock`)
+    fcntl = None
+
+# Default locations of the source data & the precomputed ratio artifact
+CSV_PATH = 'xbrl_data.csv'
+ARTIFACT_PATH = 'xbrl_ratios.pkl'
+
+# NOTE: Bump this whenever the ratio calculations in `xbrl_functions.py` change, so existing artifacts are rebuilt
+ARTIFACT_VERSION = 9
+
+
+# Function to hold an exclusive lock on `<path>.lock` while a file shared by several processes (e.g. gunicorn workers) is built
+# Only one process builds at a time: the others wait, then find the file already built for the current data and only load it
+@contextmanager
+def build_lock(path):
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# Function to hash the source data (NOTE: the artifact version is part of the hash, so code changes also invalidate the artifact)
+# The population table is part of the source data too (see `xbrl_functions.POPULATIONS`)
+def source_hash(csv_path=CSV_PATH):
+    digest = hashlib.sha256('ratio-artifact-v{}'.format(ARTIFACT_VERSION).encode())
+    digest.update(pd.util.hash_pandas_object(xbrl_functions.POPULATIONS, index=False).to_numpy().tobytes())
+    with open(csv_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Function to hash the facts of each municipality, to find the municipalities whose facts changed between two versions of the data
+# Returns a dictionary of report ID -> hash, in the order the report IDs appear in `df` (NOTE: the order of the facts is part of the hash)
+# A municipality's rows in the population table are part of its hash, so a new population also recalculates its ratios
+def fact_hashes(df):
+    return finish_fact_hashes(update_fact_hashes({}, df))
+
+# Function to add the facts of `df` (e.g. one chunk of the source data) to running hashes of each municipality (report ID -> `hashlib` object)
+# Hashing the source data one chunk at a time gives the same hashes as `fact_hashes` on the whole data (see `fact_db.build_database`)
+def update_fact_hashes(digests, df):
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    for report_id, positions in df.groupby('report.id', sort=False).indices.items():
+        digests.setdefault(int(report_id), hashlib.sha1()).update(row_hashes[positions].tobytes())
+    return digests
+
+# Function to add each municipality's rows of the population table to its running hash (see `update_fact_hashes`) and return report ID -> hash
+def finish_fact_hashes(digests):
+    populations = xbrl_functions.POPULATIONS
+    population_hashes = pd.util.hash_pandas_object(populations, index=False).to_numpy()
+    population_positions = populations.groupby('report_id').indices
+    for report_id, digest in digests.items():
+        digest.update(population_hashes[population_positions.get(report_id, [])].tobytes())
+    return {report_id: digest.hexdigest() for report_id, digest in digests.items()}
+
+# Function to hash the ratios & ratio history of each municipality, so cached gauge plots of unchanged municipalities stay valid after a reload
+# Returns a dictionary of entity name -> hash
+def entity_versions(final_ratios, ratio_panel):
+    hashes = pd.concat([pd.Series(pd.util.hash_pandas_object(final_ratios, index=False).to_numpy(), index=final_ratios['report_entity_name'].to_numpy()),
+                        pd.Series(pd.util.hash_pandas_object(ratio_panel, index=False).to_numpy(), index=ratio_panel['report_entity_name'].to_numpy())])
+    return {name: '{:016x}'.format(int(value)) for name, value in hashes.groupby(level=0, sort=False).sum().items()}
+
+# Function to calculate `final_ratios` from the source data and write it to the artifact
+# The artifact is a pickled dictionary with the following keys & values:
+# `source_hash`: Hash of the source data the ratios were calculated from
+# `final_ratios`: The `final_ratios` DataFrame
+# `report_entity_name`: List of municipality names, in the order they appear in `final_ratios`
+# `ratio_panel`: Every ratio for every fiscal year with data, indexed by (entity name, ratio, fiscal year) (see `xbrl_functions.compute_ratio_panel`)
+# `peer_index`: Sorted ratio values of every peer group, for percentile & peer median lookups (see `peer_index.build_peer_index`)
+# `search_index`: Prefix & fuzzy search index over entity names & report IDs, for the dropdown (see `entity_search.build_search_index`)
+# `fact_hashes`: Report ID -> hash of its facts (see `fact_hashes`), to find the municipalities that changed when the data is refreshed
+# `entity_versions`: Entity name -> hash of its ratios (see `entity_versions`), part of the gauge cache key in `app.py`
+# `ratio_inputs`: Inputs of the latest ratios, one row per report ID (see `xbrl_functions.pivot_ratio_inputs`), for what-if scenarios (see `scenario.py`)
+def build_artifact(csv_path=CSV_PATH, artifact_path=ARTIFACT_PATH):
+    current_hash = source_hash(csv_path)
+
+    # Each stage is timed (see `metrics.py`)
+    with metrics.timer('startup_stage_seconds', {'stage': 'read_csv'}):
+        df = xbrl_functions.load_fact_table(csv_path) # only the columns the ratios need, with compact types
+        df = xbrl_functions.drop_superseded_reports(df) # one report per municipality (the dashboard is keyed by entity name)
+    with metrics.timer('startup_stage_seconds', {'stage': 'compute_ratios'}):
+        final_ratios, ratio_panel = xbrl_functions.compute_ratio_tables(df) # split across processes for large datasets
+    with metrics.timer('startup_stage_seconds', {'stage': 'pivot_ratio_inputs'}):
+        ratio_inputs = xbrl_functions.pivot_ratio_inputs(xbrl_functions.build_fact_table(df))
+    with metrics.timer('startup_stage_seconds', {'stage': 'build_peer_index'}):
+        peers = peer_index.build_peer_index(final_ratios)
+    return _write_artifact(artifact_path, current_hash, final_ratios, ratio_panel, ratio_inputs, peers, fact_hashes(df))
+
+# Function to refresh the artifact after the source data has changed, recalculating only the municipalities whose facts changed
+# Returns the new artifact, or None if the source data has not changed since `artifact` was built
+# NOTE: If another process has already refreshed the artifact file for the current data, that artifact is returned as is
+# (processes refreshing at the same time wait for each other, so only the first one recalculates, see `build_lock`)
+def refresh_artifact(artifact, csv_path=CSV_PATH, artifact_path=ARTIFACT_PATH):
+    current_hash = source_hash(csv_path)
+    if artifact.get('source_hash') == current_hash:
+        return None
+    with build_lock(artifact_path):
+        on_disk = read_artifact(artifact_path)
+        if on_disk is not None and on_disk.get('source_hash') == current_hash:
+            return on_disk
+        if 'fact_hashes' not in artifact:
+            return build_artifact(csv_path, artifact_path)
+        return _refresh_artifact(artifact, current_hash, csv_path, artifact_path)
+
+# Function to recalculate the municipalities whose facts changed since `artifact` was built (see `refresh_artifact`)
+def _refresh_artifact(artifact, current_hash, csv_path, artifact_path):
+    df = xbrl_functions.drop_superseded_reports(xbrl_functions.load_fact_table(csv_path))
+    hashes = fact_hashes(df)
+    changed = [report_id for report_id, fact_hash in hashes.items() if artifact['fact_hashes'].get(report_id) != fact_hash]
+    stale = set(changed) | (set(artifact['fact_hashes']) - set(hashes)) # changed & removed municipalities
+    metrics.inc('reload_changed_entities_total', amount=len(stale))
+
+    # Recalculate the changed municipalities only, and keep every other municipality's rows
+    changed_facts = df[df['report.id'].isin(changed)]
+    new_ratios, new_panel = xbrl_functions.compute_ratio_tables(changed_facts)
+    new_inputs = xbrl_functions.pivot_ratio_inputs(xbrl_functions.build_fact_table(changed_facts))
+    old_ratios, old_panel, old_inputs = artifact['final_ratios'], artifact['ratio_panel'], artifact['ratio_inputs']
+    final_ratios = pd.concat([old_ratios[~old_ratios['report_id'].isin(stale)], new_ratios], ignore_index=True)
+    order = {report_id: position for position, report_id in enumerate(hashes)} # order of the report IDs in the new data
+    final_ratios = final_ratios.iloc[final_ratios['report_id'].map(order).argsort(kind='stable')].reset_index(drop=True)
+    ratio_panel = pd.concat([old_panel[~old_panel['report_id'].isin(stale)], new_panel]).sort_index()
+    ratio_inputs = pd.concat([old_inputs[~old_inputs.index.isin(stale)], new_inputs]).reindex(pd.Index(list(hashes), name='report.id'))
+
+    # Update the peer index in place of a copy, so requests still using the old artifact are not affected
+    peers = copy.deepcopy(artifact['peer_index'])
+    for entity_name, ratio_name in old_ratios.loc[old_ratios['report_id'].isin(stale), ['report_entity_name', 'ratio']].itertuples(index=False, name=None):
+        peer_index.remove_from_peer_index(peers, entity_name, ratio_name)
+    peer_index.update_peer_index(peers, new_ratios)
+    return _write_artifact(artifact_path, current_hash, final_ratios, ratio_panel, ratio_inputs, peers, hashes)
+
+# Function to assemble the artifact (see `build_artifact`) and write it to `artifact_path`
+def _write_artifact(artifact_path, current_hash, final_ratios, ratio_panel, ratio_inputs, peers, hashes):
+    with metrics.timer('startup_stage_seconds', {'stage': 'build_search_index'}):
+        search_index = entity_search.build_search_index(final_ratios)
+    artifact = {'source_hash': current_hash,
+                'final_ratios': final_ratios,
+                'report_entity_name': final_ratios['report_entity_name'].unique().tolist(),
+                'ratio_panel': ratio_panel,
+                'peer_index': peers,
+                'search_index': search_index,
+                'fact_hashes': hashes,
+                'entity_versions': entity_versions(final_ratios, ratio_panel),
+                'ratio_inputs': ratio_inputs}
+
+    # Write to a temporary file first, so a worker never reads a partially written artifact
+    tmp_path = '{}.{}.tmp'.format(artifact_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, artifact_path)
+    return artifact
+
+# Function to read the artifact (returns None if it does not exist or cannot be read)
+def read_artifact(artifact_path=ARTIFACT_PATH):
+    try:
+        with open(artifact_path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+# Function to load the artifact, rebuilding it only if the source data has changed
+# NOTE: Processes starting at the same time wait for each other, so only the first one rebuilds the artifact (see `build_lock`)
+def load_artifact(csv_path=CSV_PATH, artifact_path=ARTIFACT_PATH):
+    with metrics.timer('startup_stage_seconds', {'stage': 'read_artifact'}):
+        artifact = read_artifact(artifact_path)
+    with metrics.timer('startup_stage_seconds', {'stage': 'source_hash'}):
+        current_hash = source_hash(csv_path)
+    if artifact is None or artifact.get('source_hash') != current_hash:
+        with build_lock(artifact_path):
+            artifact = read_artifact(artifact_path)
+            if artifact is None or artifact.get('source_hash') != current_hash:
+                artifact = build_artifact(csv_path, artifact_path)
+    return artifact
+
+# Function to load `final_ratios` & the list of municipality names, rebuilding the artifact only if the source data has changed
+def load_ratios(csv_path=CSV_PATH, artifact_path=ARTIFACT_PATH):
+    artifact = load_artifact(csv_path, artifact_path)
+    return artifact['final_ratios'], artifact['report_entity_name']
+
+
+# Build step: `python ratio_store.py [CSV_PATH] [ARTIFACT_PATH]`
+if __name__ == '__main__':
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else CSV_PATH
+    artifact_path = sys.argv[2] if len(sys.argv) > 2 else ARTIFACT_PATH
+    artifact = build_artifact(csv_path, artifact_path)
+    print('Wrote {} ratios for {} municipalities to {}'.format(len(artifact['final_ratios']), len(artifact['report_entity_name']), artifact_path))
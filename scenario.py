@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import xbrl_functions
+
+# Inputs the what-if sliders of the dashboard adjust (input name -> label), from the inputs of the batch engine (see `xbrl_functions.BATCH_INPUTS`)
+SCENARIO_INPUTS = {
+    'gf_revenue': 'General Fund Revenue',
+    'gf_expenditures': 'General Fund Expenditures',
+    'gf_balance_unassigned': 'General Fund Balance Unassigned',
+    'gf_cash': 'General Fund Cash and Cash Equivalents',
+    'gov_expenditures': 'Governmental Funds Expenditures',
+    'gov_debt_principal': 'Debt Service Principal',
+    'gov_debt_interest': 'Debt Service Interest',
+}
+
+
+# Function to build the dependency graph from XBRL concepts to the inputs of the batch engine, and from the inputs to the ratios that use them
+# The ratios of each input are found by changing that input alone and checking which ratios change (see `xbrl_functions.evaluate_ratios`),
+# so the graph always matches the ratio functions, including inputs with a default (e.g. capital outlay in the debt coverage)
+# Graph keys & values are as follows:
+# `concepts`: `cube.primary-local-name` -> list of input names (a concept can feed several inputs, one per member)
+# `inputs`: Input name -> list of ratio names, in the order of `RATIO_TARGETS`
+def build_dependency_graph():
+    columns = list(xbrl_functions.BATCH_INPUTS) + ['{}_{}'.format(prefix, period) for prefix in xbrl_functions.BATCH_CAPITAL_ASSET_INPUTS
+                                                   for period in ('begin', 'end')] + ['population']
+    probe = pd.DataFrame([[1 + position / len(columns) for position in range(len(columns))]], columns=columns, index=pd.Index([0], name='report.id'))
+    baseline = xbrl_functions.evaluate_ratios(probe, xbrl_functions.BATCH_RATIOS)
+
+    graph = {'concepts': {}, 'inputs': {}}
+    for concept, members in xbrl_functions.BATCH_INPUTS.values():
+        graph['concepts'].setdefault(concept, [])
+    for name, (concept, members) in xbrl_functions.BATCH_INPUTS.items():
+        graph['concepts'][concept].append(name)
+    graph['concepts']['CapitalAssetsNetOfAccumulatedDepreciationAndAmortization'] = columns[len(xbrl_functions.BATCH_INPUTS):-1]
+    for column in columns:
+        changed = probe.copy()
+        changed[column] = changed[column] * 3
+        results = xbrl_functions.evaluate_ratios(changed, xbrl_functions.BATCH_RATIOS)
+        graph['inputs'][column] = [ratio_name for ratio_name, result in results.items()
+                                   if not result[['value', 'var_1_value', 'var_2_value']].equals(baseline[ratio_name][['value', 'var_1_value', 'var_2_value']])]
+    return graph
+
+# Dependency graph of the ratio functions (see `build_dependency_graph`)
+DEPENDENCIES = build_dependency_graph()
+
+# Function to resolve the keys of a scenario (input names or XBRL concepts) to input names
+# A concept stands for every input it feeds, e.g. `ExpendituresModifiedAccrual` for both the General Fund & Governmental Funds expenditures
+def resolve_inputs(names):
+    inputs = []
+    for name in names:
+        for input_name in DEPENDENCIES['concepts'].get(name, [name]):
+            if input_name not in DEPENDENCIES['inputs']:
+                raise KeyError('Unknown input or concept: {}'.format(name))
+            if input_name not in inputs:
+                inputs.append(input_name)
+    return inputs
+
+# Function to list the ratios that depend on some inputs or XBRL concepts, in the order of `RATIO_TARGETS`
+def affected_ratios(names):
+    ratio_names = {ratio_name for input_name in resolve_inputs(names) for ratio_name in DEPENDENCIES['inputs'][input_name]}
+    return [ratio_name for ratio_name in xbrl_functions.RATIO_TARGETS if ratio_name in ratio_names]
+
+# Function to apply a what-if scenario to one municipality, recalculating only the ratios that depend on the changed inputs
+# `inputs`: The municipality's ratio inputs as reported (a row of `xbrl_functions.pivot_ratio_inputs`)
+# `rows`: The municipality's `final_ratios` rows
+# `overrides`: Input name or XBRL concept -> value to use instead of the reported value
+# `changed`: Input names or XBRL concepts changed since `rows` were calculated (default: every key of `overrides`). Ratios that do not
+#            depend on them are left as they are, so moving one slider only recalculates the ratios that use its input
+# Returns (new `final_ratios` rows, list of the names of the ratios that were recalculated)
+def apply_scenario(inputs, rows, overrides, changed=None):
+    ratio_names = affected_ratios(overrides if changed is None else changed)
+    wide = inputs.to_frame().T.astype(float)
+    wide.index.name = 'report.id'
+    for name, value in overrides.items():
+        for input_name in resolve_inputs([name]):
+            wide[input_name] = float(value)
+
+    rows = rows.copy()
+    for ratio_name, result in xbrl_functions.evaluate_ratios(wide, ratio_names).items():
+        position = np.flatnonzero(rows['ratio'].to_numpy() == ratio_name)
+        for column in ['value', 'var_1_value', 'var_2_value', 'unavailable_reason']:
+            rows.iloc[position, rows.columns.get_loc(column)] = result[column].iloc[0]
+    return rows, ratio_names
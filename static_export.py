@@ -0,0 +1,182 @@
+import argparse
+import hashlib
+import html
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from dash import dcc
+import plotly.io as pio
+from plotly.offline import get_plotlyjs
+
+# The export renders the pages in background processes, so the dashboard's background reload thread is not needed (see `app.reload_dataset`)
+os.environ.setdefault('RELOAD_INTERVAL', '0')
+import app
+
+# Default folder the static pages are written to
+EXPORT_DIR = 'static_export'
+
+# Number of processes rendering the pages (None: one per CPU), and number of pages each process renders at a time
+EXPORT_WORKERS = None
+EXPORT_BATCH = 25
+
+# Bump this when the page template changes, so every page is rendered again (see `page_hash`)
+EXPORT_VERSION = 2
+
+# Gauges (ratio indexes) in each column of a page, same as the dashboard layout in `app.py`
+PAGE_COLUMNS = [[0, 1, 2, 3, 8], [4, 5, 6, 7]]
+
+# MathJax renders the formulas (the same LaTeX as the dashboard, see `app.update_markdown`). The copy bundled with Dash (the one the
+# dashboard's `dcc.Markdown` components load) is written to the export folder next to plotly.js, so the pages work offline
+MATHJAX_PATH = os.path.join(os.path.dirname(dcc.__file__), 'mathjax.js')
+
+PAGE_STYLE = '''body { font-family: 'Courier New', monospace; margin: 0 5%; }
+h1 { text-align: center; }
+.columns { display: flex; gap: 5%; }
+.column { flex: 1; }
+.gauge { border: 3px solid black; padding: 20px; background-color: lavender; margin-bottom: 60px; text-align: center; }
+.formula { font-size: 30px; }
+.rank { font-size: 18px; }'''
+
+
+# Function to convert the markdown of the dashboard's text components (bold text & line breaks, see `app.update_rank`) to HTML
+# NOTE: LaTeX formulas (`$...$`) are left as is, for MathJax
+def markdown_to_html(text):
+    text = html.escape(text, quote=False)
+    text = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', text)
+    return text.replace('  \n', '<br>').replace('\n', '<br>')
+
+# Function to return the file name of a municipality's page
+def page_name(report_id):
+    return '{}.html'.format(report_id)
+
+# Function to return the hash of everything shown on a municipality's page, to decide whether it has to be rendered again
+# The page shows the municipality's own ratios (see `app.get_entity_version`) and its peer rankings, which change whenever any municipality changes
+def page_hash(entity_name):
+    ranks = [app.update_rank(entity_name, ratio) for ratio in range(app.gauge_count)]
+    return hashlib.sha1(json.dumps([EXPORT_VERSION, app.get_entity_version(entity_name), ranks]).encode('utf-8')).hexdigest()
+
+# Function to render the full gauge layout of a municipality (gauge plot, formula, peer ranking & trend chart of every ratio) as an HTML page
+def render_page(entity_name, report_id):
+    gauges = {}
+    for ratio in range(app.gauge_count):
+        figure, text, trend = app.get_gauge(entity_name, ratio, app.get_entity_version(entity_name))
+        gauges[ratio] = ''.join([
+            '<div class="gauge">',
+            pio.to_html(figure, full_html=False, include_plotlyjs=False, include_mathjax=False, config={'responsive': True}),
+            '<p class="formula">{}</p>'.format(markdown_to_html(text)),
+            '<p class="rank">{}</p>'.format(markdown_to_html(app.update_rank(entity_name, ratio))),
+            pio.to_html(trend, full_html=False, include_plotlyjs=False, include_mathjax=False, config={'displayModeBar': False, 'responsive': True},
+                        default_height=app.trend_height),
+            '</div>'])
+    columns = ''.join('<div class="column">{}</div>'.format(''.join(gauges[ratio] for ratio in column if ratio in gauges)) for column in PAGE_COLUMNS)
+    return '''<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=0.75">
+<title>{name} - Government Financial Ratios</title>
+<style>{style}</style>
+<script src="plotly.min.js"></script>
+<script>window.MathJax = {{tex: {{inlineMath: [['$', '$']]}}}};</script>
+<script src="mathjax.js"></script>
+</head>
+<body>
+<h1>Government Financial Ratios</h1>
+<h2 style="text-align: center">{name} ({report_id})</h2>
+<p style="text-align: center"><a href="index.html">All municipalities</a></p>
+<div class="columns">{columns}</div>
+</body>
+</html>
+'''.format(name=html.escape(entity_name), report_id=report_id, style=PAGE_STYLE, columns=columns)
+
+# Function to render the index page, linking to every municipality's page (with a search box that filters the list in the browser)
+def render_index(entities):
+    items = ''.join('<li><a href="{}">{}</a> ({})</li>\n'.format(page_name(report_id), html.escape(entity_name), report_id)
+                    for entity_name, report_id in sorted(entities))
+    return '''<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=0.75">
+<title>Government Financial Ratios</title>
+<style>{style}</style>
+</head>
+<body>
+<h1>Government Financial Ratios</h1>
+<p style="text-align: center"><input id="search" type="search" placeholder="Search by municipality name or report ID" size="50"></p>
+<ul id="entities">
+{items}</ul>
+<script>
+document.getElementById('search').addEventListener('input', function () {{
+    var query = this.value.toLowerCase();
+    document.querySelectorAll('#entities li').forEach(function (item) {{
+        item.style.display = item.textContent.toLowerCase().indexOf(query) === -1 ? 'none' : '';
+    }});
+}});
+</script>
+</body>
+</html>
+'''.format(style=PAGE_STYLE, items=items)
+
+# Function to write a file through a temporary file, so a web server never serves a half-written page
+def _write_file(path, text):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+# Function to render & write the pages of a batch of (entity name, report ID), in a worker process
+def _render_batch(output_dir, entities):
+    for entity_name, report_id in entities:
+        _write_file(os.path.join(output_dir, page_name(report_id)), render_page(entity_name, report_id))
+    return len(entities)
+
+# Function to export every municipality's page, the index page, plotly.js & MathJax to `output_dir`
+# Only the pages whose content changed since the last export are rendered again (see `page_hash`); the hash of each page is kept in
+# a manifest (`<output_dir>/_manifest.json`, report ID -> page hash). Pages of municipalities no longer in the data are removed.
+# Returns the number of pages rendered
+def export(output_dir=EXPORT_DIR, workers=EXPORT_WORKERS, full=False):
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, '_manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path) and not full:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    entities = app.dataset['search_index']['entities'] # (entity name, report ID), for every municipality
+    hashes = {str(report_id): page_hash(entity_name) for entity_name, report_id in entities}
+    pending = [(entity_name, report_id) for entity_name, report_id in entities
+               if manifest.get(str(report_id)) != hashes[str(report_id)] or not os.path.exists(os.path.join(output_dir, page_name(report_id)))]
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(pending) <= EXPORT_BATCH:
+        _render_batch(output_dir, pending)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            batches = [pending[start:start + EXPORT_BATCH] for start in range(0, len(pending), EXPORT_BATCH)]
+            for future in [executor.submit(_render_batch, output_dir, batch) for batch in batches]:
+                future.result()
+
+    for report_id in set(manifest) - set(hashes): # municipalities no longer in the data
+        if os.path.exists(os.path.join(output_dir, page_name(report_id))):
+            os.remove(os.path.join(output_dir, page_name(report_id)))
+    if full or not os.path.exists(os.path.join(output_dir, 'plotly.min.js')):
+        _write_file(os.path.join(output_dir, 'plotly.min.js'), get_plotlyjs())
+    if full or not os.path.exists(os.path.join(output_dir, 'mathjax.js')):
+        with open(MATHJAX_PATH, encoding='utf-8') as f:
+            _write_file(os.path.join(output_dir, 'mathjax.js'), f.read())
+    _write_file(os.path.join(output_dir, 'index.html'), render_index(entities))
+    _write_file(manifest_path, json.dumps(hashes, indent=2, sort_keys=True))
+    return len(pending)
+
+
+# Command line: `python static_export.py [--output static_export] [--workers N] [--full]`
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the dashboard of every municipality as static HTML pages.')
+    parser.add_argument('--output', default=EXPORT_DIR, help='folder to write the pages to')
+    parser.add_argument('--workers', type=int, default=EXPORT_WORKERS, help='number of rendering processes (default: one per CPU)')
+    parser.add_argument('--full', action='store_true', help='render every page again, even if its data has not changed')
+    args = parser.parse_args()
+    rendered = export(args.output, args.workers, args.full)
+    print('Rendered {} of {} pages in {}'.format(rendered, len(app.dataset['search_index']['entities']), args.output))
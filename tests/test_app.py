@@ -0,0 +1,137 @@
+import importlib
+import json
+from contextvars import copy_context
+import math
+import os
+import plotly.io as pio
+import pytest
+from dash._callback_context import context_value
+from dash._utils import AttributeDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# The dashboard module (`app.py`), loaded from the repository's data without the background reload thread
+@pytest.fixture(scope='module')
+def dashboard():
+    cwd = os.getcwd()
+    os.environ['RELOAD_INTERVAL'] = '0'
+    os.chdir(ROOT)
+    try:
+        yield importlib.import_module('app')
+    finally:
+        os.chdir(cwd)
+
+
+# The same dataset with a municipality's ratios changed, as loaded after a data reload
+def reloaded_dataset(dashboard, value):
+    rows = dashboard.dataset['entity_rows'][value].copy()
+    rows['value'] = rows['value'] * 2
+    return dict(dashboard.dataset, version='reloaded', entity_rows=dict(dashboard.dataset['entity_rows'], **{value: rows}),
+                entity_versions=dict(dashboard.dataset['entity_versions'], **{value: 'reloaded'}))
+
+
+def test_reload_during_gauge_callback_is_not_cached_under_old_version(dashboard, monkeypatch):
+    value = 'Flint, Michigan'
+    current = dashboard.dataset
+    old_version = dashboard.get_entity_version(value)
+    expected = dashboard.dataset['entity_rows'][value]['value'].iloc[0]
+    dashboard.get_gauge.cache_clear()
+    dashboard.get_gauge_patch.cache_clear()
+
+    # The data is reloaded right after the callback read the entity version
+    get_entity_version = dashboard.get_entity_version
+    def reload_after(value):
+        version = get_entity_version(value)
+        monkeypatch.setattr(dashboard, 'dataset', reloaded_dataset(dashboard, value))
+        return version
+    monkeypatch.setattr(dashboard, 'get_entity_version', reload_after)
+
+    dashboard.update_gauge_plots(value)
+    assert dashboard.dataset is not current
+    assert dashboard.get_gauge(value, 0, old_version)[0].data[0].value == round(expected, 3)
+    dashboard.get_gauge.cache_clear()
+    dashboard.get_gauge_patch.cache_clear()
+
+
+def test_ratio_api_serves_dashboard_rows(dashboard):
+    client = dashboard.app.server.test_client()
+    entity_name, report_id = dashboard.dataset['search_index']['entities'][0]
+    payload = client.get('/api/ratios/{}'.format(report_id)).get_json()
+    assert payload['report_entity_name'] == entity_name
+    assert [ratio['ratio'] for ratio in payload['ratios']] == dashboard.get_entity_rows(entity_name)['ratio'].tolist()
+    assert client.get('/api/ratios/1').status_code == 404
+
+
+# Function to apply a `Patch` to a figure's JSON, like the browser does (see `app.figure_patch`)
+def apply_patch(figure, patch):
+    for operation in patch.to_plotly_json()['operations']:
+        target = figure
+        for key in operation['location'][:-1]:
+            target = target[key]
+        if operation['operation'] == 'Delete':
+            target.pop(operation['location'][-1], None)
+        else:
+            assert operation['operation'] == 'Assign'
+            target[operation['location'][-1]] = operation['params']['value']
+    return figure
+
+
+def figure_json(figure):
+    return json.loads(pio.to_json(figure))
+
+
+def test_patches_turn_any_gauge_into_any_other(dashboard):
+    flint, ogemaw = 'Flint, Michigan', 'County of Ogemaw'
+    for ratio in range(dashboard.gauge_count):
+        unavailable = dashboard.get_entity_rows(ogemaw).iloc[ratio].copy()
+        unavailable['value'], unavailable['unavailable_reason'] = math.nan, 'Not reported: Test'
+        gauges = [dashboard.create_gauge(flint, ratio), dashboard.create_gauge(ogemaw, ratio), dashboard.create_gauge(ogemaw, ratio, unavailable)]
+        for source in gauges:
+            for target in gauges:
+                patched = apply_patch(figure_json(source), dashboard.figure_patch(target, dashboard.gauge_patch_paths))
+                assert patched == figure_json(target)
+
+
+def test_patches_turn_any_trend_into_any_other(dashboard):
+    trends = [dashboard.create_trend(value, ratio) for value in ['Flint, Michigan', 'County of Ogemaw'] for ratio in range(dashboard.gauge_count)]
+    for source in trends:
+        for target in trends:
+            assert apply_patch(figure_json(source), dashboard.figure_patch(target, dashboard.trend_patch_paths)) == figure_json(target)
+
+
+# Function to call a callback as Dash would when `prop_id` triggered it (e.g. `compare-more.n_clicks`)
+def trigger(callback, prop_id, *args):
+    def run():
+        context_value.set(AttributeDict(triggered_inputs=[{'prop_id': prop_id, 'value': None}]))
+        return callback(*args)
+    return copy_context().run(run)
+
+
+def card_titles(cards):
+    return [(card.children[0].children, card.children[1].figure.data[0].title.text) for card in cards]
+
+
+def test_compare_grid_loads_one_page_at_a_time(dashboard):
+    entities = ['Flint, Michigan', 'City of Nowhere', 'County of Ogemaw']
+    ratios = list(range(dashboard.gauge_count))
+    ratio_names = list(dashboard.xbrl_functions.RATIO_TARGETS)
+    expected = [(value, ratio_names[ratio]) for ratio in ratios for value in ['Flint, Michigan', 'County of Ogemaw']] # unknown names are left out
+
+    children, loaded, more_style, status = trigger(dashboard.update_compare_grid, 'compare-ratios.value', entities, ratios, 0, 0)
+    assert card_titles(children) == expected[:dashboard.compare_page_size]
+    assert loaded == dashboard.compare_page_size and more_style.get('display') != 'none'
+    assert status == 'Showing {} of {} gauges'.format(dashboard.compare_page_size, len(expected))
+
+    # `Show more` sends only the next cards, appended to the grid in the browser
+    patch, loaded, more_style, status = trigger(dashboard.update_compare_grid, 'compare-more.n_clicks', entities, ratios, 1, loaded)
+    operation, = patch.to_plotly_json()['operations']
+    assert operation['operation'] == 'Extend' and operation['location'] == []
+    assert card_titles(operation['params']['value']) == expected[dashboard.compare_page_size:]
+    assert loaded == len(expected) and more_style == {'display': 'none'}
+
+    # A new selection starts again from the first page
+    children, loaded, more_style, status = trigger(dashboard.update_compare_grid, 'compare-entities.value', ['County of Ogemaw'], [0, 1], 1, loaded)
+    assert card_titles(children) == [('County of Ogemaw', ratio_names[0]), ('County of Ogemaw', ratio_names[1])]
+    assert loaded == 2 and more_style == {'display': 'none'} and status == 'Showing 2 of 2 gauges'
+    assert trigger(dashboard.update_compare_grid, 'compare-entities.value', None, [0], 1, loaded) == ([], 0, {'display': 'none'}, '')
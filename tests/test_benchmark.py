@@ -0,0 +1,51 @@
+import json
+import pandas as pd
+import pytest
+import benchmark
+import xbrl_functions
+from test_ratio_store import CSV_PATH
+
+
+# The synthetic municipalities' populations are added to the population table, so restore it after each test
+@pytest.fixture(autouse=True)
+def populations(monkeypatch):
+    monkeypatch.setattr(xbrl_functions, 'POPULATIONS', xbrl_functions.POPULATIONS)
+    monkeypatch.setattr(xbrl_functions, 'LATEST_POPULATIONS', xbrl_functions.LATEST_POPULATIONS)
+
+
+def test_generate_facts_copies_template_municipalities(populations):
+    template = pd.read_csv(CSV_PATH)
+    df = benchmark.generate_facts(template, 5, years=2)
+    report_ids = list(df['report.id'].unique())
+    assert report_ids == [benchmark.SYNTHETIC_REPORT_ID + i for i in range(5)]
+    # The second year is a copy one fiscal year earlier (the template reports already include a prior year)
+    years = df.groupby('report.id')['period.fiscal-year'].agg(['min', 'max'])
+    assert years['max'].eq(template['period.fiscal-year'].max()).all() and years['min'].eq(template['period.fiscal-year'].min() - 1).all()
+    templates = [len(rows) for report_id, rows in template.groupby('report.id', sort=False)]
+    assert [len(df[df['report.id'] == report_id]) for report_id in report_ids] == [2 * templates[i % len(templates)] for i in range(5)]
+    assert set(report_ids) <= set(xbrl_functions.LATEST_POPULATIONS)
+    assert df['report.entity-name'].nunique() == 5
+
+    # The same seed generates the same data, and every municipality has different ratios
+    pd.testing.assert_frame_equal(df, benchmark.generate_facts(template, 5, years=2))
+    final_ratios = xbrl_functions.compute_ratios(df)
+    assert final_ratios[final_ratios['ratio'] == 'Liquidity (Quick) Ratio']['value'].nunique() == 5
+
+
+def test_calibrate_parallel_reports_timings_and_restores_threshold(populations):
+    threshold = xbrl_functions.PARALLEL_MIN_ENTITIES
+    result = benchmark.calibrate_parallel(pd.read_csv(CSV_PATH), counts=[4, 8], years=1, workers=2)
+    assert [timing['entities'] for timing in result['timings']] == [4, 8]
+    assert all(timing['single_seconds'] > 0 and timing['parallel_seconds'] > 0 for timing in result['timings'])
+    assert result['threshold'] in (None, 4, 8)
+    assert xbrl_functions.PARALLEL_MIN_ENTITIES == threshold
+
+
+def test_main_writes_results(tmp_path):
+    output = tmp_path / 'benchmark_results.json'
+    benchmark.main(['--entities', '3', '--years', '1', '--template', CSV_PATH, '--output', str(output), '--no-memory'])
+    results = json.loads(output.read_text())
+    run, = results['runs']
+    assert run['entities'] == 3 and run['ratios'] == 3 * len(xbrl_functions.RATIO_TARGETS)
+    assert {'read_csv', 'compute_ratios', 'startup_cold', 'startup_warm', 'import_app'} <= set(run['stages'])
+    assert run['callbacks']['update_gauge_plots']['calls'] == 3
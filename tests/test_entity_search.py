@@ -0,0 +1,53 @@
+import pandas as pd
+import pytest
+import entity_search
+
+ENTITIES = [('County of Ogemaw', 1001), ('Flint, Michigan', 2002), ('City of Flint Township', 3003), ('County of Otsego', 1004),
+            ('Ogemaw Township', 4005), ('City of Detroit', 1006), ('City of Flynt', 5007)]
+
+
+@pytest.fixture
+def index():
+    return entity_search.build_search_index(pd.DataFrame(ENTITIES * 2, columns=['report_entity_name', 'report_id']))
+
+
+def names(results):
+    return [entity_name for entity_name, report_id in results]
+
+
+def test_index_has_each_entity_once_in_source_order(index):
+    assert index['entities'] == ENTITIES
+    assert index['positions']['City of Detroit'] == 5
+
+
+@pytest.mark.parametrize('query, expected', [
+    # The whole name starts with the query, then any word does
+    ('ogemaw', ['Ogemaw Township', 'County of Ogemaw']),
+    ('Flint, mich', ['Flint, Michigan']),
+    # Every word of the query starts a word of the name, in any order & case, ignoring punctuation
+    ('ogem cou', ['County of Ogemaw']),
+    ('TOWNSHIP, flint', ['City of Flint Township']),
+    # Names first, then report IDs
+    ('100', ['County of Ogemaw', 'County of Otsego', 'City of Detroit']),
+    ('3003', ['City of Flint Township']),
+])
+def test_search_ranks_exact_matches(index, query, expected):
+    assert names(entity_search.search_entities(index, query)) == expected
+
+
+def test_search_falls_back_to_misspelled_words(index):
+    assert names(entity_search.search_entities(index, 'detriot')) == ['City of Detroit']
+    assert names(entity_search.search_entities(index, 'county ogemw')) == ['County of Ogemaw']
+    assert entity_search.search_entities(index, 'zzzz') == []
+    # Fuzzy matches come after the exact ones
+    assert names(entity_search.search_entities(index, 'Flint')) == ['Flint, Michigan', 'City of Flint Township', 'City of Flynt']
+
+
+def test_search_limit_and_empty_query(index):
+    assert entity_search.search_entities(index, 'of', limit=2) == [('County of Ogemaw', 1001), ('City of Flint Township', 3003)]
+    assert entity_search.search_entities(index, ' , ', limit=3) == ENTITIES[:3]
+
+
+def test_lookup_entity(index):
+    assert entity_search.lookup_entity(index, 'County of Otsego') == [('County of Otsego', 1004)]
+    assert entity_search.lookup_entity(index, 'County of Nowhere') == []
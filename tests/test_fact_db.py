@@ -0,0 +1,130 @@
+import sqlite3
+import pandas as pd
+import pytest
+import fact_db
+from test_ratio_store import CSV_PATH, changed_source
+
+
+# Function to read every table of the fact database (facts in the order of each report, without the row IDs)
+def read_database(db_path):
+    with sqlite3.connect(db_path) as conn:
+        facts = pd.read_sql_query('SELECT * FROM facts', conn).drop(columns='row_id')
+        entities = pd.read_sql_query('SELECT * FROM entities ORDER BY position', conn)
+    facts = facts.sort_values('report_id', kind='stable').reset_index(drop=True)
+    return facts, entities
+
+
+# Function to read the row IDs of a municipality's facts (they change only when its facts are rewritten)
+def row_ids_of(db_path, entity_name):
+    with sqlite3.connect(db_path) as conn:
+        return [row[0] for row in conn.execute('SELECT row_id FROM facts JOIN entities USING (report_id) WHERE entity_name = ? ORDER BY row_id', (entity_name,))]
+
+
+# Source data with a newer report of Ogemaw (fiscal year 2022), which supersedes its current report on the dashboard
+def superseding_source(path):
+    df = pd.read_csv(CSV_PATH)
+    newer = df[df['report.entity-name'] == 'County of Ogemaw'].copy()
+    newer['report.id'] = 900002
+    newer['period.fiscal-year'] = newer['period.fiscal-year'] + 1
+    newer['fact.value'] = newer['fact.value'] * 3
+    pd.concat([df, newer], ignore_index=True).to_csv(path, index=False)
+
+
+@pytest.mark.parametrize('change', ['changed', 'removed', 'superseded'])
+def test_update_database_matches_full_build(tmp_path, change):
+    csv_path = str(tmp_path / 'xbrl_data.csv')
+    db_path = str(tmp_path / 'xbrl_facts.db')
+    pd.read_csv(CSV_PATH).to_csv(csv_path, index=False)
+    fact_db.build_database(csv_path, db_path)
+    versions = fact_db.entity_versions(db_path)
+    row_ids = row_ids_of(db_path, 'Flint, Michigan' if change == 'superseded' else 'County of Ogemaw')
+
+    if change == 'superseded':
+        superseding_source(csv_path)
+    else:
+        changed_source(csv_path, remove_ogemaw=change == 'removed')
+    database = fact_db.load_database(csv_path, db_path)
+    full_path = str(tmp_path / 'full.db')
+    fact_db.build_database(csv_path, full_path)
+
+    updated_facts, updated_entities = read_database(db_path)
+    built_facts, built_entities = read_database(full_path)
+    pd.testing.assert_frame_equal(updated_facts, built_facts)
+    pd.testing.assert_frame_equal(updated_entities, built_entities)
+    assert database['source_hash'] == fact_db.read_metadata(full_path, 'source_hash')
+    assert database['peer_index'] == fact_db.load_database(csv_path, full_path)['peer_index']
+
+    # Municipalities whose facts did not change keep their version, so their cached results stay valid
+    new_versions = fact_db.entity_versions(db_path)
+    assert new_versions == fact_db.entity_versions(full_path)
+    unchanged = 'County of Ogemaw' if change != 'superseded' else 'Flint, Michigan'
+    if unchanged in new_versions:
+        assert new_versions[unchanged] == versions[unchanged]
+        assert row_ids_of(db_path, unchanged) == row_ids # its facts were not rewritten
+    changed_entity = 'Flint, Michigan' if change != 'superseded' else 'County of Ogemaw'
+    assert new_versions[changed_entity] != versions[changed_entity]
+
+
+def test_load_database_rebuilds_other_versions(tmp_path, monkeypatch):
+    csv_path = str(tmp_path / 'xbrl_data.csv')
+    db_path = str(tmp_path / 'xbrl_facts.db')
+    pd.read_csv(CSV_PATH).to_csv(csv_path, index=False)
+    fact_db.build_database(csv_path, db_path)
+    changed_source(csv_path)
+
+    # A database built by another version of the ratio calculations is built again from scratch, not updated
+    calls = []
+    monkeypatch.setattr(fact_db, 'update_database', lambda *args: calls.append('update'))
+    monkeypatch.setattr(fact_db.ratio_store, 'ARTIFACT_VERSION', fact_db.ratio_store.ARTIFACT_VERSION + 1)
+    fact_db.load_database(csv_path, db_path)
+    assert calls == []
+    assert fact_db.read_metadata(db_path, 'artifact_version') == fact_db.ratio_store.ARTIFACT_VERSION
+
+
+def test_connect_reopens_replaced_database(tmp_path):
+    csv_path = str(tmp_path / 'xbrl_data.csv')
+    db_path = str(tmp_path / 'xbrl_facts.db')
+    pd.read_csv(CSV_PATH).to_csv(csv_path, index=False)
+    fact_db.build_database(csv_path, db_path)
+    conn = fact_db.connect(db_path)
+    assert fact_db.connect(db_path) is conn # reused while the file is the same
+    versions = fact_db.entity_versions(db_path)
+
+    # The update replaces the file, so the next call opens the new database and closes the old connection
+    changed_source(csv_path)
+    fact_db.load_database(csv_path, db_path)
+    new_conn = fact_db.connect(db_path)
+    assert new_conn is not conn
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute('SELECT 1')
+    assert fact_db.entity_versions(db_path)['Flint, Michigan'] != versions['Flint, Michigan']
+    with pytest.raises(sqlite3.OperationalError): # read-only
+        new_conn.execute('DELETE FROM facts')
+
+
+def test_entity_ratios_are_cached_per_version(tmp_path):
+    csv_path = str(tmp_path / 'xbrl_data.csv')
+    db_path = str(tmp_path / 'xbrl_facts.db')
+    pd.read_csv(CSV_PATH).to_csv(csv_path, index=False)
+    fact_db.build_database(csv_path, db_path)
+    fact_db.entity_ratios.cache_clear()
+    entities = fact_db.list_entities(db_path)
+    report_ids = dict(zip(entities['report_entity_name'], entities['report_id']))
+
+    # Calculated from the municipality's facts only, the same as the batch over every municipality
+    def ratios(entity_name):
+        return fact_db.entity_ratios(report_ids[entity_name], db_path, fact_db.entity_versions(db_path)[entity_name])[0]
+    final_ratios = fact_db.xbrl_functions.compute_ratios(fact_db.xbrl_functions.load_fact_table(csv_path))
+    for entity_name in report_ids:
+        expected = final_ratios[final_ratios['report_entity_name'] == entity_name].reset_index(drop=True)
+        pd.testing.assert_frame_equal(ratios(entity_name), expected)
+    flint = ratios('Flint, Michigan')
+    assert fact_db.entity_ratios.cache_info().hits == 1 and fact_db.entity_ratios.cache_info().misses == 2
+
+    # After an update, only the municipality whose facts changed is calculated again
+    changed_source(csv_path)
+    fact_db.load_database(csv_path, db_path)
+    ratios('County of Ogemaw')
+    assert not ratios('Flint, Michigan').equals(flint)
+    assert fact_db.entity_ratios.cache_info().hits == 2 and fact_db.entity_ratios.cache_info().misses == 3
+    fact_db.entity_ratios.cache_clear()
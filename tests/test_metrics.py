@@ -0,0 +1,43 @@
+import os
+import metrics
+import pytest
+
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, '_counters', {})
+    monkeypatch.setattr(metrics, '_histograms', {})
+    monkeypatch.setattr(metrics, '_collectors', [])
+    return tmp_path
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_render_adds_up_every_process(metrics_dir):
+    metrics.inc('data_reloads_total', amount=2)
+    metrics.observe('api_seconds', 0.003, {'route': 'entity'})
+    metrics.register_collector(lambda: [('gauge_cache_size', 'gauge', None, 5)])
+
+    # A forked worker starts from zero, and its metrics are written to its own file
+    pid = os.fork()
+    if pid == 0:
+        try:
+            metrics.inc('data_reloads_total')
+            metrics.observe('api_seconds', 0.2, {'route': 'entity'})
+            metrics.flush()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+    lines = metrics.render().splitlines()
+    assert 'data_reloads_total 3' in lines
+    assert 'api_seconds_count{route="entity"} 2' in lines
+    assert 'api_seconds_bucket{route="entity",le="0.005"} 1' in lines
+    assert 'gauge_cache_size{{pid="{}"}} 5'.format(os.getpid()) in lines
+    assert 'gauge_cache_size{{pid="{}"}} 5'.format(pid) in lines
+
+    # An exited worker's counters are kept, its collected samples are dropped
+    metrics.mark_process_dead(pid)
+    lines = metrics.render().splitlines()
+    assert 'data_reloads_total 3' in lines
+    assert 'gauge_cache_size{{pid="{}"}} 5'.format(pid) not in lines
@@ -0,0 +1,53 @@
+import math
+import pandas as pd
+import pytest
+import peer_index
+
+RATIO = 'Short-run Financial Position'
+
+
+# `final_ratios` rows of one ratio, from (report ID, entity name, value)
+def ratio_rows(entities, ratio_name=RATIO):
+    return pd.DataFrame([{'report_id': report_id, 'report_entity_name': entity_name, 'ratio': ratio_name, 'value': value}
+                         for report_id, entity_name, value in entities])
+
+
+@pytest.fixture
+def index():
+    return peer_index.build_peer_index(ratio_rows([
+        (1, 'City of A', 1.0), (2, 'City of B', 2.0), (3, 'City of C', 2.0), (4, 'City of D', 4.0),
+        (5, 'County of E', 3.0), (6, 'County of F', 5.0), (7, 'City of G', math.nan),
+    ]))
+
+
+def test_peer_rank_all_filers_and_type(index):
+    # City of B has one peer below it and ties with City of C (ties count half, both its own value & the tied one)
+    assert peer_index.peer_rank(index, 'City of B', RATIO) == {'group': peer_index.ALL_FILERS, 'count': 6, 'percentile': 100 * 2 / 6, 'median': 2.5}
+    assert peer_index.peer_rank(index, 'City of B', RATIO, 'type') == {'group': 'Cities & Other Municipalities', 'count': 4, 'percentile': 50.0, 'median': 2.0}
+    assert peer_index.peer_rank(index, 'County of F', RATIO, 'type') == {'group': 'Counties', 'count': 2, 'percentile': 75.0, 'median': 4.0}
+    assert peer_index.peer_rank(index, 'City of A', RATIO)['percentile'] == 100 * 0.5 / 6
+
+
+def test_missing_values_are_not_ranked(index):
+    assert peer_index.peer_rank(index, 'City of G', RATIO) is None
+    assert peer_index.peer_rank(index, 'City of Nowhere', RATIO) is None
+    assert peer_index.peer_rank(index, 'City of A', 'Another Ratio') is None
+
+
+def test_update_matches_rebuilt_index(index):
+    # City of B changes, County of E is removed, City of G gets a value, and a new county is added
+    peer_index.update_peer_index(index, ratio_rows([(2, 'City of B', 6.0), (7, 'City of G', 0.5), (8, 'County of H', 1.0)]))
+    peer_index.remove_from_peer_index(index, 'County of E', RATIO)
+    rebuilt = peer_index.build_peer_index(ratio_rows([
+        (1, 'City of A', 1.0), (2, 'City of B', 6.0), (3, 'City of C', 2.0), (4, 'City of D', 4.0),
+        (6, 'County of F', 5.0), (7, 'City of G', 0.5), (8, 'County of H', 1.0),
+    ]))
+    assert index == rebuilt
+    assert peer_index.peer_rank(index, 'City of B', RATIO)['percentile'] == 100 * 6.5 / 7
+
+
+def test_removing_last_member_drops_its_groups(index):
+    peer_index.update_peer_index(index, ratio_rows([(5, 'County of E', math.nan)]))
+    peer_index.remove_from_peer_index(index, 'County of F', RATIO)
+    assert ('type', 'Counties', RATIO) not in index['values']
+    assert index == peer_index.build_peer_index(ratio_rows([(1, 'City of A', 1.0), (2, 'City of B', 2.0), (3, 'City of C', 2.0), (4, 'City of D', 4.0)]))
@@ -0,0 +1,81 @@
+import gzip
+import json
+import math
+import pandas as pd
+import pytest
+from flask import Flask
+import ratio_api
+
+
+# A Flask server with the ratio routes, over `final_ratios` rows that can be changed between requests
+# `versions`: Report ID -> version of its rows (None: version of the whole data); `calls`: report IDs the rows were read for
+@pytest.fixture
+def api():
+    rows = pd.DataFrame([
+        {'report_id': 1, 'report_entity_name': 'City of A', 'ratio': 'Liquidity', 'value': 1.5},
+        {'report_id': 1, 'report_entity_name': 'City of A', 'ratio': 'Own Source Revenue', 'value': math.nan},
+        {'report_id': 2, 'report_entity_name': 'County of B', 'ratio': 'Liquidity', 'value': 0.25},
+    ])
+    state = {'versions': {None: 'v1', 1: 'a1', 2: 'b1'}, 'calls': []}
+
+    def get_rows(report_id):
+        state['calls'].append(report_id)
+        if report_id is None:
+            return rows
+        if report_id not in state['versions']:
+            return None
+        return rows[rows['report_id'] == report_id]
+
+    server = Flask(__name__)
+    ratio_api.register_endpoints(server, lambda report_id: state['versions'].get(report_id, state['versions'][None]), get_rows)
+    state['client'] = server.test_client()
+    return state
+
+
+def test_entity_route_serves_gzip_json(api):
+    response = api['client'].get('/api/ratios/1', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'].endswith('-gz"')
+    payload = json.loads(gzip.decompress(response.data))
+    assert payload['version'] == 'a1' and payload['report_id'] == 1 and payload['report_entity_name'] == 'City of A'
+    assert [ratio['value'] for ratio in payload['ratios']] == [1.5, None]
+
+
+def test_uncompressed_response_has_its_own_etag(api):
+    compressed = api['client'].get('/api/ratios/1', headers={'Accept-Encoding': 'gzip'})
+    plain = api['client'].get('/api/ratios/1')
+    assert 'Content-Encoding' not in plain.headers
+    assert json.loads(plain.data) == json.loads(gzip.decompress(compressed.data))
+    assert plain.headers['ETag'] != compressed.headers['ETag']
+    assert plain.headers['Vary'] == 'Accept-Encoding'
+    # The ETag of one encoding does not match the other
+    assert api['client'].get('/api/ratios/1', headers={'If-None-Match': compressed.headers['ETag']}).status_code == 200
+
+
+def test_not_modified_until_version_changes(api):
+    etag = api['client'].get('/api/ratios/1', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+    response = api['client'].get('/api/ratios/1', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 304 and response.data == b''
+    assert api['calls'] == [1] # serialized once
+
+    api['versions'][1] = 'a2'
+    response = api['client'].get('/api/ratios/1', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    assert json.loads(gzip.decompress(response.data))['version'] == 'a2'
+
+
+def test_unknown_report_is_not_found_and_not_cached(api):
+    etag = api['client'].get('/api/ratios/1').headers['ETag']
+    for _ in range(2):
+        response = api['client'].get('/api/ratios/3', headers={'If-None-Match': etag})
+        assert response.status_code == 404
+        assert json.loads(response.data) == {'error': 'Not found'}
+    assert api['calls'] == [1, 3, 3]
+    assert api['client'].get('/api/ratios/abc').status_code == 404
+
+
+def test_all_route(api):
+    payload = json.loads(api['client'].get('/api/ratios').data)
+    assert payload['version'] == 'v1' and 'report_id' not in payload
+    assert [ratio['report_id'] for ratio in payload['ratios']] == [1, 1, 2]
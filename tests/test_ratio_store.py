@@ -0,0 +1,49 @@
+import os
+import pandas as pd
+import pytest
+import ratio_store
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'xbrl_data.csv')
+
+
+# Function to compare two artifacts (everything except the source hash, which is checked separately)
+def assert_same_artifact(refreshed, built):
+    pd.testing.assert_frame_equal(refreshed['final_ratios'], built['final_ratios'])
+    pd.testing.assert_frame_equal(refreshed['ratio_panel'], built['ratio_panel'])
+    pd.testing.assert_frame_equal(refreshed['ratio_inputs'], built['ratio_inputs'])
+    assert refreshed['report_entity_name'] == built['report_entity_name']
+    assert refreshed['peer_index'] == built['peer_index']
+    assert refreshed['search_index'] == built['search_index']
+    assert refreshed['fact_hashes'] == built['fact_hashes']
+    assert refreshed['entity_versions'] == built['entity_versions']
+
+
+# Source data with one municipality's facts changed, a new municipality (a copy of Flint) and, optionally, Ogemaw removed
+def changed_source(path, remove_ogemaw=False):
+    df = pd.read_csv(CSV_PATH)
+    flint = df[df['report.entity-name'] == 'Flint, Michigan'].copy()
+    flint['report.id'] = 900001
+    flint['report.entity-name'] = 'City of Copy'
+    flint['fact.value'] = flint['fact.value'] * 2
+    df.loc[(df['report.entity-name'] == 'Flint, Michigan') & (df['cube.primary-local-name'] == 'RevenuesModifiedAccrual'), 'fact.value'] *= 1.5
+    if remove_ogemaw:
+        df = df[df['report.entity-name'] != 'County of Ogemaw']
+    pd.concat([df, flint], ignore_index=True).to_csv(path, index=False)
+
+
+@pytest.mark.parametrize('remove_ogemaw', [False, True])
+def test_refresh_artifact_matches_full_build(tmp_path, remove_ogemaw):
+    csv_path = str(tmp_path / 'xbrl_data.csv')
+    artifact_path = str(tmp_path / 'xbrl_ratios.pkl')
+    pd.read_csv(CSV_PATH).to_csv(csv_path, index=False)
+    artifact = ratio_store.build_artifact(csv_path, artifact_path)
+
+    changed_source(csv_path, remove_ogemaw)
+    refreshed = ratio_store.refresh_artifact(artifact, csv_path, artifact_path)
+    built = ratio_store.build_artifact(csv_path, str(tmp_path / 'full.pkl'))
+    assert refreshed['source_hash'] == built['source_hash'] == ratio_store.source_hash(csv_path)
+    assert_same_artifact(refreshed, built)
+
+    # The refreshed artifact is written to disk, and there is nothing left to refresh
+    assert_same_artifact(ratio_store.read_artifact(artifact_path), built)
+    assert ratio_store.refresh_artifact(refreshed, csv_path, artifact_path) is None
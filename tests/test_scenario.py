@@ -0,0 +1,51 @@
+import os
+import pandas as pd
+import pytest
+import scenario
+import xbrl_functions
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'xbrl_data.csv')
+
+# Inputs a ratio reads with a default instead of requiring them (so they are not in `BATCH_RATIO_INPUTS`)
+OPTIONAL_INPUTS = {'gov_capital_outlay': ['Governmental Funds Debt Coverage']}
+
+# Every input of the batch engine, as named in the dependency graph
+INPUTS = list(scenario.DEPENDENCIES['inputs'])
+
+
+@pytest.fixture(scope='module')
+def facts():
+    df = xbrl_functions.load_fact_table(CSV_PATH)
+    return xbrl_functions.pivot_ratio_inputs(xbrl_functions.build_fact_table(df)), xbrl_functions.compute_ratios(df)
+
+
+@pytest.mark.parametrize('input_name', INPUTS)
+def test_affected_ratios_match_formula_inputs(input_name):
+    expected = [ratio_name for ratio_name in xbrl_functions.RATIO_TARGETS
+                if input_name in xbrl_functions.BATCH_RATIO_INPUTS[ratio_name] or ratio_name in OPTIONAL_INPUTS.get(input_name, [])]
+    assert scenario.affected_ratios([input_name]) == expected
+
+
+def test_concepts_resolve_to_every_input_they_feed():
+    assert scenario.resolve_inputs(['ExpendituresModifiedAccrual']) == ['gf_expenditures', 'gov_expenditures']
+    with pytest.raises(KeyError):
+        scenario.resolve_inputs(['NotAConcept'])
+
+
+@pytest.mark.parametrize('input_name', INPUTS)
+def test_apply_scenario_matches_full_recalculation(facts, input_name):
+    wide, final_ratios = facts
+    for report_id, inputs in wide.iterrows():
+        rows = final_ratios[final_ratios['report_id'] == report_id].reset_index(drop=True)
+        value = inputs[input_name] * 1.2 if pd.notna(inputs[input_name]) else 1000.0
+        new_rows, recalculated = scenario.apply_scenario(inputs, rows, {input_name: value})
+
+        # Every ratio recalculated from scratch with the changed input: the ratios left as they were must not have changed
+        changed = inputs.to_frame().T.astype(float)
+        changed.index.name = 'report.id'
+        changed[input_name] = value
+        full = xbrl_functions.evaluate_ratios(changed, list(xbrl_functions.RATIO_TARGETS))
+        for position, ratio_name in enumerate(new_rows['ratio']):
+            for column in ['value', 'var_1_value', 'var_2_value']:
+                assert new_rows[column].iloc[position] == pytest.approx(full[ratio_name][column].iloc[0], nan_ok=True), (ratio_name, column)
+        assert recalculated == scenario.affected_ratios([input_name])
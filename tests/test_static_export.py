@@ -0,0 +1,32 @@
+import os
+import re
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# The static export module (`static_export.py`), loaded from the repository's data (see `dashboard` in `test_app.py`)
+@pytest.fixture(scope='module')
+def static_export():
+    cwd = os.getcwd()
+    os.environ['RELOAD_INTERVAL'] = '0'
+    os.chdir(ROOT)
+    try:
+        import static_export
+        yield static_export
+    finally:
+        os.chdir(cwd)
+
+
+def test_pages_load_nothing_from_outside_the_export_folder(static_export, tmp_path):
+    assert static_export.export(str(tmp_path), workers=1) == len(static_export.app.dataset['search_index']['entities'])
+    entity_name, report_id = static_export.app.dataset['search_index']['entities'][0]
+    with open(tmp_path / static_export.page_name(report_id), encoding='utf-8') as f:
+        page = f.read()
+    assert re.findall(r'<script src="([^"]+)"', page) == ['plotly.min.js', 'mathjax.js']
+    assert not re.findall(r'https?://', page)
+    assert os.path.getsize(tmp_path / 'mathjax.js') == os.path.getsize(static_export.MATHJAX_PATH)
+    assert r'\frac' in page # formulas are left for MathJax to render
+
+    # Nothing changed, so nothing is rendered again
+    assert static_export.export(str(tmp_path), workers=1) == 0
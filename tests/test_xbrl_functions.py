@@ -0,0 +1,195 @@
+import os
+import pandas as pd
+import pytest
+import xbrl_functions
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'xbrl_data.csv')
+
+
+def test_load_fact_table_matches_read_csv():
+    df = xbrl_functions.load_fact_table(CSV_PATH)
+    raw = pd.read_csv(CSV_PATH)
+    assert str(df['report.id'].dtype) == 'int32'
+    assert str(df['period.fiscal-year'].dtype) == 'int16'
+    assert str(df['dimensions.count'].dtype) == 'int8'
+    assert isinstance(df['cube.primary-local-name'].dtype, pd.CategoricalDtype)
+    assert len(df) == len(raw)
+    assert (df['report.id'].values == raw['report.id'].values).all()
+    assert (df['period.fiscal-year'].values == raw['period.fiscal-year'].values).all()
+    pd.testing.assert_series_equal(df['fact.value'], raw['fact.value'])
+
+    # Loading in chunks gives the same rows
+    chunks = pd.concat(xbrl_functions.load_fact_table(CSV_PATH, chunksize=1000), ignore_index=True)
+    assert (chunks['report.id'].values == df['report.id'].values).all()
+    assert str(chunks['period.fiscal-year'].dtype) == 'int16'
+
+
+def test_load_fact_table_drops_blank_fiscal_year(tmp_path):
+    raw = pd.read_csv(CSV_PATH)
+    blank = (raw['report.entity-name'] == 'Flint, Michigan') & (raw['cube.primary-local-name'] == 'RevenuesModifiedAccrual')
+    raw['period.fiscal-year'] = raw['period.fiscal-year'].astype(object)
+    raw.loc[blank, 'period.fiscal-year'] = ''
+    csv_path = str(tmp_path / 'xbrl_data.csv')
+    raw.to_csv(csv_path, index=False)
+
+    with pytest.warns(UserWarning, match=r'Dropped {} facts .*Flint, Michigan \({}\)'.format(blank.sum(), blank.sum())):
+        df = xbrl_functions.load_fact_table(csv_path)
+    assert len(df) == len(raw) - blank.sum()
+    assert str(df['period.fiscal-year'].dtype) == 'int16'
+    assert not ((df['report.entity-name'] == 'Flint, Michigan') & (df['cube.primary-local-name'] == 'RevenuesModifiedAccrual')).any()
+
+    # Every other municipality still gets its ratios
+    ratios = xbrl_functions.compute_ratios(df)
+    assert set(ratios['report_id']) == set(raw['report.id'])
+
+
+# Per-municipality ratio functions, in the order of `RATIO_TARGETS`
+RATIO_FUNCTIONS = [
+    xbrl_functions.get_short_run,
+    xbrl_functions.get_days_cash_on_hand,
+    xbrl_functions.get_liquidity,
+    xbrl_functions.get_gov_debt_coverage,
+    xbrl_functions.get_expenditure_per_capita,
+    xbrl_functions.get_net_asset_growth,
+    xbrl_functions.get_captial_asset_ga,
+    xbrl_functions.get_captial_asset_bta,
+    xbrl_functions.get_own_source_rev,
+]
+
+
+# Source data with extra copies of Flint covering the edge cases of the ratio functions:
+# - `City of Missing`: unassigned fund balance, capital outlay (defaults to 0) & one business-type capital asset value not reported,
+#   and no population
+# - `City of Prior Year`: every fact also reported for the year before, some before & some after the current year's facts
+# - `City of Zero`: general fund revenue of 0 (division by zero)
+def edge_case_facts():
+    df = xbrl_functions.ensure_dimension_columns(pd.read_csv(CSV_PATH))
+    flint = df[df['report.entity-name'] == 'Flint, Michigan']
+
+    def copy(report_id, name):
+        return flint.assign(**{'report.id': report_id, 'report.entity-name': name})
+
+    missing = copy(900001, 'City of Missing')
+    bta_assets = missing.index[(missing['cube.primary-local-name'] == 'CapitalAssetsNetOfAccumulatedDepreciationAndAmortization')
+                               & (missing['member1'] == 'BusinessTypeActivitiesMember')]
+    missing = missing.drop(bta_assets[:1])
+    missing = missing[~(((missing['cube.primary-local-name'] == 'FundBalanceUnassigned') & (missing['member1'] == 'GeneralFundMember'))
+                        | (missing['cube.primary-local-name'] == 'ExpendituresForCapitalOutlayModifiedAccrual'))]
+
+    current = copy(900002, 'City of Prior Year')
+    prior = current.assign(**{'period.fiscal-year': current['period.fiscal-year'] - 1, 'fact.value': current['fact.value'] * 0.8})
+    prior_year = pd.concat([prior.iloc[::2], current, prior.iloc[1::2]])
+
+    zero = copy(900003, 'City of Zero')
+    zero.loc[(zero['cube.primary-local-name'] == 'RevenuesModifiedAccrual') & (zero['member1'] == 'GeneralFundMember'), 'fact.value'] = 0.0
+
+    return pd.concat([df, missing, prior_year, zero], ignore_index=True)
+
+
+def test_compute_ratios_matches_ratio_functions():
+    df = edge_case_facts()
+    index = xbrl_functions.build_fact_index(df)
+    final_ratios = xbrl_functions.compute_ratios(df)
+    assert list(final_ratios['report_id'].unique()) == list(df['report.id'].unique())
+
+    unavailable = 0
+    for row in final_ratios.to_dict('records'):
+        function = RATIO_FUNCTIONS[list(xbrl_functions.RATIO_TARGETS).index(row['ratio'])]
+        try:
+            expected = function(index, row['report_id'])
+        except (KeyError, ZeroDivisionError):
+            # An input was not reported, or a division by zero: the batch engine gives NaN with the reason instead of raising
+            assert pd.isna(row['value']) and row['unavailable_reason'], (row['report_entity_name'], row['ratio'])
+            unavailable += 1
+            continue
+        assert row['report_entity_name'] == expected['report_entity_name']
+        for column in ['value', 'var_1_value', 'var_2_value']:
+            assert row[column] == pytest.approx(expected[column], nan_ok=True), (row['report_entity_name'], row['ratio'], column)
+        assert (row['unavailable_reason'] is None) == bool(pd.notna(expected['value'])), (row['report_entity_name'], row['ratio'])
+        for column in ['green_start', 'green_end', 'yellow_start', 'yellow_end', 'red_start', 'red_end', 'var_1_name', 'var_2_name']:
+            assert row[column] == expected[column] or (pd.isna(row[column]) and pd.isna(expected[column]))
+
+    # The edge cases were exercised: inputs not reported (City of Missing) and a division by zero (City of Zero)
+    assert unavailable >= 3
+    reasons = final_ratios.set_index(['report_entity_name', 'ratio'])['unavailable_reason']
+    assert reasons['City of Missing', 'Short Run Financial Position'].startswith('Not reported: FundBalanceUnassigned')
+    assert reasons['City of Zero', 'Short Run Financial Position'] == 'Division by zero'
+    assert reasons['City of Missing', 'Governmental Funds Debt Coverage'] is None # capital outlay defaults to 0
+
+
+def test_ratio_history_ends_with_reported_ratio():
+    df = xbrl_functions.load_fact_table(CSV_PATH)
+    final_ratios = xbrl_functions.compute_ratios(df)
+    panel = xbrl_functions.compute_ratio_panel(df)
+    latest = df.groupby('report.entity-name', observed=True)['period.fiscal-year'].max()
+    for row in final_ratios.itertuples(index=False):
+        history = xbrl_functions.ratio_history(panel, row.report_entity_name, row.ratio)
+        assert history['fiscal_year'].is_monotonic_increasing and history['fiscal_year'].is_unique
+        if pd.isna(row.value):
+            assert latest[row.report_entity_name] not in history['fiscal_year'].tolist()
+        else:
+            assert history['fiscal_year'].iloc[-1] == latest[row.report_entity_name]
+            assert history['value'].iloc[-1] == pytest.approx(row.value)
+    assert xbrl_functions.ratio_history(panel, 'City of Nowhere', final_ratios['ratio'].iloc[0]).empty
+
+    # A copy of every fact one fiscal year earlier has the same ratios in that year
+    # (NOTE: the ratios of the latest year change, since some compare a year with the year before)
+    earlier = df.copy()
+    earlier['period.fiscal-year'] = earlier['period.fiscal-year'] - 1
+    panel = xbrl_functions.compute_ratio_panel(pd.concat([earlier, df], ignore_index=True))
+    for row in final_ratios[final_ratios['value'].notna()].itertuples(index=False):
+        history = xbrl_functions.ratio_history(panel, row.report_entity_name, row.ratio).set_index('fiscal_year')
+        assert history.loc[latest[row.report_entity_name] - 1, 'value'] == pytest.approx(row.value)
+
+
+def test_drop_superseded_reports_keeps_latest_report_of_each_municipality():
+    df = xbrl_functions.load_fact_table(CSV_PATH)
+    ogemaw = df[df['report.entity-name'] == 'County of Ogemaw']
+    newer, same_year = ogemaw.copy(), ogemaw.copy()
+    newer['report.id'], newer['period.fiscal-year'] = 900002, newer['period.fiscal-year'] + 1
+    same_year['report.id'] = 900001 # same fiscal year as the current report, higher report ID
+    flint = df[df['report.entity-name'] == 'Flint, Michigan']['report.id'].iloc[0]
+
+    kept = xbrl_functions.drop_superseded_reports(pd.concat([df, newer, same_year], ignore_index=True))
+    assert set(kept['report.id']) == {flint, 900002}
+    kept = xbrl_functions.drop_superseded_reports(pd.concat([same_year, df], ignore_index=True))
+    assert set(kept['report.id']) == {flint, 900001}
+    assert xbrl_functions.drop_superseded_reports(df) is df
+
+
+# The population table is replaced in some tests, so restore it after each test
+@pytest.fixture
+def populations(monkeypatch):
+    monkeypatch.setattr(xbrl_functions, 'POPULATIONS', xbrl_functions.POPULATIONS)
+    monkeypatch.setattr(xbrl_functions, 'LATEST_POPULATIONS', xbrl_functions.LATEST_POPULATIONS)
+
+
+def test_load_populations_keeps_last_row_of_each_year(tmp_path):
+    path = tmp_path / 'population.csv'
+    path.write_text('report_id,entity_name,fiscal_year,population\n1,City of A,2020,100\n1,City of A,2020,110\n2,"County, B",2021,\n3,City of C,2019,300\n')
+    table = xbrl_functions.load_populations(str(path))
+    assert table.values.tolist() == [[1, 2020, 110.0], [3, 2019, 300.0]]
+    assert xbrl_functions.load_populations(str(tmp_path / 'missing.csv')).empty
+
+
+def test_join_populations_uses_nearest_year(populations):
+    xbrl_functions.set_populations(pd.DataFrame({'report_id': [1, 1, 2], 'fiscal_year': [2018, 2021, 2020], 'population': [100.0, 130.0, 500.0]}))
+    assert xbrl_functions.LATEST_POPULATIONS == {1: 130.0, 2: 500.0}
+    joined = xbrl_functions.join_populations([2, 1, 1, 1, 3, 1], [2022, 2018, 2019, 2021, 2021, 2024])
+    assert joined[:4].tolist() == [500.0, 100.0, 100.0, 130.0]
+    assert pd.isna(joined[4]) and joined[5] == 130.0
+
+
+def test_expenditure_per_capita_reads_population_table(populations):
+    df = xbrl_functions.load_fact_table(CSV_PATH)
+    per_capita = lambda: xbrl_functions.compute_ratios(df).set_index(['report_entity_name', 'ratio'])['value'].xs('Expenditure per Capita', level='ratio')
+    reported = per_capita()
+    flint = df[df['report.entity-name'] == 'Flint, Michigan']['report.id'].iloc[0]
+
+    # Doubling Flint's population halves its expenditure per capita; a municipality missing from the table has none
+    table = xbrl_functions.POPULATIONS.copy()
+    table.loc[table['report_id'] == flint, 'population'] *= 2
+    xbrl_functions.set_populations(table[table['report_id'] == flint])
+    changed = per_capita()
+    assert changed['Flint, Michigan'] == pytest.approx(reported['Flint, Michigan'] / 2)
+    assert pd.isna(changed['County of Ogemaw'])
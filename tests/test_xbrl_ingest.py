@@ -0,0 +1,180 @@
+import json
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import pandas as pd
+import pytest
+import xbrl_ingest
+
+
+# Local stub of the XBRL US API (`/oauth2/token`, `/api/v1/cube/search` & `/api/v1/report/search`)
+# `rows`: (report ID, statement ID) -> number of facts in the partition (fact `i` is concept `C<i>` with value `i`)
+# `page_size`: Rows per page (the `paging.limit` of the account)
+# `duplicates`: Number of facts repeated at the start of every page after the first, like overlapping pages from the API
+# `failures`: Responses to send before the real one, as a list of (status, headers, body) for each (report ID, statement ID, offset)
+class StubAPI:
+    def __init__(self, rows, page_size=100, duplicates=0, failures=None):
+        self.rows = rows
+        self.page_size = page_size
+        self.duplicates = duplicates
+        self.failures = failures or {}
+        self.requests = [] # (report ID, statement ID, offset) of every search request, in the order received
+
+    def facts(self, report_id, statement_id, offset):
+        start = max(offset - self.duplicates, 0) if offset else 0
+        end = min(offset + self.page_size, self.rows[(report_id, statement_id)])
+        return [{'report.id': report_id, 'period.fiscal-year': 2021, 'period.instant': '2021-06-30', 'period.start': None, 'period.end': None,
+                 'cube.description': str(statement_id), 'cube.tree-sequence': i,
+                 'report.entity-name': 'Report {}'.format(report_id), 'dimensions.count': 0, 'dimension-pair': None,
+                 'cube.primary-local-name': 'C{}'.format(i), 'fact.value': str(i), 'unit': 'USD'} for i in range(start, end)]
+
+    def handle(self, path, query):
+        if path == xbrl_ingest.TOKEN_PATH:
+            return 200, {}, {'access_token': 'token', 'refresh_token': 'refresh'}
+        if path == xbrl_ingest.REPORT_SEARCH_PATH:
+            return 200, {}, {'data': [{'report.id': int(report_id), 'report.filing-date': '2022-01-01'} for report_id in query['report.id'][0].split(',')]}
+        report_id, statement_id = int(query['report.id'][0]), int(query['cube.description'][0])
+        match = re.search(r'cube\.offset\((\d+)\)', query['fields'][0])
+        offset = int(match.group(1)) if match else 0
+        self.requests.append((report_id, statement_id, offset))
+        pending = self.failures.get((report_id, statement_id, offset))
+        if pending:
+            return pending.pop(0)
+        data = self.facts(report_id, statement_id, offset)
+        return 200, {}, {'data': data, 'paging': {'limit': self.page_size, 'offset': offset, 'count': min(self.page_size, self.rows[(report_id, statement_id)] - offset)}}
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    # Starts a stub in a background thread and returns its base URL
+    def start(stub):
+        class Handler(BaseHTTPRequestHandler):
+            def respond(self):
+                url = urlparse(self.path)
+                status, headers, body = stub.handle(url.path, parse_qs(url.query, keep_blank_values=True))
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self.respond()
+
+            do_GET = respond
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_fetch_partition_follows_pages(serve):
+    stub = StubAPI({(1, 10): 250})
+    base_url = serve(stub)
+    records = xbrl_ingest.fetch_partition(xbrl_ingest.make_session(1), 'token', 1, 10, base_url)
+    assert [record['cube.primary-local-name'] for record in records] == ['C{}'.format(i) for i in range(250)]
+    assert stub.requests == [(1, 10, 0), (1, 10, 100), (1, 10, 200)]
+
+
+def test_rate_limited_page_is_retried_after_retry_after(serve):
+    stub = StubAPI({(1, 10): 150}, failures={(1, 10, 100): [(429, {'Retry-After': '0'}, {'error': 'rate limited'})]})
+    base_url = serve(stub)
+    records = xbrl_ingest.fetch_partition(xbrl_ingest.make_session(1, backoff_factor=0), 'token', 1, 10, base_url)
+    assert len(records) == 150
+    assert stub.requests.count((1, 10, 100)) == 2
+
+
+def test_account_row_limit_warns_and_is_recorded(serve, tmp_path):
+    stub = StubAPI({(1, 10): 1500})
+    base_url = serve(stub)
+    with pytest.warns(UserWarning, match='reached the limit of 1000 rows'):
+        xbrl_ingest.sync('token', [1], [10], str(tmp_path), workers=1, base_url=base_url, session=xbrl_ingest.make_session(1))
+    assert xbrl_ingest.load_manifest(str(tmp_path))['partitions']['1:10']['truncated'] is True
+    assert len(xbrl_ingest.load_fact_store(str(tmp_path))) == 1000
+
+
+def test_sync_resumes_from_manifest_and_drops_duplicates(serve, tmp_path):
+    error = (200, {}, {'error': 'server', 'error_description': 'temporary failure'})
+    stub = StubAPI({(1, 10): 350, (2, 10): 50}, duplicates=5, failures={(1, 10, 200): [error]})
+    base_url = serve(stub)
+    session = xbrl_ingest.make_session(1, retries=0)
+
+    with pytest.raises(RuntimeError, match='run again to resume'):
+        xbrl_ingest.sync('token', [1, 2], [10], str(tmp_path), workers=1, base_url=base_url, session=session)
+    partitions = xbrl_ingest.load_manifest(str(tmp_path))['partitions']
+    assert partitions['1:10']['status'] == 'fetching' and partitions['1:10']['offset'] == 200
+    assert partitions['2:10']['status'] == 'complete'
+
+    stub.requests.clear()
+    result = xbrl_ingest.sync('token', [1, 2], [10], str(tmp_path), workers=1, base_url=base_url, session=session)
+    assert result['fetched'] == [(1, 10)]
+    assert stub.requests == [(1, 10, 200), (1, 10, 300)] # pages before the interruption are not fetched again
+
+    facts = xbrl_ingest.load_fact_store(str(tmp_path), report_ids=[1])
+    assert len(facts) == 350
+    assert sorted(facts['fact.value'].astype(int)) == list(range(350))
+    assert xbrl_ingest.load_manifest(str(tmp_path))['partitions']['1:10']['truncated'] is False
+
+
+# Function to save records as the fetched pages of a partition, ready to publish (see `xbrl_ingest._publish_partition`)
+def save_pages(store_dir, report_id, statement_id, pages):
+    partial_dir = xbrl_ingest.partition_dir(store_dir, report_id, statement_id) + '.partial'
+    os.makedirs(partial_dir)
+    for number, records in enumerate(pages):
+        xbrl_ingest.normalize_facts(records).to_parquet(os.path.join(partial_dir, 'page-{:08d}.parquet'.format(number)), index=False)
+
+
+def test_publish_partition_keeps_latest_version_of_each_fact(tmp_path):
+    def fact(concept, value, instant='2021-06-30', start=None, end=None, member=None):
+        return {'report.id': 1, 'period.fiscal-year': 2021, 'period.instant': instant, 'period.start': start, 'period.end': end,
+                'cube.description': '10', 'cube.tree-sequence': 1, 'report.entity-name': 'Report 1', 'dimensions.count': 1 if member else 0,
+                'dimension-pair': [{'dimension': 'acfr:FundAxis', 'member': member}] if member else None,
+                'cube.primary-local-name': concept, 'fact.value': str(value), 'unit': 'USD', 'cube_id': 10}
+
+    # Beginning & ending balances of the same concept & member in the same fiscal year are different facts;
+    # a fact repeated on the next page with a new value keeps the new value
+    save_pages(str(tmp_path), 1, 10, [
+        [fact('CapitalAssetsNet', 100, instant='2020-06-30', member='acfr:GovernmentalActivitiesMember'),
+         fact('CapitalAssetsNet', 120, member='acfr:GovernmentalActivitiesMember'),
+         fact('Revenues', 50, start='2020-07-01', end='2021-06-30', instant=None)],
+        [fact('Revenues', 55, start='2020-07-01', end='2021-06-30', instant=None),
+         fact('Revenues', 7, start='2020-07-01', end='2021-06-30', instant=None, member='acfr:GeneralFundMember')],
+    ])
+    xbrl_ingest._publish_partition(str(tmp_path), 1, 10)
+    facts = xbrl_ingest.load_fact_store(str(tmp_path))
+    assert list(zip(facts['cube.primary-local-name'], facts['fact.value'])) == [('CapitalAssetsNet', 100), ('CapitalAssetsNet', 120), ('Revenues', 55), ('Revenues', 7)]
+
+
+def test_main_exports_only_requested_reports(serve, tmp_path, monkeypatch):
+    stub = StubAPI({(1, 10): 20, (2, 10): 30})
+    base_url = serve(stub)
+    for name in ['XBRL_EMAIL', 'XBRL_PASSWORD', 'XBRL_CLIENT_ID', 'XBRL_CLIENT_SECRET']:
+        monkeypatch.setenv(name, 'x')
+    store, output = str(tmp_path / 'store'), str(tmp_path / 'xbrl_data.csv')
+    arguments = ['--statement-ids', '10', '--store', store, '--output', output, '--base-url', base_url, '--workers', '1']
+
+    xbrl_ingest.main(['--report-ids', '1', '2'] + arguments)
+    assert sorted(pd.read_csv(output)['report.id'].unique()) == [1, 2]
+
+    # Report 2 is still in the fact store, but only the requested report is exported
+    xbrl_ingest.main(['--report-ids', '1'] + arguments)
+    exported = pd.read_csv(output)
+    assert list(exported['report.id'].unique()) == [1]
+    assert len(exported) == 20
@@ -1,28 +1,266 @@
 import ast
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+import metrics
+
+# Function to parse a single `dimension-pair` value into a list of (axis, member) pairs
+# Accepts the list of dictionaries returned by the XBRL API, or its string representation from older CSV files
+def parse_dimension_pair(dimension_pair):
+    if isinstance(dimension_pair, str):
+        dimension_pair = ast.literal_eval(dimension_pair)
+    if not isinstance(dimension_pair, (list, tuple)):
+        return [] # rows without dimensions are stored as NaN/None
+    return [next(iter(pair.items())) if isinstance(pair, dict) else (None, pair) for pair in dimension_pair]
+
+# Function to replace the `dimension-pair` column with explicit `axis1`, `member1`, `axis2`, `member2`, ... columns (NOTE: run at ingest time)
+# One axis/member column pair is added for every dimension, up to the largest dimension count in the data; unused columns are empty
+def flatten_dimensions(df):
+    df = df.copy()
+    pairs = df['dimension-pair'].map(parse_dimension_pair)
+    dim_count = int(pairs.map(len).max()) if len(pairs) else 0
+    for i in range(dim_count):
+        df['axis{}'.format(i + 1)] = pairs.map(lambda x: x[i][0] if len(x) > i else None)
+        df['member{}'.format(i + 1)] = pairs.map(lambda x: x[i][1] if len(x) > i else None)
+    return df.drop(columns='dimension-pair')
+
+# Function to make sure the DataFrame has explicit member columns (NOTE: only CSV files written before `flatten_dimensions` existed need converting)
+def ensure_dimension_columns(df):
+    if 'dimension-pair' in df.columns and 'member1' not in df.columns:
+        return flatten_dimensions(df)
+    return df
+
+# Function to list the `member1`, `member2`, ... columns in the DataFrame, in order
+def member_columns(df):
+    return sorted([column for column in df.columns if column.startswith('member') and column[len('member'):].isdigit()], key=lambda column: int(column[len('member'):]))
+
+# Function to list the `axis1`, `member1`, `axis2`, `member2`, ... columns in the DataFrame, in order
+def axis_member_columns(df):
+    return [column for member in member_columns(df) for column in ['axis' + member[len('member'):], member] if column in df.columns]
+
+# Columns of `xbrl_data.csv` read by the ratio calculations, and the type each is loaded as (see `load_fact_table`)
+# Repeated strings are loaded as categories (each distinct string is stored once), IDs & years as the smallest integer type that fits them
+# IDs & years are read as nullable integers so a blank cell does not fail the load; rows missing one are dropped (see `_drop_incomplete_facts`)
+# NOTE: The member columns (`member1`, `member2`, ...) are loaded as categories too; every other column is skipped
+FACT_TABLE_SCHEMA = {
+    'report.id': 'Int32',
+    'period.fiscal-year': 'Int16',
+    'report.entity-name': 'category',
+    'dimensions.count': 'Int8',
+    'cube.primary-local-name': 'category',
+    'fact.value': 'float64',
+}
+
+# Function to load `xbrl_data.csv` with only the columns & compact types in `FACT_TABLE_SCHEMA`, for the ratio calculations
+# Uses a fraction of the memory of `pd.read_csv` with default types; CSV files written before `flatten_dimensions` existed are converted
+# NOTE: If `chunksize` is given, returns an iterator of DataFrames of up to `chunksize` rows instead (see `pd.read_csv`)
+def load_fact_table(csv_path, chunksize=None):
+    header = pd.read_csv(csv_path, nrows=0)
+    members = member_columns(header)
+    dtype = dict(FACT_TABLE_SCHEMA, **{member: 'category' for member in members})
+    usecols = [column for column in header.columns if column in dtype or column == 'dimension-pair']
+    if chunksize is not None:
+        return (_compact_dimensions(_drop_incomplete_facts(chunk)) for chunk in pd.read_csv(csv_path, usecols=usecols, dtype=dtype, chunksize=chunksize))
+    return _compact_dimensions(_drop_incomplete_facts(pd.read_csv(csv_path, usecols=usecols, dtype=dtype)))
+
+# Integer columns of `FACT_TABLE_SCHEMA` that every fact needs: the report & year it belongs to, and how many dimensions it has
+REQUIRED_FACT_COLUMNS = ['report.id', 'period.fiscal-year', 'dimensions.count']
+
+# Function to drop the facts missing a value in `REQUIRED_FACT_COLUMNS` (they cannot be attributed to a report or year), with a warning
+# naming the municipalities they belong to, then convert those columns to plain (non-nullable) integers of the same size
+def _drop_incomplete_facts(df):
+    required = [column for column in REQUIRED_FACT_COLUMNS if column in df.columns]
+    incomplete = df[required].isna().any(axis=1)
+    if incomplete.any():
+        entities = df.loc[incomplete, 'report.entity-name'].astype(object).fillna('(unknown)').value_counts() if 'report.entity-name' in df.columns else pd.Series(dtype=int)
+        warnings.warn('Dropped {} facts missing a report ID, fiscal year or dimension count: {}'.format(
+            int(incomplete.sum()), ', '.join('{} ({})'.format(entity, count) for entity, count in entities.items()) or 'no municipality name'))
+        df = df[~incomplete]
+    return df.astype({column: str(df[column].dtype).lower() for column in required})
+
+# Function to convert the `dimension-pair` column of older CSV files into categorical member columns (see `load_fact_table`)
+def _compact_dimensions(df):
+    if 'dimension-pair' in df.columns:
+        df = ensure_dimension_columns(df)
+        df = df.drop(columns=[column for column in axis_member_columns(df) if column.startswith('axis')])
+        df = df.astype({member: 'category' for member in member_columns(df)})
+    return df
 
 # Function to preprocess the DataFrame from its raw CSV format (NOTE: filters for dimension count of 1 by default)
 def process_dataframe(df, dim = 1):
+    df = ensure_dimension_columns(df)
+
     # Filter dataframe to only include rows where `dimensions.count` is equal to `dim`
-    df = df[df['dimensions.count'] == dim]
-    
-    # Apply ast.literal_eval to 'dimension-pair' column to convert string representation of dictionary to dictionary
-    # This is necessary because CSV files store dictionaries and other nested data structures as strings
-    df['dimension-pair'] = df['dimension-pair'].apply(ast.literal_eval)
-    
+    df = df[df['dimensions.count'] == dim].copy()
+
     if dim == 1:
-        # Create a new column 'fund-member' by extracting the value from the first dictionary in 'dimension-pair' column
-        df['fund-member'] = df['dimension-pair'].apply(lambda x: x[0][list(x[0].keys())[0]])
-    elif dim == 2:
-        # Extract nested values (fund-member names) from dictionaries within list (ex: [{'key':value}, {'key':value}]) in 'dimension-pair' column
-        df['fund-member1'] = df['dimension-pair'].apply(lambda x: list(x[0].values())[0] if isinstance(x[0], dict) else x[0])
-        df['fund-member2'] = df['dimension-pair'].apply(lambda x: list(x[1].values())[0] if isinstance(x[1], dict) else x[1])
+        # Create a new column 'fund-member' from the member of the only dimension
+        df['fund-member'] = df['member1']
     else:
-        # Raise an error if the dimension count is not 1 or 2, as we have only encountered these two cases thus far
-        raise ValueError('Invalid dimension count -- Please specify a dimension count of 1 or 2, or add a new preprocessing option.')
+        # Create new columns 'fund-member1', 'fund-member2', ... from the member of each dimension
+        for i in range(1, dim + 1):
+            df['fund-member{}'.format(i)] = df['member{}'.format(i)] if 'member{}'.format(i) in df.columns else None
     
     return df
 
 
+# Function to build a fact index from the raw CSV DataFrame (NOTE: run once at startup, then pass the index to the ratio functions)
+# The cost of a lookup no longer depends on the size of the dataset
+# Index keys & values are as follows:
+# `entities`: report ID -> name of the municipality
+# `fiscal_years`: report ID -> latest fiscal year reported (the year the population is looked up for, see `join_populations`)
+# `facts`: (report ID, `cube.primary-local-name`, member(s), `period.fiscal-year`) -> first `fact.value` reported for that key
+# `series`: (report ID, `cube.primary-local-name`, member(s)) -> list of (`period.fiscal-year`, `fact.value`) in the order they were reported
+# NOTE: member(s) is a tuple of the member names of each dimension, e.g. ('GeneralFundMember',) for a dimension count of 1
+def build_fact_index(df):
+    df = ensure_dimension_columns(df)
+    entities = {}
+    fiscal_years = {}
+    facts = {}
+    series = {}
+
+    columns = ['report.id', 'report.entity-name', 'cube.primary-local-name', 'period.fiscal-year', 'fact.value'] + member_columns(df)
+    for report_id, entity_name, concept, fiscal_year, value, *members in df[columns].itertuples(index=False, name=None):
+        report_id = int(report_id)
+        entities.setdefault(report_id, entity_name)
+        fiscal_years[report_id] = max(fiscal_years.get(report_id, int(fiscal_year)), int(fiscal_year))
+
+        # Unused member columns are empty (NaN)
+        members = tuple(member for member in members if isinstance(member, str))
+
+        facts.setdefault((report_id, concept, members, int(fiscal_year)), value)
+        series.setdefault((report_id, concept, members), []).append((int(fiscal_year), value))
+
+    return {'entities': entities, 'fiscal_years': fiscal_years, 'facts': facts, 'series': series}
+
+# Function to accept either a fact index or a raw DataFrame in the ratio functions (NOTE: passing a DataFrame rebuilds the index on every call)
+def as_fact_index(data):
+    if isinstance(data, dict):
+        return data
+    return build_fact_index(data)
+
+# Function to normalize member(s) to the tuple form used as part of the fact index keys
+def _members_key(members):
+    if isinstance(members, str):
+        return (members,)
+    return tuple(members)
+
+# Function to look up the name of a municipality in the fact index
+def lookup_entity(index, report_id):
+    return index['entities'][int(report_id)]
+
+# Function to look up a single `fact.value` in the fact index (raises `KeyError` if the fact was not reported)
+# If `fiscal_year` is not given, the first value reported for the concept & member(s) is returned
+def lookup_fact(index, report_id, concept, members, fiscal_year=None):
+    members = _members_key(members)
+    if fiscal_year is None:
+        return index['series'][(int(report_id), concept, members)][0][1]
+    return index['facts'][(int(report_id), concept, members, int(fiscal_year))]
+
+# Function to look up every (`period.fiscal-year`, `fact.value`) pair reported for a concept & member(s), in the order they were reported
+def lookup_fact_series(index, report_id, concept, members):
+    return index['series'].get((int(report_id), concept, _members_key(members)), [])
+
+
+# Columns of the `final_ratios` DataFrame (one row per municipality & ratio)
+RATIO_COLUMNS = ['report_id', 'report_entity_name', 'ratio', 'value', 'green_start', 'green_end', 'yellow_start', 'yellow_end', 'red_start', 'red_end', 'var_1_name', 'var_1_value', 'var_2_name', 'var_2_value', 'unavailable_reason']
+
+# Target ranges & variable names for each financial ratio/metric, in the order the gauges are numbered (gauge-plot1, gauge-plot2, ...)
+# NOTE: Shared by the single-report ratio functions and the batch engine (`compute_ratios`) so the two can never disagree
+RATIO_TARGETS = {
+    'Short Run Financial Position': {
+        'green_start': 0.15, 'green_end': 0.2, # green target range
+        'yellow_start': 0.2, 'yellow_end': 1, # yellow range
+        'red_start': 0, 'red_end': 0.15, # red range
+        'var_1_name': 'General Fund Balance Unassigned', # numerator
+        'var_2_name': 'General Fund Revenue'}, # denominator
+    'Days of Cash on Hand': {
+        'green_start': 125, 'green_end': 500,
+        'yellow_start': 90, 'yellow_end': 125,
+        'red_start': 0, 'red_end': 90,
+        'var_1_name': 'Cash and Cash Equivalents',
+        'var_2_name': 'Expenditures / 365'},
+    'Liquidity (Quick) Ratio': {
+        'green_start': 2, 'green_end': 10,
+        'yellow_start': 1, 'yellow_end': 2,
+        'red_start': 0, 'red_end': 1,
+        'var_1_name': 'Cash and Cash Equivalents',
+        'var_2_name': 'Liabilities - Deferred Revenue'},
+    'Governmental Funds Debt Coverage': {
+        'green_start': 0, 'green_end': 0.1,
+        'yellow_start': 0.1, 'yellow_end': 0.15,
+        'red_start': 0.15, 'red_end': 0.5,
+        'var_1_name': 'Debt Service Expenditures',
+        'var_2_name': 'Total Expenditures - Capital Outlay - Debt Service Expenditures'},
+    'Expenditure per Capita': {
+        'green_start': 500, 'green_end': 1500,
+        'yellow_start': 100, 'yellow_end': 100,
+        'red_start': 0, 'red_end': 500,
+        'var_1_name': 'Total Expenditures',
+        'var_2_name': 'Population'},
+    'Net Asset Growth (Governmental Activities)': {
+        'green_start': 0.02, 'green_end': 0.5,
+        'yellow_start': 0.0, 'yellow_end': 0.02,
+        'red_start': -0.5, 'red_end': 0.0,
+        'var_1_name': 'Governmental Activities Change in Net Position',
+        'var_2_name': 'Governmental Activities Beginning Net Position'},
+    'Capital Asset Condition (Governmental Activities)': {
+        'green_start': 0.02, 'green_end': 0.5,
+        'yellow_start': 0, 'yellow_end': 0.02,
+        'red_start': -1, 'red_end': 0,
+        'var_1_name': 'Ending Net Value - Beginning Net Value',
+        'var_2_name': 'Beginning Net Value'},
+    'Capital Asset Condition (Business-Type Activities)': {
+        'green_start': 0.02, 'green_end': 0.5,
+        'yellow_start': 0, 'yellow_end': 0.02,
+        'red_start': -1, 'red_end': 0,
+        'var_1_name': 'Ending Net Value - Beginning Net Value',
+        'var_2_name': 'Beginning Net Value'},
+    'Proportion of (Non) Own-Source Revenue': {
+        'green_start': 0, 'green_end': 0.60,
+        'yellow_start': 0.60, 'yellow_end': 0.80,
+        'red_start': 0.80, 'red_end': 1,
+        'var_1_name': 'Total Primary Government Operating Grants and Contributions',
+        'var_2_name': 'Total Primary Government Revenue'},
+}
+
+# Default location of the population reference table (NOTE: next to this file rather than the working directory, since it ships with the code)
+POPULATION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'population.csv')
+
+# Function to load the population reference table: one row per (report ID, fiscal year) with the population of the municipality
+# NOTE: `population.csv` also has an `entity_name` column, for people editing the file; it is not loaded
+def load_populations(csv_path=POPULATION_PATH):
+    dtype = {'report_id': 'int64', 'fiscal_year': 'int64', 'population': 'float64'}
+    if not os.path.exists(csv_path):
+        return pd.DataFrame({column: pd.Series(dtype=column_type) for column, column_type in dtype.items()})
+    table = pd.read_csv(csv_path, usecols=list(dtype), dtype=dtype).dropna()
+    return table.drop_duplicates(['report_id', 'fiscal_year'], keep='last')
+
+# Function to replace the population reference table used by the ratio calculations (see `POPULATIONS`)
+def set_populations(table):
+    global POPULATIONS, LATEST_POPULATIONS
+    table = table[['report_id', 'fiscal_year', 'population']].sort_values(['fiscal_year', 'report_id'], ignore_index=True)
+    LATEST_POPULATIONS = table.groupby('report_id')['population'].last().to_dict()
+    POPULATIONS = table
+
+# Population reference table (see `load_populations`), sorted by fiscal year for `join_populations`,
+# and the most recent population of each municipality (report ID -> population), e.g. for peer groups
+POPULATIONS = None
+LATEST_POPULATIONS = {}
+set_populations(load_populations())
+
+# Function to join the population of every (report ID, fiscal year) pair in one step, returning an array of populations (NaN if unknown)
+# Fiscal years missing from the table use the population of the nearest fiscal year of the same municipality
+def join_populations(report_ids, fiscal_years):
+    keys = pd.DataFrame({'report_id': np.asarray(report_ids, dtype='int64'), 'fiscal_year': np.asarray(fiscal_years, dtype='int64')})
+    keys['position'] = np.arange(len(keys))
+    joined = pd.merge_asof(keys.sort_values('fiscal_year', kind='stable'), POPULATIONS, on='fiscal_year', by='report_id', direction='nearest')
+    return joined.sort_values('position')['population'].to_numpy()
+
+
 # Below are the functions that calculate the ratios for the different financial health indicators.
 # Return statement keys & values are as follows:
 # `report_id`: ID of the municipality
@@ -39,223 +277,511 @@ def process_dataframe(df, dim = 1):
 # `var_1_value`: Value of the numerator variable
 # `var_2_name`: Name of the denominator used in the ratio calculation
 # `var_2_value`: Value of the denominator variable
+# `unavailable_reason`: Why the ratio could not be calculated (`value` is NaN), or None if it was
+#
+# Each function takes the fact index from `build_fact_index` (preferred) or the raw CSV DataFrame, and the report ID of the municipality
+# Every call is timed, and errors are counted per ratio (see `metrics.py`)
+
+# Function to build the dictionary returned by each ratio function (target ranges & variable names come from `RATIO_TARGETS`)
+def make_ratio_row(report_id, report_entity, ratio_name, value, var_1_value, var_2_value):
+    targets = RATIO_TARGETS[ratio_name]
+    return {'report_id': report_id, 'report_entity_name': report_entity,
+            'ratio': ratio_name, 'value': value,
+            'green_start': targets['green_start'], 'green_end': targets['green_end'],
+            'yellow_start': targets['yellow_start'], 'yellow_end': targets['yellow_end'],
+            'red_start': targets['red_start'], 'red_end': targets['red_end'],
+            'var_1_name': targets['var_1_name'], 'var_1_value': var_1_value,
+            'var_2_name': targets['var_2_name'], 'var_2_value': var_2_value,
+            'unavailable_reason': None}
 
 # Short Run Financial Position
-def get_short_run(df, report_id):
-    df = process_dataframe(df) # process DataFrame
-    report_entity = df[df['report.id'] == int(report_id)].iloc[0]['report.entity-name'] # name of municipality
+@metrics.timed('ratio_function_seconds', {'ratio': 'Short Run Financial Position', 'engine': 'lookup'}, 'ratio_function_failures_total')
+def get_short_run(facts, report_id):
+    facts = as_fact_index(facts) # fact index
+    report_entity = lookup_entity(facts, report_id) # name of municipality
 
-    # Extract appropriate `fact.value` by filtering through `cube.primary-local-name` and `fund-member` columns
+    # Look up appropriate `fact.value` by `cube.primary-local-name` and `fund-member`
     # Note: Should be replicable for any reportID (municipality) with the same XBRL format
-    balance_unassigned = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'FundBalanceUnassigned') & (df['fund-member'] == 'GeneralFundMember')].iloc[0]['fact.value']
-    fund_revenue = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'RevenuesModifiedAccrual') & (df['fund-member'] == 'GeneralFundMember')].iloc[0]['fact.value']    
+    balance_unassigned = lookup_fact(facts, report_id, 'FundBalanceUnassigned', 'GeneralFundMember')
+    fund_revenue = lookup_fact(facts, report_id, 'RevenuesModifiedAccrual', 'GeneralFundMember')
 
     # Calculate ratio
     ratio = balance_unassigned / fund_revenue
 
     # Return dictionary with relevant information
-    return {'report_id': report_id, 'report_entity_name' : report_entity,
-            'ratio': 'Short Run Financial Position', 'value': ratio,
-            'green_start': 0.15, 'green_end': 0.2, # green target range
-            'yellow_start': 0.2, 'yellow_end': 1, # yellow range
-            'red_start': 0, 'red_end': 0.15, # red range
-            'var_1_name':'General Fund Balance Unassigned', 'var_1_value':balance_unassigned, # numerator
-            'var_2_name':'General Fund Revenue', 'var_2_value': fund_revenue} # denominator
+    return make_ratio_row(report_id, report_entity, 'Short Run Financial Position', ratio, balance_unassigned, fund_revenue)
     
 # Days of Cash on Hand
-def get_days_cash_on_hand(df, report_id):
-    df = process_dataframe(df) # process DataFrame
-    report_entity = df[df['report.id'] == int(report_id)].iloc[0]['report.entity-name']
+@metrics.timed('ratio_function_seconds', {'ratio': 'Days of Cash on Hand', 'engine': 'lookup'}, 'ratio_function_failures_total')
+def get_days_cash_on_hand(facts, report_id):
+    facts = as_fact_index(facts) # fact index
+    report_entity = lookup_entity(facts, report_id)
 
-    # Extract appropriate `fact.value` by filtering through `cube.primary-local-name` and `fund-member` columns
-    cash_and_cash_equivalents = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'CashAndCashEquivalentsModifiedAccrual') & (df['fund-member'] == 'GeneralFundMember')].iloc[0]['fact.value']
-    expenditures = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'ExpendituresModifiedAccrual') & (df['fund-member'] == 'GeneralFundMember')].iloc[0]['fact.value']
+    # Look up appropriate `fact.value` by `cube.primary-local-name` and `fund-member`
+    cash_and_cash_equivalents = lookup_fact(facts, report_id, 'CashAndCashEquivalentsModifiedAccrual', 'GeneralFundMember')
+    expenditures = lookup_fact(facts, report_id, 'ExpendituresModifiedAccrual', 'GeneralFundMember')
     
     # Calculate ratio
     ratio = cash_and_cash_equivalents / (expenditures / 365)
 
     # Return dictionary with relevant information
-    return {'report_id': report_id, 'report_entity_name' : report_entity,
-            'ratio': 'Days of Cash on Hand', 'value': ratio,
-            'green_start': 125, 'green_end': 500,
-            'yellow_start': 90, 'yellow_end': 125,
-            'red_start': 0, 'red_end': 90,
-            'var_1_name':'Cash and Cash Equivalents', 'var_1_value': cash_and_cash_equivalents,
-            'var_2_name':'Expenditures / 365', 'var_2_value': expenditures/365}
+    return make_ratio_row(report_id, report_entity, 'Days of Cash on Hand', ratio, cash_and_cash_equivalents, expenditures/365)
     
 # Liquidity (Quick) Ratio
-def get_liquidity(df, report_id):
-    df = process_dataframe(df) # process DataFrame
-
-    # Extract appropriate `fact.value` by filtering through `cube.primary-local-name` and `fund-member` columns
-    report_entity = df[df['report.id'] == int(report_id)].iloc[0]['report.entity-name']
-    cash_and_cash_equivalents = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'CashAndCashEquivalentsModifiedAccrual') & (df['fund-member'] == 'GeneralFundMember')].iloc[0]['fact.value']
-    liabilities = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'LiabilitiesModifiedAccrual') & (df['fund-member'] == 'GeneralFundMember')].iloc[0]['fact.value']
-    deferred_revenue = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'DeferredInflowsOfResourcesModifiedAccrual') & (df['fund-member'] == 'GeneralFundMember')].iloc[0]['fact.value']
+@metrics.timed('ratio_function_seconds', {'ratio': 'Liquidity (Quick) Ratio', 'engine': 'lookup'}, 'ratio_function_failures_total')
+def get_liquidity(facts, report_id):
+    facts = as_fact_index(facts) # fact index
+
+    # Look up appropriate `fact.value` by `cube.primary-local-name` and `fund-member`
+    report_entity = lookup_entity(facts, report_id)
+    cash_and_cash_equivalents = lookup_fact(facts, report_id, 'CashAndCashEquivalentsModifiedAccrual', 'GeneralFundMember')
+    liabilities = lookup_fact(facts, report_id, 'LiabilitiesModifiedAccrual', 'GeneralFundMember')
+    deferred_revenue = lookup_fact(facts, report_id, 'DeferredInflowsOfResourcesModifiedAccrual', 'GeneralFundMember')
     
     # Calculate ratio
     ratio = cash_and_cash_equivalents / (liabilities - deferred_revenue)
 
     # Return dictionary with relevant information
-    return {'report_id': report_id, 'report_entity_name': report_entity,
-            'ratio': 'Liquidity (Quick) Ratio', 'value': ratio,
-            'green_start': 2, 'green_end': 10, 
-            'yellow_start': 1, 'yellow_end': 2,
-            'red_start': 0, 'red_end': 1,
-            'var_1_name':'Cash and Cash Equivalents', 'var_1_value': cash_and_cash_equivalents,
-            'var_2_name':'Liabilities - Deferred Revenue', 'var_2_value': liabilities-deferred_revenue}
+    return make_ratio_row(report_id, report_entity, 'Liquidity (Quick) Ratio', ratio, cash_and_cash_equivalents, liabilities-deferred_revenue)
     
 # Governmental Funds Debt Coverage
-def get_gov_debt_coverage(df, report_id):
-    df = process_dataframe(df) # process DataFrame
-    report_entity = df[df['report.id'] == int(report_id)].iloc[0]['report.entity-name']
-
-    # Extract appropriate `fact.value` by filtering through `cube.primary-local-name` and `fund-member` columns
-    debt_serv_expenditures = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'DebtServicePrincipalRepaymentModifiedAccrual') & (df['fund-member'] == 'GovernmentalFundsMember')].iloc[0]['fact.value'] \
-        + df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'DebtServiceInterestAndFiscalChargesModifiedAccrual') & (df['fund-member'] == 'GovernmentalFundsMember')].iloc[0]['fact.value']
-    total_expenditures = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'ExpendituresModifiedAccrual') & (df['fund-member'] == 'GovernmentalFundsMember')].iloc[0]['fact.value']
+@metrics.timed('ratio_function_seconds', {'ratio': 'Governmental Funds Debt Coverage', 'engine': 'lookup'}, 'ratio_function_failures_total')
+def get_gov_debt_coverage(facts, report_id):
+    facts = as_fact_index(facts) # fact index
+    report_entity = lookup_entity(facts, report_id)
+
+    # Look up appropriate `fact.value` by `cube.primary-local-name` and `fund-member`
+    debt_serv_expenditures = lookup_fact(facts, report_id, 'DebtServicePrincipalRepaymentModifiedAccrual', 'GovernmentalFundsMember') \
+        + lookup_fact(facts, report_id, 'DebtServiceInterestAndFiscalChargesModifiedAccrual', 'GovernmentalFundsMember')
+    total_expenditures = lookup_fact(facts, report_id, 'ExpendituresModifiedAccrual', 'GovernmentalFundsMember')
     
     try: # account for missing Capital Outlay data
-        capital_outlay = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'ExpendituresForCapitalOutlayModifiedAccrual') & (df['fund-member'] == 'GovernmentalFundsMember')].iloc[0]['fact.value']
-    except:
+        capital_outlay = lookup_fact(facts, report_id, 'ExpendituresForCapitalOutlayModifiedAccrual', 'GovernmentalFundsMember')
+    except KeyError:
         capital_outlay = 0
+        metrics.inc('ratio_fallbacks_total', {'ratio': 'Governmental Funds Debt Coverage', 'input': 'capital_outlay', 'engine': 'lookup'})
 
     # Calculate ratio
     ratio = debt_serv_expenditures / (total_expenditures - capital_outlay - debt_serv_expenditures)
 
     # Return dictionary with relevant information
-    return {'report_id': report_id, 'report_entity_name': report_entity,
-            'ratio': 'Governmental Funds Debt Coverage', 'value': ratio,
-            'green_start': 0, 'green_end': 0.1,
-            'yellow_start': 0.1, 'yellow_end': 0.15,
-            'red_start': 0.15, 'red_end': 0.5,
-            'var_1_name':'Debt Service Expenditures', 'var_1_value': debt_serv_expenditures, 
-            'var_2_name':'Total Expenditures - Capital Outlay - Debt Service Expenditures', 'var_2_value': (total_expenditures - capital_outlay - debt_serv_expenditures)}
+    return make_ratio_row(report_id, report_entity, 'Governmental Funds Debt Coverage', ratio, debt_serv_expenditures, (total_expenditures - capital_outlay - debt_serv_expenditures))
         
 # Expense per Capita
-def get_expenditure_per_capita(df, report_id):
-    df = process_dataframe(df) # process DataFrame
-    report_entity = df[df['report.id'] == int(report_id)].iloc[0]['report.entity-name']
+@metrics.timed('ratio_function_seconds', {'ratio': 'Expenditure per Capita', 'engine': 'lookup'}, 'ratio_function_failures_total')
+def get_expenditure_per_capita(facts, report_id):
+    facts = as_fact_index(facts) # fact index
+    report_entity = lookup_entity(facts, report_id)
 
-    # Extract appropriate `fact.value` by filtering through `cube.primary-local-name` and `fund-member` columns
-    total_expenditures = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'ExpendituresModifiedAccrual') & (df['fund-member'] == 'GovernmentalFundsMember')].iloc[0]['fact.value']
+    # Look up appropriate `fact.value` by `cube.primary-local-name` and `fund-member`
+    total_expenditures = lookup_fact(facts, report_id, 'ExpendituresModifiedAccrual', 'GovernmentalFundsMember')
     
-    # Assign default population values based on report ID
-     # NOTE: Hardcoded population values for Flint & Ogemaw County
-    if int(report_id) == 677268: # Ogemaw County
-        population = 20726  
-    elif int(report_id) == 677267: # Flint
-        population = 83300  
-    else:
-        population = 0  # Default population value
+    # Population for the latest fiscal year of the report (see `POPULATIONS`), NaN if the municipality is not in the population table
+    population = join_populations([report_id], [facts['fiscal_years'][int(report_id)]])[0]
     
     # Calculate ratio
     ratio = total_expenditures / population
 
     # Return dictionary with relevant information
-    return {'report_id': report_id, 'report_entity_name': report_entity,
-            'ratio': 'Expenditure per Capita', 'value': ratio,
-            'green_start': 500, 'green_end': 1500,
-            'yellow_start':100 , 'yellow_end': 100,
-            'red_start': 0, 'red_end': 500,
-            'var_1_name':'Total Expenditures', 'var_1_value': total_expenditures, 
-            'var_2_name':'Population', 'var_2_value': population}
+    return make_ratio_row(report_id, report_entity, 'Expenditure per Capita', ratio, total_expenditures, population)
     
 # Net Asset Growth (Governmental Activities)
-def get_net_asset_growth(df, report_id):
-    df = process_dataframe(df) # process DataFrame
-    report_entity = df[df['report.id'] == int(report_id)].iloc[0]['report.entity-name']
+@metrics.timed('ratio_function_seconds', {'ratio': 'Net Asset Growth (Governmental Activities)', 'engine': 'lookup'}, 'ratio_function_failures_total')
+def get_net_asset_growth(facts, report_id):
+    facts = as_fact_index(facts) # fact index
+    report_entity = lookup_entity(facts, report_id)
 
-    # Extract appropriate `fact.value` by filtering through `cube.primary-local-name` and `fund-member` columns
-    change_net_position = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'ChangesInNetPosition') & (df['fund-member'] == 'GovernmentalActivitiesMember')].iloc[0]['fact.value']
-    begin_net_position = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'NetPositionAtBeginningOfPeriodAfterAdjustments') & (df['fund-member'] == 'GovernmentalActivitiesMember')].iloc[0]['fact.value']
+    # Look up appropriate `fact.value` by `cube.primary-local-name` and `fund-member`
+    change_net_position = lookup_fact(facts, report_id, 'ChangesInNetPosition', 'GovernmentalActivitiesMember')
+    begin_net_position = lookup_fact(facts, report_id, 'NetPositionAtBeginningOfPeriodAfterAdjustments', 'GovernmentalActivitiesMember')
     
     # Calculate ratio
     ratio = -change_net_position / begin_net_position
     
     # Return dictionary with relevant information
-    return {'report_id': report_id, 'report_entity_name': report_entity,
-            'ratio': 'Net Asset Growth (Governmental Activities)', 'value': ratio,
-            'green_start': 0.02, 'green_end': 0.5,
-            'yellow_start': 0.0, 'yellow_end': 0.02,
-            'red_start': -0.5, 'red_end': 0.0,
-            'var_1_name':'Governmental Activities Change in Net Position', 'var_1_value':change_net_position, 
-            'var_2_name':'Governmental Activities Beginning Net Position', 'var_2_value':begin_net_position}
+    return make_ratio_row(report_id, report_entity, 'Net Asset Growth (Governmental Activities)', ratio, change_net_position, begin_net_position)
     
 # (Non) Own-Source Revenue
-def get_own_source_rev(df, report_id):
-    df = df[df['report.id'] == int(report_id)]
-    report_entity = df[df['report.id'] == int(report_id)].iloc[0]['report.entity-name']
+@metrics.timed('ratio_function_seconds', {'ratio': 'Proportion of (Non) Own-Source Revenue', 'engine': 'lookup'}, 'ratio_function_failures_total')
+def get_own_source_rev(facts, report_id):
+    facts = as_fact_index(facts) # fact index
+    report_entity = lookup_entity(facts, report_id)
 
-    # Extract appropriate `fact.value` by filtering through `cube.primary-local-name` and `fund-member` columns
-    total_rev = process_dataframe(df) # process DataFrame
-    total_rev = total_rev[(total_rev['cube.primary-local-name'] == 'NetExpenseRevenue') & (total_rev['fund-member'] == 'PrimaryGovernmentActivitiesMember')].iloc[0]['fact.value']
+    # Look up appropriate `fact.value` by `cube.primary-local-name` and `fund-member`
+    total_rev = lookup_fact(facts, report_id, 'NetExpenseRevenue', 'PrimaryGovernmentActivitiesMember')
 
-    # NOTE: Dimension count is 2 for this value -- preprocessing steps are slightly different
-    total_op_grants = process_dataframe(df, dim=2) # process DataFrame with dimension count of 2
-    # Extract appropriate `fact.value` by filtering through `cube.primary-local-name` and `fund-member` columns
-    total_op_grants = total_op_grants[(df['cube.primary-local-name'] == 'ProgramRevenues') & ((total_op_grants['fund-member1'] == 'PrimaryGovernmentActivitiesMember')) & (total_op_grants['fund-member2'] == 'ProgramRevenuesFromOperatingGrantsAndContributionsMember')].iloc[0]['fact.value']
+    # NOTE: Dimension count is 2 for this value -- both members are part of the lookup key
+    total_op_grants = lookup_fact(facts, report_id, 'ProgramRevenues', ('PrimaryGovernmentActivitiesMember', 'ProgramRevenuesFromOperatingGrantsAndContributionsMember'))
 
     # Calculate ratio
     ratio = abs(total_op_grants / total_rev)
 
     # Return dictionary with relevant information
-    return {
-        'report_id': report_id, 'report_entity_name': report_entity,
-        'ratio': 'Proportion of (Non) Own-Source Revenue', 'value': ratio,
-        'green_start': 0, 'green_end': 0.60,
-        'yellow_start': 0.60, 'yellow_end': 0.80,
-        'red_start': 0.80, 'red_end': 1,
-        'var_1_name': 'Total Primary Government Operating Grants and Contributions', 'var_1_value': total_op_grants,
-        'var_2_name': 'Total Primary Government Revenue', 'var_2_value': total_rev,
-    }
+    return make_ratio_row(report_id, report_entity, 'Proportion of (Non) Own-Source Revenue', ratio, total_op_grants, total_rev)
+
+# Function to look up the beginning & ending net value of capital assets for a `fund-member`
+# NOTE: Uses the first two values reported for the member, ordered by `period.fiscal-year`
+def get_capital_asset_net_values(facts, report_id, member):
+    net_values = sorted(lookup_fact_series(facts, report_id, 'CapitalAssetsNetOfAccumulatedDepreciationAndAmortization', member)[:2], key=lambda pair: pair[0])
+    if len(net_values) < 2:
+        raise KeyError((int(report_id), 'CapitalAssetsNetOfAccumulatedDepreciationAndAmortization', member))
+    return net_values[0][1], net_values[1][1]
 
 # Capital Asset Condition (Governmental Activities)
-def get_captial_asset_ga(df, report_id):
-    df = process_dataframe(df) # process DataFrame
-    report_entity = df[df['report.id'] == int(report_id)].iloc[0]['report.entity-name']
+@metrics.timed('ratio_function_seconds', {'ratio': 'Capital Asset Condition (Governmental Activities)', 'engine': 'lookup'}, 'ratio_function_failures_total')
+def get_captial_asset_ga(facts, report_id):
+    facts = as_fact_index(facts) # fact index
+    report_entity = lookup_entity(facts, report_id)
 
-    # Extract appropriate `fact.value` by filtering through `cube.primary-local-name` and `fund-member` columns
-    net_values = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'CapitalAssetsNetOfAccumulatedDepreciationAndAmortization') & (df['fund-member'] == 'GovernmentalActivitiesMember')].iloc[:2].sort_values(by='period.fiscal-year')
-    beginning_net_value = net_values.iloc[0]['fact.value']
-    end_net_value = net_values.iloc[1]['fact.value']
+    # Look up beginning & ending `fact.value` for the `fund-member`
+    beginning_net_value, end_net_value = get_capital_asset_net_values(facts, report_id, 'GovernmentalActivitiesMember')
 
     # Calculate ratio
     captial_asset_ga = (end_net_value - beginning_net_value) / beginning_net_value
-    captial_asset_ga
 
     # Return dictionary with relevant information
-    return {
-        'report_id': report_id, 
-        'ratio': 'Capital Asset Condition (Governmental Activities)', 'value': captial_asset_ga, 
-        'green_start': 0.02, 'green_end': 0.5, 
-        'yellow_start': 0, 'yellow_end': 0.02,
-        'red_start': -1, 'red_end': 0, 
-        'var_1_name':'Ending Net Value - Beginning Net Value', 'var_1_value': (end_net_value - beginning_net_value), 
-        'var_2_name':'Beginning Net Value', 'var_2_value': beginning_net_value, 'report_entity_name': report_entity
-    }
+    return make_ratio_row(report_id, report_entity, 'Capital Asset Condition (Governmental Activities)', captial_asset_ga, (end_net_value - beginning_net_value), beginning_net_value)
     
 # Capital Asset Condition (Business-Type Activities)
-def get_captial_asset_bta(df, report_id):
-    df = process_dataframe(df) # process DataFrame
-    report_entity = df[df['report.id'] == int(report_id)].iloc[0]['report.entity-name']
+@metrics.timed('ratio_function_seconds', {'ratio': 'Capital Asset Condition (Business-Type Activities)', 'engine': 'lookup'}, 'ratio_function_failures_total')
+def get_captial_asset_bta(facts, report_id):
+    facts = as_fact_index(facts) # fact index
+    report_entity = lookup_entity(facts, report_id)
 
-    # Extract appropriate `fact.value` by filtering through `cube.primary-local-name` and `fund-member` columns
-    net_values = df[(df['report.id'] == int(report_id)) & (df['cube.primary-local-name'] == 'CapitalAssetsNetOfAccumulatedDepreciationAndAmortization') & (df['fund-member'] == 'BusinessTypeActivitiesMember')].iloc[:2].sort_values(by='period.fiscal-year')
-    beginning_net_value = net_values.iloc[0]['fact.value']
-    end_net_value = net_values.iloc[1]['fact.value']
+    # Look up beginning & ending `fact.value` for the `fund-member`
+    beginning_net_value, end_net_value = get_capital_asset_net_values(facts, report_id, 'BusinessTypeActivitiesMember')
 
     # Calculate ratio
     captial_asset_bta = (end_net_value - beginning_net_value) / beginning_net_value
-    captial_asset_bta
 
     # Return dictionary with relevant information
-    return {
-        'report_id': report_id,
-        'ratio': 'Capital Asset Condition (Business-Type Activities)', 'value': captial_asset_bta,
-        'green_start': 0.02, 'green_end': 0.5,
-        'yellow_start': 0, 'yellow_end': 0.02,
-        'red_start': -1, 'red_end': 0, 
-        'var_1_name':'Ending Net Value - Beginning Net Value', 'var_1_value': (end_net_value - beginning_net_value), 
-        'var_2_name':'Beginning Net Value', 'var_2_value': beginning_net_value, 'report_entity_name': report_entity
-    }
+    return make_ratio_row(report_id, report_entity, 'Capital Asset Condition (Business-Type Activities)', captial_asset_bta, (end_net_value - beginning_net_value), beginning_net_value)
+
+
+# Below is the batch engine that calculates every ratio for every municipality at once.
+# It produces the same rows as calling the ratio functions above for each report ID, but in a handful of vectorized
+# pivot/groupby passes over the fact table instead of one lookup per value.
+
+# Inputs used by the batch engine: column name -> (`cube.primary-local-name`, member(s))
+# NOTE: The first value reported for each input is used, matching `lookup_fact`
+BATCH_INPUTS = {
+    'gf_balance_unassigned': ('FundBalanceUnassigned', ('GeneralFundMember',)),
+    'gf_revenue': ('RevenuesModifiedAccrual', ('GeneralFundMember',)),
+    'gf_cash': ('CashAndCashEquivalentsModifiedAccrual', ('GeneralFundMember',)),
+    'gf_expenditures': ('ExpendituresModifiedAccrual', ('GeneralFundMember',)),
+    'gf_liabilities': ('LiabilitiesModifiedAccrual', ('GeneralFundMember',)),
+    'gf_deferred_inflows': ('DeferredInflowsOfResourcesModifiedAccrual', ('GeneralFundMember',)),
+    'gov_debt_principal': ('DebtServicePrincipalRepaymentModifiedAccrual', ('GovernmentalFundsMember',)),
+    'gov_debt_interest': ('DebtServiceInterestAndFiscalChargesModifiedAccrual', ('GovernmentalFundsMember',)),
+    'gov_expenditures': ('ExpendituresModifiedAccrual', ('GovernmentalFundsMember',)),
+    'gov_capital_outlay': ('ExpendituresForCapitalOutlayModifiedAccrual', ('GovernmentalFundsMember',)),
+    'ga_change_net_position': ('ChangesInNetPosition', ('GovernmentalActivitiesMember',)),
+    'ga_begin_net_position': ('NetPositionAtBeginningOfPeriodAfterAdjustments', ('GovernmentalActivitiesMember',)),
+    'pg_net_expense_revenue': ('NetExpenseRevenue', ('PrimaryGovernmentActivitiesMember',)),
+    'pg_operating_grants': ('ProgramRevenues', ('PrimaryGovernmentActivitiesMember', 'ProgramRevenuesFromOperatingGrantsAndContributionsMember')),
+}
+
+# Inputs that are reported as of the end of the previous fiscal year (ex: beginning net position), used by the multi-year ratio panel
+BATCH_PRIOR_YEAR_INPUTS = {'ga_begin_net_position'}
+
+# Capital asset inputs used by the batch engine: column prefix -> member (beginning & ending values are the first two reported, ordered by year)
+BATCH_CAPITAL_ASSET_INPUTS = {
+    'ga_capital_assets': 'GovernmentalActivitiesMember',
+    'bta_capital_assets': 'BusinessTypeActivitiesMember',
+}
+
+# Function to pick the report shown for each municipality, when a municipality filed several reports (e.g. one ACFR per fiscal year)
+# The dashboard, peer index & search index are keyed by entity name, so each name maps to exactly one report: the report with the
+# most recent fiscal year, or the highest report ID if two reports cover the same year
+# `reports`: DataFrame with `report_id`, `report_entity_name` & `fiscal_year` (latest fiscal year of the report) columns
+# Returns the set of report IDs to keep
+def latest_report_ids(reports):
+    latest = reports.sort_values(['fiscal_year', 'report_id'], kind='stable', na_position='first').drop_duplicates('report_entity_name', keep='last')
+    return set(latest['report_id'].astype('int64'))
+
+# Function to drop the facts of every report superseded by a later report of the same municipality (see `latest_report_ids`)
+def drop_superseded_reports(df):
+    reports = df.groupby('report.id', sort=False, observed=True).agg(report_entity_name=('report.entity-name', 'first'), fiscal_year=('period.fiscal-year', 'max'))
+    reports = reports.reset_index().rename(columns={'report.id': 'report_id'})
+    keep = latest_report_ids(reports)
+    if len(keep) == len(reports):
+        return df
+    return df[df['report.id'].isin(keep)]
+
+# Function to reduce the raw CSV DataFrame to the columns the batch engine reads
+def build_fact_table(df):
+    df = ensure_dimension_columns(df)
+    facts = df[['report.id', 'report.entity-name', 'cube.primary-local-name', 'period.fiscal-year', 'fact.value'] + member_columns(df)].copy()
+    facts['report.id'] = facts['report.id'].astype('int64')
+    return facts
+
+# Function to give each fact-table row a single lookup key: `cube.primary-local-name` followed by its member(s)
+def _fact_keys(fact_table):
+    keys = fact_table['cube.primary-local-name'].astype(str)
+    for column in member_columns(fact_table):
+        keys = keys + ('|' + fact_table[column].astype(object)).fillna('') # member columns may be categorical (see `load_fact_table`)
+    return keys
+
+# Function to pivot the fact table into one row per report ID with a column for every input in `BATCH_INPUTS` & `BATCH_CAPITAL_ASSET_INPUTS`
+def pivot_ratio_inputs(fact_table):
+    keys = _fact_keys(fact_table)
+    report_ids = pd.Index(fact_table['report.id'].unique(), name='report.id')
+
+    # First value reported for each single-value input
+    input_names = {concept + '|' + '|'.join(members): name for name, (concept, members) in BATCH_INPUTS.items()}
+    inputs = fact_table.assign(input=keys.map(input_names)).dropna(subset=['input'])
+    inputs = inputs.drop_duplicates(subset=['report.id', 'input'], keep='first')
+    wide = inputs.pivot(index='report.id', columns='input', values='fact.value')
+    wide = wide.reindex(index=report_ids, columns=list(BATCH_INPUTS))
+
+    # Beginning & ending capital asset values: the first two values reported, ordered by year
+    asset_names = {'CapitalAssetsNetOfAccumulatedDepreciationAndAmortization|' + member: name for name, member in BATCH_CAPITAL_ASSET_INPUTS.items()}
+    assets = fact_table.assign(input=keys.map(asset_names)).dropna(subset=['input'])
+    assets = assets.groupby(['report.id', 'input'], sort=False).head(2)
+    assets = assets.sort_values('period.fiscal-year', kind='stable')
+    assets = assets[assets.groupby(['report.id', 'input'])['fact.value'].transform('size') == 2]
+    grouped = assets.groupby(['report.id', 'input'])['fact.value']
+    for position, suffix in [('first', '_begin'), ('last', '_end')]:
+        values = grouped.agg(position).unstack('input').reindex(index=report_ids, columns=list(BATCH_CAPITAL_ASSET_INPUTS))
+        wide = wide.join(values.add_suffix(suffix))
+
+    # Population of each municipality for its latest fiscal year (see `join_populations`)
+    fiscal_years = fact_table.groupby('report.id', sort=False)['period.fiscal-year'].max().reindex(report_ids)
+    wide['population'] = join_populations(report_ids, fiscal_years)
+    return wide
+
+# Function to pivot the fact table into one row per (report ID, fiscal year) with a column for every input, for multi-year ratios
+# Beginning capital asset values are the values reported for the previous fiscal year
+def pivot_ratio_inputs_by_year(fact_table):
+    keys = _fact_keys(fact_table)
+    index = ['report.id', 'period.fiscal-year']
+
+    # First value reported for each single-value input & fiscal year
+    input_names = {concept + '|' + '|'.join(members): name for name, (concept, members) in BATCH_INPUTS.items()}
+    inputs = fact_table.assign(input=keys.map(input_names)).dropna(subset=['input'])
+    inputs['period.fiscal-year'] = inputs['period.fiscal-year'] + inputs['input'].isin(BATCH_PRIOR_YEAR_INPUTS) # see `BATCH_PRIOR_YEAR_INPUTS`
+    inputs = inputs.drop_duplicates(subset=index + ['input'], keep='first')
+    wide = inputs.pivot(index=index, columns='input', values='fact.value').reindex(columns=list(BATCH_INPUTS))
+
+    # Ending capital asset values for each fiscal year, and the previous year's values as beginning values
+    asset_names = {'CapitalAssetsNetOfAccumulatedDepreciationAndAmortization|' + member: name for name, member in BATCH_CAPITAL_ASSET_INPUTS.items()}
+    assets = fact_table.assign(input=keys.map(asset_names)).dropna(subset=['input'])
+    assets = assets.drop_duplicates(subset=index + ['input'], keep='first')
+    end_values = assets.pivot(index=index, columns='input', values='fact.value').reindex(columns=list(BATCH_CAPITAL_ASSET_INPUTS))
+    begin_values = end_values.reset_index()
+    begin_values['period.fiscal-year'] += 1
+    begin_values = begin_values.set_index(index)
+
+    wide = wide.reindex(wide.index.union(end_values.index))
+    wide = wide.join(begin_values.reindex(wide.index).add_suffix('_begin')).join(end_values.reindex(wide.index).add_suffix('_end'))
+
+    # Population of each municipality & fiscal year (see `join_populations`)
+    wide['population'] = join_populations(wide.index.get_level_values('report.id'), wide.index.get_level_values('period.fiscal-year'))
+    return wide
+
+# Function to name the table the pivoted inputs are for, as a metrics label: `latest` (`final_ratios`) or `panel` (ratio panel)
+def _ratio_table(w):
+    return 'panel' if 'period.fiscal-year' in w.index.names else 'latest'
+
+# Functions that calculate (value, var_1_value, var_2_value) for every report ID at once from the pivoted inputs
+# NOTE: Keys & order match `RATIO_TARGETS` -- add new ratios to both
+def _batch_short_run(w):
+    return w['gf_balance_unassigned'] / w['gf_revenue'], w['gf_balance_unassigned'], w['gf_revenue']
+
+def _batch_days_cash_on_hand(w):
+    return w['gf_cash'] / (w['gf_expenditures'] / 365), w['gf_cash'], w['gf_expenditures'] / 365
+
+def _batch_liquidity(w):
+    denominator = w['gf_liabilities'] - w['gf_deferred_inflows']
+    return w['gf_cash'] / denominator, w['gf_cash'], denominator
+
+def _batch_gov_debt_coverage(w):
+    metrics.inc('ratio_fallbacks_total', {'ratio': 'Governmental Funds Debt Coverage', 'input': 'capital_outlay', 'engine': 'batch', 'table': _ratio_table(w)},
+                int((w['gov_capital_outlay'].isna() & w['gov_expenditures'].notna()).sum()))
+    debt_serv_expenditures = w['gov_debt_principal'] + w['gov_debt_interest']
+    denominator = w['gov_expenditures'] - w['gov_capital_outlay'].fillna(0) - debt_serv_expenditures # account for missing Capital Outlay data
+    return debt_serv_expenditures / denominator, debt_serv_expenditures, denominator
+
+def _batch_expenditure_per_capita(w):
+    return w['gov_expenditures'] / w['population'], w['gov_expenditures'], w['population']
+
+def _batch_net_asset_growth(w):
+    return -w['ga_change_net_position'] / w['ga_begin_net_position'], w['ga_change_net_position'], w['ga_begin_net_position']
+
+def _batch_captial_asset(w, prefix):
+    change = w[prefix + '_end'] - w[prefix + '_begin']
+    return change / w[prefix + '_begin'], change, w[prefix + '_begin']
+
+def _batch_own_source_rev(w):
+    return (w['pg_operating_grants'] / w['pg_net_expense_revenue']).abs(), w['pg_operating_grants'], w['pg_net_expense_revenue']
+
+BATCH_RATIOS = {
+    'Short Run Financial Position': _batch_short_run,
+    'Days of Cash on Hand': _batch_days_cash_on_hand,
+    'Liquidity (Quick) Ratio': _batch_liquidity,
+    'Governmental Funds Debt Coverage': _batch_gov_debt_coverage,
+    'Expenditure per Capita': _batch_expenditure_per_capita,
+    'Net Asset Growth (Governmental Activities)': _batch_net_asset_growth,
+    'Capital Asset Condition (Governmental Activities)': lambda w: _batch_captial_asset(w, 'ga_capital_assets'),
+    'Capital Asset Condition (Business-Type Activities)': lambda w: _batch_captial_asset(w, 'bta_capital_assets'),
+    'Proportion of (Non) Own-Source Revenue': _batch_own_source_rev,
+}
+
+# Inputs each ratio in `BATCH_RATIOS` needs (NOTE: Capital Outlay is left out, it defaults to 0 when it was not reported)
+BATCH_RATIO_INPUTS = {
+    'Short Run Financial Position': ['gf_balance_unassigned', 'gf_revenue'],
+    'Days of Cash on Hand': ['gf_cash', 'gf_expenditures'],
+    'Liquidity (Quick) Ratio': ['gf_cash', 'gf_liabilities', 'gf_deferred_inflows'],
+    'Governmental Funds Debt Coverage': ['gov_debt_principal', 'gov_debt_interest', 'gov_expenditures'],
+    'Expenditure per Capita': ['gov_expenditures', 'population'],
+    'Net Asset Growth (Governmental Activities)': ['ga_change_net_position', 'ga_begin_net_position'],
+    'Capital Asset Condition (Governmental Activities)': ['ga_capital_assets_begin', 'ga_capital_assets_end'],
+    'Capital Asset Condition (Business-Type Activities)': ['bta_capital_assets_begin', 'bta_capital_assets_end'],
+    'Proportion of (Non) Own-Source Revenue': ['pg_operating_grants', 'pg_net_expense_revenue'],
+}
+
+# Function to describe a batch input for the `unavailable_reason` column, e.g. `RevenuesModifiedAccrual (GeneralFundMember)`
+def _input_label(name):
+    if name in BATCH_INPUTS:
+        concept, members = BATCH_INPUTS[name]
+    elif name.endswith('_begin') or name.endswith('_end'):
+        prefix, period = name.rsplit('_', 1)
+        concept, members = 'CapitalAssetsNetOfAccumulatedDepreciationAndAmortization', (BATCH_CAPITAL_ASSET_INPUTS[prefix], period)
+    elif name == 'population':
+        return 'Population (population.csv)'
+    else:
+        return name
+    return '{} ({})'.format(concept, ', '.join(members))
+
+# Function to explain why each value of a ratio could not be calculated: which inputs were not reported, or a division by zero
+# Returns a Series with the reason for every NaN (or infinite) value, and None for every value that was calculated
+def _unavailable_reasons(wide, ratio_name, value):
+    missing = pd.Series('', index=wide.index)
+    for name in BATCH_RATIO_INPUTS[ratio_name]:
+        missing = missing + np.where(wide[name].isna() | ((name == 'population') & (wide[name] == 0)), _input_label(name) + '; ', '')
+    reasons = np.where(missing != '', 'Not reported: ' + missing.str[:-2], 'Division by zero')
+    return pd.Series(np.where(np.isfinite(value), None, reasons), index=wide.index)
+
+# Function to calculate every ratio in `BATCH_RATIOS` from the pivoted inputs and return one DataFrame per ratio
+# NOTE: Infinite values (division by zero) are stored as NaN, with the reason in `unavailable_reason`
+def _ratio_frames(wide, entity_names):
+    report_ids = wide.index.get_level_values('report.id')
+    frames = []
+    for position, (ratio_name, batch_function) in enumerate(BATCH_RATIOS.items()):
+        labels = {'ratio': ratio_name, 'engine': 'batch', 'table': _ratio_table(wide)}
+        with metrics.timer('ratio_function_seconds', labels, 'ratio_function_failures_total'):
+            value, var_1_value, var_2_value = batch_function(wide)
+        value = value.astype(float)
+        reasons = _unavailable_reasons(wide, ratio_name, value)
+        metrics.inc('ratio_unavailable_total', labels, int(reasons.notna().sum()))
+        frame = pd.DataFrame({'report_id': report_ids, 'report_entity_name': entity_names.reindex(report_ids).values,
+                              'ratio': ratio_name, 'value': value.where(np.isfinite(value)).values,
+                              'var_1_value': var_1_value.values, 'var_2_value': var_2_value.values,
+                              'unavailable_reason': reasons.values})
+        if 'period.fiscal-year' in wide.index.names:
+            frame['fiscal_year'] = wide.index.get_level_values('period.fiscal-year')
+        frames.append(frame.assign(**RATIO_TARGETS[ratio_name], _report_position=range(len(wide)), _ratio_position=position))
+    return frames
+
+# Function to calculate some ratios from pivoted inputs (see `pivot_ratio_inputs`) without building `final_ratios` rows, e.g. for what-if scenarios
+# Returns a dictionary of ratio name -> DataFrame indexed like `wide`, with `value`, `var_1_value`, `var_2_value` & `unavailable_reason` columns
+def evaluate_ratios(wide, ratio_names):
+    results = {}
+    for ratio_name in ratio_names:
+        value, var_1_value, var_2_value = BATCH_RATIOS[ratio_name](wide)
+        value = value.astype(float)
+        results[ratio_name] = pd.DataFrame({'value': value.where(np.isfinite(value)), 'var_1_value': var_1_value, 'var_2_value': var_2_value,
+                                            'unavailable_reason': _unavailable_reasons(wide, ratio_name, value)})
+    return results
+
+# Function to calculate every ratio for every report ID and return the complete `final_ratios` DataFrame
+# Rows are ordered by report ID (in the order they appear in `df`) and then by ratio (in the order of `RATIO_TARGETS`)
+# NOTE: Ratios whose inputs were not reported have a `value` of NaN instead of raising an error
+def compute_ratios(df):
+    fact_table = build_fact_table(df)
+    wide = pivot_ratio_inputs(fact_table)
+    entity_names = fact_table.groupby('report.id', sort=False)['report.entity-name'].first().astype(object)
+
+    final_ratios = pd.concat(_ratio_frames(wide, entity_names), ignore_index=True)
+    final_ratios = final_ratios.sort_values(['_report_position', '_ratio_position'], kind='stable')
+    return final_ratios[RATIO_COLUMNS].reset_index(drop=True)
+
+# Number of worker processes used by `compute_ratio_tables` (None: one per CPU core)
+RATIO_WORKERS = None
+
+# Minimum number of municipalities before `compute_ratio_tables` splits the work across processes (smaller datasets are faster in one)
+# Estimated with `python benchmark.py --calibrate` on a single core: one process takes ~1.2 ms per municipality, and the process pool
+# adds ~0.45 s plus ~0.35 ms per municipality (starting the workers, sending the shards & results). Even with 4-8 cores, the processes
+# only win from ~650-800 municipalities. NOTE: Not yet measured on a multi-core machine: run the calibration there and use its `threshold`
+PARALLEL_MIN_ENTITIES = 800
+
+# Number of shards per worker process, so a slow shard does not hold up the others
+SHARDS_PER_WORKER = 4
+
+# Function to calculate `final_ratios` & the ratio panel (see `compute_ratios` & `compute_ratio_panel`), sharding the report IDs across processes
+# Each shard is calculated independently and the results are merged in the order of `df`, so the result is the same as in one process.
+# NOTE: A municipality whose filing cannot be processed at all gets NaN ratios with the error as `unavailable_reason`, instead of
+# failing the whole calculation (see `_compute_shard`)
+def compute_ratio_tables(df, workers=RATIO_WORKERS):
+    workers = workers or os.cpu_count() or 1
+    positions = df.groupby('report.id', sort=False).indices # report ID -> row positions, in the order of `df`
+    if workers == 1 or len(positions) < PARALLEL_MIN_ENTITIES:
+        return _compute_shard(df)
+
+    shards = [df.take(np.concatenate([positions[report_id] for report_id in report_ids]))
+              for report_ids in np.array_split(np.array(list(positions), dtype=object), workers * SHARDS_PER_WORKER) if len(report_ids)]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_compute_shard, shard) for shard in shards]
+        for shard, future in zip(shards, futures):
+            try:
+                results.append(future.result())
+            except BrokenProcessPool: # a worker process died (e.g. out of memory): calculate the shard in this process instead
+                results.append(_compute_shard(shard))
+
+    final_ratios = pd.concat([final_ratios for final_ratios, panel in results], ignore_index=True)
+    ratio_panel = pd.concat([panel for final_ratios, panel in results]).sort_index()
+    return final_ratios, ratio_panel
+
+# Function to calculate (`final_ratios`, ratio panel) for one shard of the fact table
+# If the shard fails as a whole, each municipality is calculated on its own, so one malformed filing only affects its own ratios
+def _compute_shard(df):
+    try:
+        return compute_ratios(df), compute_ratio_panel(df)
+    except Exception:
+        results = [_compute_entity(rows) for report_id, rows in df.groupby('report.id', sort=False)]
+        return pd.concat([final_ratios for final_ratios, panel in results], ignore_index=True), pd.concat([panel for final_ratios, panel in results]).sort_index()
+
+# Function to calculate (`final_ratios`, ratio panel) for the facts of one municipality, recording any error as unavailable ratios
+def _compute_entity(rows):
+    try:
+        return compute_ratios(rows), compute_ratio_panel(rows)
+    except Exception as error:
+        metrics.inc('entity_failures_total', {'error': type(error).__name__})
+        report_id, entity_name = int(rows['report.id'].iloc[0]), rows['report.entity-name'].iloc[0]
+        final_ratios = pd.DataFrame([dict(make_ratio_row(report_id, entity_name, ratio_name, np.nan, np.nan, np.nan),
+                                          unavailable_reason='Error: {}: {}'.format(type(error).__name__, error)) for ratio_name in RATIO_TARGETS])
+        return final_ratios[RATIO_COLUMNS], compute_ratio_panel(rows.iloc[0:0])
+
+# Columns of the ratio panel (one row per municipality, ratio & fiscal year); target ranges are the same every year (see `RATIO_TARGETS`)
+PANEL_COLUMNS = ['report_id', 'report_entity_name', 'ratio', 'fiscal_year', 'value', 'var_1_value', 'var_2_value']
+
+# Function to calculate every ratio for every report ID & every fiscal year with data, in a single batch
+# Returns the ratio panel, indexed by (`report_entity_name`, `ratio`, `fiscal_year`) and sorted, so one entity's history of a ratio is a fast slice
+# NOTE: (entity, ratio, year) combinations whose inputs were not reported are left out
+def compute_ratio_panel(df):
+    fact_table = build_fact_table(df)
+    wide = pivot_ratio_inputs_by_year(fact_table)
+    entity_names = fact_table.groupby('report.id', sort=False)['report.entity-name'].first().astype(object)
+
+    panel = pd.concat(_ratio_frames(wide, entity_names), ignore_index=True)
+    panel = panel[panel['value'].notna()][PANEL_COLUMNS]
+    panel['fiscal_year'] = panel['fiscal_year'].astype('int64')
+    return panel.set_index(['report_entity_name', 'ratio', 'fiscal_year'], drop=False).sort_index()
+
+# Function to return the history of one ratio for one entity from the ratio panel (rows ordered by fiscal year)
+def ratio_history(panel, entity_name, ratio_name):
+    try:
+        return panel.loc[(entity_name, ratio_name)]
+    except KeyError:
+        return panel.iloc[0:0]
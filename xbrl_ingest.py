@@ -0,0 +1,406 @@
+import argparse
+import getpass
+import glob
+import json
+import os
+import shutil
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+import pandas as pd
+import pyarrow.parquet as pq
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import xbrl_functions
+
+# XBRL US API endpoints (NOTE: `base_url` can point at a local stub of the API for testing)
+BASE_URL = 'https://api.xbrl.us'
+TOKEN_PATH = '/oauth2/token'
+SEARCH_PATH = '/api/v1/cube/search'
+REPORT_SEARCH_PATH = '/api/v1/report/search'
+
+# Default query: ACFR reports & statements used by the dashboard
+# County of Ogemaw: https://xbrlus.github.io/acfr/ixviewer/ix.html?doc=../samples/100/Ogemaw-20210930-Annual-Accounts.htm
+# Flint, Michigan: https://xbrlus.github.io/acfr/ixviewer/ix.html?doc=../samples/107/FLINTF652021.htm
+REPORT_IDS = ['677268', '677267']
+STATEMENT_IDS = [404000, 300690, 200000, 801150, 200110]
+
+# Data fields to return (multi-sort based on order)
+FIELDS = [
+    'report.id',
+    'period.fiscal-year',
+    'period.instant',
+    'period.start',
+    'period.end',
+    'cube.description.sort(ASC)',
+    'cube.tree-sequence.sort(ASC)',
+    'report.entity-name',
+    'dimensions.count',
+    'dimension-pair',
+    'cube.primary-local-name',
+    'fact.value',
+    'unit'
+]
+
+# Column order of `xbrl_data.csv` (the axis/member columns from `xbrl_functions.flatten_dimensions` follow these)
+CSV_COLUMNS = ['report.id', 'period.fiscal-year', 'cube.description', 'cube.tree-sequence', 'report.entity-name',
+               'dimensions.count', 'cube.primary-local-name', 'fact.value', 'unit', 'cube_id', 'period.instant', 'period.start', 'period.end']
+
+# Columns that identify a fact in a partition: a fact repeated by overlapping pages has the same key (its axis/member columns are part of
+# the key too, see `fact_key_columns`)
+# NOTE: The period is part of the key, not just the fiscal year -- e.g. the beginning & ending balances of a capital asset roll-forward
+# are the same concept & members in the same fiscal year
+PERIOD_COLUMNS = ['period.instant', 'period.start', 'period.end']
+FACT_KEY_COLUMNS = ['report.id', 'cube.primary-local-name', 'period.fiscal-year'] + PERIOD_COLUMNS
+
+# Maximum number of rows per query for each account type, keyed by the page size the API returns
+# 100 rows per page: non-Member account (1,000 rows), 500 rows per page: Basic Individual Member account (2,000 rows)
+ACCOUNT_ROW_LIMITS = {100: 1000, 500: 2000}
+
+# Number of partitions fetched at the same time (also the size of the connection pool)
+WORKERS = 8
+
+# Default location of the fact store (see `sync`)
+STORE_DIR = 'xbrl_facts'
+
+# Guards token refreshes & manifest writes, which are shared by the worker threads
+_lock = threading.Lock()
+
+
+# Function to create an HTTP session with pooled keep-alive connections
+# Requests that fail with a rate limit (429) or server error are retried with exponential backoff, honoring the `Retry-After` header
+def make_session(workers=WORKERS, retries=5, backoff_factor=1):
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET', 'POST'], respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Function to authenticate with an XBRL US Web account and return the token response (`access_token`, `refresh_token`, ...)
+# NOTE: The client ID & secret are added to the returned dictionary, so the access token can be refreshed when it expires
+def get_access_token(session, email, password, client_id, client_secret, base_url=BASE_URL):
+    body_auth = {'username': email,
+                 'client_id': client_id,
+                 'client_secret': client_secret,
+                 'password': password,
+                 'grant_type': 'password',
+                 'platform': 'ipynb'}
+    res = session.post(base_url + TOKEN_PATH, data=body_auth, headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    auth_json = res.json()
+    if 'error' in auth_json:
+        raise RuntimeError('There was a problem generating an access token with these credentials: {}'.format(auth_json.get('error_description', auth_json['error'])))
+    auth_json.update(client_id=client_id, client_secret=client_secret)
+    return auth_json
+
+# Function to replace an expired access token (in place) using the refresh token
+def refresh_access_token(session, auth, base_url=BASE_URL, expired_token=None):
+    with _lock:
+        if expired_token is not None and auth['access_token'] != expired_token:
+            return auth # another worker already refreshed it
+        refresh_auth = {'client_id': auth['client_id'],
+                        'client_secret': auth['client_secret'],
+                        'grant_type': 'refresh_token',
+                        'platform': 'ipynb',
+                        'refresh_token': auth['refresh_token']}
+        refresh_json = session.post(base_url + TOKEN_PATH, data=refresh_auth, headers={'Content-Type': 'application/x-www-form-urlencoded'}).json()
+        if 'error' in refresh_json:
+            raise RuntimeError('There was a problem refreshing the access token: {}'.format(refresh_json.get('error_description', refresh_json['error'])))
+        auth['access_token'] = refresh_json['access_token']
+        auth['refresh_token'] = refresh_json['refresh_token']
+        return auth
+
+# Function to send an authenticated GET request and return the JSON response
+# `auth` is either an access token, or the dictionary from `get_access_token` (in which case an expired token is refreshed once)
+def api_get(session, auth, path, params, base_url=BASE_URL):
+    access_token = auth['access_token'] if isinstance(auth, dict) else auth
+    res = session.get(base_url + path, params=params, headers={'Authorization': 'Bearer {}'.format(access_token)})
+    if res.status_code == 401 and isinstance(auth, dict) and auth.get('refresh_token'):
+        refresh_access_token(session, auth, base_url, expired_token=access_token)
+        res = session.get(base_url + path, params=params, headers={'Authorization': 'Bearer {}'.format(auth['access_token'])})
+    return res.json()
+
+# Function to fetch the pages of one (report ID, statement ID) partition, starting at `start_offset`
+# Yields (offset, records, next_offset, truncated) for each page; `next_offset` is None after the last page
+# Pagination stops at the row limit of the account: `truncated` is True if the partition has more rows than the account can fetch
+# (a warning is printed, as the rows past the limit are missing)
+def iter_partition_pages(session, auth, report_id, statement_id, base_url=BASE_URL, start_offset=0):
+    params = {'report.id': str(report_id), 'cube.description': str(statement_id), 'fields': ','.join(FIELDS), 'unique': ''}
+    offset_value = start_offset
+    while True:
+        if offset_value:
+            params['fields'] = ','.join(FIELDS) + ',cube.offset({})'.format(offset_value)
+        res_json = api_get(session, auth, SEARCH_PATH, params, base_url)
+        if 'error' in res_json:
+            raise RuntimeError('There was an error fetching report {}, statement {}: {}'.format(report_id, statement_id, res_json.get('error_description', res_json['error'])))
+
+        records = res_json['data']
+        for record in records:
+            record['cube_id'] = int(statement_id)
+
+        limit = res_json['paging']['limit']
+        next_offset = offset_value + limit
+        truncated = False
+        if res_json['paging']['count'] < limit:
+            next_offset = None
+        elif next_offset >= ACCOUNT_ROW_LIMITS.get(limit, float('inf')):
+            next_offset = None
+            truncated = True
+            warnings.warn('Report {}, statement {} reached the limit of {} rows per query of this account; the rows past the limit are missing. '
+                          'Consider upgrading (https://xbrl.us/access-token).'.format(report_id, statement_id, ACCOUNT_ROW_LIMITS[limit]))
+
+        yield offset_value, records, next_offset, truncated
+        if next_offset is None:
+            break
+        offset_value = next_offset
+
+# Function to fetch every page of one (report ID, statement ID) partition and return the list of records
+# Pagination starts at offset 0 for every partition, and stops at the row limit of the account
+def fetch_partition(session, access_token, report_id, statement_id, base_url=BASE_URL):
+    return [record for offset, records, next_offset, truncated in iter_partition_pages(session, access_token, report_id, statement_id, base_url) for record in records]
+
+# Function to fetch every (report ID, statement ID) partition concurrently and return the combined list of records
+# NOTE: Records are returned in partition order (statement, then report), regardless of which request finishes first
+def fetch_records(access_token, report_ids=REPORT_IDS, statement_ids=STATEMENT_IDS, workers=WORKERS, base_url=BASE_URL, session=None):
+    session = session or make_session(workers)
+    partitions = [(report_id, statement_id) for statement_id in statement_ids for report_id in report_ids]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda partition: fetch_partition(session, access_token, *partition, base_url=base_url), partitions)
+        return [record for records in results for record in records]
+
+# Function to turn API records into the `xbrl_data.csv` format
+# Rows with non-numeric 'fact.value' are dropped, and `dimension-pair` is replaced with explicit axis/member columns
+def normalize_facts(records):
+    df = pd.DataFrame(records)
+    if df.empty:
+        return pd.DataFrame(columns=CSV_COLUMNS)
+    df['fact.value'] = pd.to_numeric(df['fact.value'], errors='coerce')
+    df = df[df['fact.value'].notna()]
+    if 'dimension-pair' not in df.columns:
+        df['dimension-pair'] = None
+    df = xbrl_functions.flatten_dimensions(df)
+    return df[[column for column in CSV_COLUMNS if column in df.columns] + [column for column in df.columns if column not in CSV_COLUMNS]]
+
+# Function to fetch & normalize the facts for a set of reports and statements
+def fetch_facts(access_token, report_ids=REPORT_IDS, statement_ids=STATEMENT_IDS, workers=WORKERS, base_url=BASE_URL):
+    return normalize_facts(fetch_records(access_token, report_ids, statement_ids, workers, base_url))
+
+
+# Below is the incremental, resumable, streaming ingestion used by the command line.
+# Facts are written to a fact store: a directory of Parquet (columnar) files with one partition per (report ID, statement ID):
+#   <store>/report.id=<report ID>/cube_id=<statement ID>/part-0.parquet
+# Each page is normalized and written to disk as soon as it arrives, so memory use does not grow with the number of reports.
+#
+# Progress is recorded in a manifest (`<store>/_manifest.json`) with the following keys & values:
+# `partitions`: 'reportID:statementID' -> {`status`, `offset`: next page to fetch, `filing_date`: filing date of the report being fetched,
+#               `updated`: time of the last checkpoint, `truncated`: True if the partition stopped at the row limit of the account}
+# Partition statuses are as follows:
+# `fetching`: pages before `offset` are saved in the partition's `.partial` directory; fetching resumes at `offset`
+# `fetched`: every page is saved in the `.partial` directory, but the partition has not replaced the old one yet
+# `complete`: part of the fact store; only fetched again if the report's filing date changes (or with `full=True`)
+
+# Function to return the path of the manifest in a fact store
+def manifest_path(store_dir=STORE_DIR):
+    return os.path.join(store_dir, '_manifest.json')
+
+# Function to read the manifest (returns an empty manifest if the file does not exist)
+def load_manifest(store_dir=STORE_DIR):
+    if not os.path.exists(manifest_path(store_dir)):
+        return {'partitions': {}}
+    with open(manifest_path(store_dir)) as f:
+        return json.load(f)
+
+# Function to write the manifest (NOTE: written to a temporary file first, so an interruption never leaves it half written)
+def save_manifest(manifest, store_dir=STORE_DIR):
+    with _lock:
+        os.makedirs(store_dir, exist_ok=True)
+        tmp_path = manifest_path(store_dir) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, manifest_path(store_dir))
+
+# Function to name a partition in the manifest
+def partition_key(report_id, statement_id):
+    return '{}:{}'.format(report_id, statement_id)
+
+# Function to return the directory of a partition in the fact store
+def partition_dir(store_dir, report_id, statement_id):
+    return os.path.join(store_dir, 'report.id={}'.format(report_id), 'cube_id={}'.format(statement_id))
+
+# Function to list the complete partitions in the fact store as (report ID, statement ID, directory)
+# Partitions are ordered by statement (in the order of `statement_ids`, then any others), then by report ID
+def list_partitions(store_dir=STORE_DIR, report_ids=None, statement_ids=None):
+    partitions = []
+    for path in glob.glob(os.path.join(store_dir, 'report.id=*', 'cube_id=*')):
+        if path.endswith('.partial') or path.endswith('.tmp'):
+            continue
+        report_id = int(os.path.basename(os.path.dirname(path))[len('report.id='):])
+        statement_id = int(os.path.basename(path)[len('cube_id='):])
+        if report_ids is not None and str(report_id) not in {str(x) for x in report_ids}:
+            continue
+        partitions.append((report_id, statement_id, path))
+    statement_order = [int(statement_id) for statement_id in (statement_ids if statement_ids is not None else STATEMENT_IDS)]
+    report_order = [int(report_id) for report_id in report_ids] if report_ids is not None else []
+    return sorted(partitions, key=lambda p: (statement_order.index(p[1]) if p[1] in statement_order else len(statement_order), p[1],
+                                             report_order.index(p[0]) if p[0] in report_order else len(report_order), p[0]))
+
+# Function to read the facts of selected partitions from the fact store (all partitions by default)
+# NOTE: Only the requested report IDs (and fiscal years) are read from disk
+def load_fact_store(store_dir=STORE_DIR, report_ids=None, statement_ids=None, fiscal_years=None):
+    filters = [('period.fiscal-year', 'in', [int(year) for year in fiscal_years])] if fiscal_years is not None else None
+    frames = [pd.read_parquet(path, filters=filters) for report_id, statement_id, path in list_partitions(store_dir, report_ids, statement_ids)]
+    if not frames:
+        return pd.DataFrame(columns=CSV_COLUMNS)
+    facts = pd.concat(frames, ignore_index=True)
+    return facts[[column for column in CSV_COLUMNS if column in facts.columns] + xbrl_functions.axis_member_columns(facts)]
+
+# Function to write the fact store to a CSV file in the `xbrl_data.csv` format, one partition at a time
+def export_csv(store_dir=STORE_DIR, output='xbrl_data.csv', report_ids=None, statement_ids=None):
+    partitions = list_partitions(store_dir, report_ids, statement_ids)
+
+    # Union of the columns of every partition (partitions with fewer dimensions have fewer axis/member columns)
+    names = {name for report_id, statement_id, path in partitions for file in glob.glob(os.path.join(path, '*.parquet')) for name in pq.read_schema(file).names}
+    columns = [column for column in CSV_COLUMNS if column in names] + xbrl_functions.axis_member_columns(pd.DataFrame(columns=sorted(names)))
+
+    tmp_path = output + '.tmp'
+    rows = 0
+    with open(tmp_path, 'w', newline='') as f:
+        pd.DataFrame(columns=columns).to_csv(f, index=False)
+        for report_id, statement_id, path in partitions:
+            facts = pd.read_parquet(path).reindex(columns=columns)
+            facts.to_csv(f, index=False, header=False)
+            rows += len(facts)
+    os.replace(tmp_path, output)
+    return rows
+
+# Function to look up the filing date of each report (report ID -> filing date)
+# NOTE: Reports missing from the response (or an API error) are treated as unchanged
+def fetch_report_versions(session, auth, report_ids, base_url=BASE_URL):
+    params = {'report.id': ','.join(str(report_id) for report_id in report_ids), 'fields': 'report.id,report.filing-date'}
+    try:
+        res_json = api_get(session, auth, REPORT_SEARCH_PATH, params, base_url)
+    except (requests.RequestException, ValueError):
+        return {}
+    if 'error' in res_json:
+        return {}
+    return {str(record['report.id']): record.get('report.filing-date') for record in res_json.get('data', [])}
+
+# Function to fetch the remaining pages of one partition, writing each page to the partition's `.partial` directory and checkpointing the manifest
+def _sync_partition(session, auth, manifest, store_dir, report_id, statement_id, base_url):
+    entry = manifest['partitions'][partition_key(report_id, statement_id)]
+    partial_dir = partition_dir(store_dir, report_id, statement_id) + '.partial'
+    os.makedirs(partial_dir, exist_ok=True)
+    for offset, records, next_offset, truncated in iter_partition_pages(session, auth, report_id, statement_id, base_url, start_offset=entry['offset']):
+        # One file per page, so a page fetched again after an interruption overwrites its earlier copy
+        facts = normalize_facts(records)
+        if len(facts):
+            facts.to_parquet(os.path.join(partial_dir, 'page-{:08d}.parquet'.format(offset)), index=False)
+        entry.update(status='fetching' if next_offset is not None else 'fetched', offset=next_offset if next_offset is not None else offset,
+                     updated=datetime.now().replace(microsecond=0).isoformat(), truncated=truncated)
+        save_manifest(manifest, store_dir)
+
+# Function to replace a partition in the fact store with its fetched pages
+# A fact fetched more than once (e.g. by overlapping pages) is kept once, with the value from the latest page (see `fact_key_columns`)
+def _publish_partition(store_dir, report_id, statement_id):
+    final_dir = partition_dir(store_dir, report_id, statement_id)
+    partial_dir = final_dir + '.partial'
+    pages = sorted(glob.glob(os.path.join(partial_dir, 'page-*.parquet')))
+    facts = pd.concat([pd.read_parquet(page) for page in pages], ignore_index=True) if pages else normalize_facts([])
+    facts = facts.drop_duplicates(fact_key_columns(facts), keep='last')
+
+    # Write the new partition next to the old one, then swap it in
+    tmp_dir = final_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    facts.to_parquet(os.path.join(tmp_dir, 'part-0.parquet'), index=False)
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+    shutil.rmtree(partial_dir, ignore_errors=True)
+
+# Function to return the columns that identify a fact: `FACT_KEY_COLUMNS` & the axis/member columns of its dimensions
+# Returns None (every column) for pages fetched before the period columns were: without them, facts of different periods would share a key
+def fact_key_columns(facts):
+    if not any(column in facts.columns for column in PERIOD_COLUMNS):
+        return None
+    return [column for column in FACT_KEY_COLUMNS if column in facts.columns] + xbrl_functions.axis_member_columns(facts)
+
+# Function to bring the fact store up to date, fetching only new, changed, or unfinished partitions
+# After an interruption (ex: an expired access token or a network failure), running it again resumes where it left off
+# Returns a dictionary with the partitions that were fetched & published
+def sync(auth, report_ids=REPORT_IDS, statement_ids=STATEMENT_IDS, store_dir=STORE_DIR, workers=WORKERS, base_url=BASE_URL, full=False, session=None):
+    session = session or make_session(workers)
+    manifest = load_manifest(store_dir)
+    versions = fetch_report_versions(session, auth, report_ids, base_url)
+
+    # Decide which partitions need fetching
+    pending = []
+    for statement_id in statement_ids:
+        for report_id in report_ids:
+            key = partition_key(report_id, statement_id)
+            entry = manifest['partitions'].get(key)
+            filing_date = versions.get(str(report_id))
+            changed = entry is not None and filing_date is not None and entry.get('filing_date') != filing_date
+            if entry is None or changed or (full and entry['status'] == 'complete'):
+                shutil.rmtree(partition_dir(store_dir, report_id, statement_id) + '.partial', ignore_errors=True)
+                entry = manifest['partitions'][key] = {'status': 'fetching', 'offset': 0, 'filing_date': filing_date, 'updated': None, 'truncated': False}
+            if entry['status'] == 'fetching':
+                pending.append((report_id, statement_id))
+    save_manifest(manifest, store_dir)
+
+    # Fetch the pending partitions concurrently -- a failed partition does not stop the others
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_sync_partition, session, auth, manifest, store_dir, report_id, statement_id, base_url): (report_id, statement_id)
+                   for report_id, statement_id in pending}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                errors.append('{}: {}'.format(partition_key(*futures[future]), future.exception()))
+
+    # Publish every fully fetched partition to the fact store
+    fetched = [(report_id, statement_id) for statement_id in statement_ids for report_id in report_ids
+               if manifest['partitions'][partition_key(report_id, statement_id)]['status'] == 'fetched']
+    for report_id, statement_id in fetched:
+        _publish_partition(store_dir, report_id, statement_id)
+        manifest['partitions'][partition_key(report_id, statement_id)]['status'] = 'complete'
+        save_manifest(manifest, store_dir)
+
+    if errors:
+        raise RuntimeError('Some partitions could not be fetched (run again to resume):\n' + '\n'.join(errors))
+    return {'fetched': pending, 'published': fetched}
+
+
+# Command line usage: `python xbrl_ingest.py --report-ids 677268 677267 --output xbrl_data.csv`
+# Only new, changed, or unfinished partitions are fetched into the fact store (use `--full` to fetch everything again),
+# then the fact store is exported to the CSV file read by the dashboard
+# Credentials are read from the XBRL_EMAIL, XBRL_PASSWORD, XBRL_CLIENT_ID and XBRL_CLIENT_SECRET environment variables (prompted for if not set)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fetch ACFR facts from the XBRL US API into a CSV file for the dashboard.')
+    parser.add_argument('--report-ids', nargs='+', default=REPORT_IDS, help='report IDs to fetch')
+    parser.add_argument('--statement-ids', nargs='+', type=int, default=STATEMENT_IDS, help='statement (cube) IDs to fetch')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='number of partitions fetched at the same time')
+    parser.add_argument('--store', default=STORE_DIR, help='fact store directory (partitioned Parquet files)')
+    parser.add_argument('--output', default='xbrl_data.csv', help='CSV file to export the fact store to (use "" to skip)')
+    parser.add_argument('--full', action='store_true', help='fetch every partition again')
+    parser.add_argument('--base-url', default=BASE_URL, help='XBRL US API base URL')
+    args = parser.parse_args(argv)
+
+    email = os.environ.get('XBRL_EMAIL') or input('Enter your XBRL US Web account email: ')
+    password = os.environ.get('XBRL_PASSWORD') or getpass.getpass(prompt='Password: ')
+    client_id = os.environ.get('XBRL_CLIENT_ID') or getpass.getpass(prompt='Client ID: ')
+    client_secret = os.environ.get('XBRL_CLIENT_SECRET') or getpass.getpass(prompt='Secret: ')
+
+    query_start = datetime.now()
+    session = make_session(args.workers)
+    auth = get_access_token(session, email, password, client_id, client_secret, args.base_url)
+    result = sync(auth, args.report_ids, args.statement_ids, args.store, args.workers, args.base_url, args.full, session)
+    print('Fetched {} partitions into {} in {}'.format(len(result['fetched']), args.store, datetime.now() - query_start))
+    if args.output:
+        rows = export_csv(args.store, args.output, args.report_ids, args.statement_ids) # only the requested reports, not every report in the store
+        print('Wrote {} rows to {}'.format(rows, args.output))
+
+
+if __name__ == '__main__':
+    main()